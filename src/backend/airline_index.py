@@ -0,0 +1,247 @@
+import bisect
+import csv
+import functools
+import mmap
+import os
+import re
+import struct
+from typing import Iterator, NamedTuple
+
+
+AIRLINE_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'airline_codes.csv')
+
+MAGIC = b'FLAI'
+VERSION = 1
+# magic, version, csv size, csv mtime_ns, record count, pool offset, then offset + count of each key index
+HEADER = struct.Struct('<4sIQQIQ' + 'QI' * 4)
+# string pool offset and length for each of the seven text fields, then the active flag
+RECORD = struct.Struct('<' + 'IH' * 7 + 'B')
+# string pool offset and length of the key, then the record number
+ENTRY = struct.Struct('<IHI')
+
+FIELDS = ['id', 'name', 'alias', 'iata', 'icao', 'callsign', 'country']
+KEY_FIELDS = ['iata', 'icao', 'callsign', 'name']
+
+IATA_FLIGHT_NUMBER_RE = re.compile(r'^[A-Z0-9]{2}\d{1,4}[A-Z]?$')
+ICAO_FLIGHT_NUMBER_RE = re.compile(r'^[A-Z]{3}\d{1,4}[A-Z]?$')
+
+
+class Airline(NamedTuple):
+    id: str
+    name: str
+    alias: str
+    iata: str
+    icao: str
+    callsign: str
+    country: str
+    active: bool
+
+
+def normalize_name(name: str) -> str:
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.lower()).split())
+
+
+def normalize_code(code: str) -> str:
+    return code.strip().upper()
+
+
+def normalize_flight_number(flight_number: str) -> str:
+    return re.sub(r'[\s\-]+', '', flight_number).upper()
+
+
+def _key(field: str, value: str) -> str:
+    return normalize_name(value) if field == 'name' else normalize_code(value)
+
+
+def _read_csv(path: str) -> list[Airline]:
+    airlines = []
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) != 8:
+                continue
+            values = ['' if value == '\\N' else value.strip() for value in row]
+            # Placeholder codes in the source data
+            for i in (3, 4):
+                if values[i] in ('-', 'N/A'):
+                    values[i] = ''
+            airlines.append(Airline(*values[:7], active=values[7] == 'Y'))
+    return airlines
+
+
+def build_index(csv_path: str = AIRLINE_CSV, index_path: str | None = None) -> str:
+    """
+    Parses the airline CSV once into the binary index format and returns its path.
+    """
+    index_path = index_path or os.path.splitext(csv_path)[0] + '.idx'
+    stat = os.stat(csv_path)
+    airlines = _read_csv(csv_path)
+
+    pool = bytearray()
+    offsets: dict[bytes, int] = {}
+
+    def intern(text: str) -> tuple[int, int]:
+        data = text.encode('utf-8')
+        if data not in offsets:
+            offsets[data] = len(pool)
+            pool.extend(data)
+        return offsets[data], len(data)
+
+    records = bytearray()
+    for airline in airlines:
+        fields = []
+        for field in FIELDS:
+            fields.extend(intern(getattr(airline, field)))
+        records.extend(RECORD.pack(*fields, airline.active))
+
+    indexes = []
+    for field in KEY_FIELDS:
+        keyed = sorted((_key(field, getattr(airline, field)).encode('utf-8'), i)
+                       for i, airline in enumerate(airlines) if getattr(airline, field))
+        entries = bytearray()
+        for key, record in keyed:
+            if not key:
+                continue
+            entries.extend(ENTRY.pack(*intern(key.decode('utf-8')), record))
+        indexes.append((entries, len(entries) // ENTRY.size))
+
+    offset = HEADER.size + len(records)
+    index_header = []
+    body = bytearray(records)
+    for entries, count in indexes:
+        index_header.extend((offset, count))
+        body.extend(entries)
+        offset += len(entries)
+    header = HEADER.pack(MAGIC, VERSION, stat.st_size, stat.st_mtime_ns, len(airlines), offset, *index_header)
+
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(header)
+        index_file.write(body)
+        index_file.write(pool)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class _Keys:
+    """Sorted key column of one index, readable with bisect without materializing it."""
+
+    def __init__(self, index: 'AirlineIndex', offset: int, count: int):
+        self.index = index
+        self.offset = offset
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        key_offset, key_len, _ = ENTRY.unpack_from(self.index._buf, self.offset + i * ENTRY.size)
+        return self.index._pool_bytes(key_offset, key_len)
+
+    def record(self, i: int) -> int:
+        return ENTRY.unpack_from(self.index._buf, self.offset + i * ENTRY.size)[2]
+
+
+class AirlineIndex:
+    """
+    Memory mapped airline code index built from airline_codes.csv.
+
+    The CSV is parsed once into a binary file next to it with fixed size records, a shared
+    string pool and a sorted key array for each of IATA, ICAO, callsign and normalized name.
+    Lookups binary search the mapped arrays, so loading the index costs one mmap and the
+    CSV is only read again when it changes.
+    """
+
+    def __init__(self, csv_path: str = AIRLINE_CSV, index_path: str | None = None):
+        self.index_path = index_path or os.path.splitext(csv_path)[0] + '.idx'
+        if not self._is_current(csv_path):
+            build_index(csv_path, self.index_path)
+        with open(self.index_path, 'rb') as index_file:
+            self._buf = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self._buf, 0)
+        self.count = header[4]
+        self._pool = header[5]
+        self._keys = {field: _Keys(self, header[6 + 2 * i], header[7 + 2 * i]) for i, field in enumerate(KEY_FIELDS)}
+
+    def _is_current(self, csv_path: str) -> bool:
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                header = HEADER.unpack(index_file.read(HEADER.size))
+            stat = os.stat(csv_path)
+        except (OSError, struct.error):
+            return False
+        return header[:4] == (MAGIC, VERSION, stat.st_size, stat.st_mtime_ns)
+
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def default(cls) -> 'AirlineIndex':
+        return cls()
+
+    def _pool_bytes(self, offset: int, length: int) -> bytes:
+        start = self._pool + offset
+        return self._buf[start:start + length]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> Airline:
+        fields = RECORD.unpack_from(self._buf, HEADER.size + i * RECORD.size)
+        values = [self._pool_bytes(fields[j], fields[j + 1]).decode('utf-8') for j in range(0, 14, 2)]
+        return Airline(*values, active=bool(fields[14]))
+
+    def airlines(self) -> Iterator[Airline]:
+        for i in range(self.count):
+            yield self[i]
+
+    def _lookup(self, field: str, value: str) -> list[Airline]:
+        key = _key(field, value).encode('utf-8')
+        if not key:
+            return []
+        keys = self._keys[field]
+        start = bisect.bisect_left(keys, key)
+        end = bisect.bisect_right(keys, key, lo=start)
+        matches = [self[keys.record(i)] for i in range(start, end)]
+        # Codes get reused once an airline stops flying, prefer the active holder
+        matches.sort(key=lambda airline: not airline.active)
+        return matches
+
+    def by_iata(self, code: str) -> list[Airline]:
+        return self._lookup('iata', code)
+
+    def by_icao(self, code: str) -> list[Airline]:
+        return self._lookup('icao', code)
+
+    def by_callsign(self, callsign: str) -> list[Airline]:
+        return self._lookup('callsign', callsign)
+
+    def by_name(self, name: str) -> list[Airline]:
+        return self._lookup('name', name)
+
+    def active_names(self) -> set[str]:
+        return {airline.name for airline in self.airlines() if airline.active and airline.name}
+
+    def parse_flight_number(self, flight_number: str) -> tuple[Airline, str] | None:
+        """
+        Splits a flight number like AA1234 or AAL1234 into the operating airline and the
+        numeric part. Three letter ICAO prefixes are tried before two character IATA ones.
+        """
+        flight_number = normalize_flight_number(flight_number)
+        if ICAO_FLIGHT_NUMBER_RE.match(flight_number):
+            airlines = self.by_icao(flight_number[:3])
+            if airlines:
+                return airlines[0], flight_number[3:]
+        if IATA_FLIGHT_NUMBER_RE.match(flight_number):
+            airlines = self.by_iata(flight_number[:2])
+            if airlines:
+                return airlines[0], flight_number[2:]
+        return None
+
+    def canonical_flight_number(self, flight_number: str) -> str:
+        """
+        Flight number with the IATA prefix when the airline is known, otherwise just with
+        whitespace removed and upper cased.
+        """
+        parsed = self.parse_flight_number(flight_number)
+        if parsed is None:
+            return normalize_flight_number(flight_number)
+        airline, number = parsed
+        return f'{airline.iata or airline.icao}{number}'
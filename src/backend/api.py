@@ -0,0 +1,142 @@
+import argparse
+import json
+import logging
+from datetime import date
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from results_store import DEFAULT_PAGE_SIZE, DEFAULT_RESULTS_DB, ResultStore
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8000
+
+
+def _date_param(params: dict[str, list[str]], name: str) -> str | None:
+    if name not in params:
+        return None
+    value = params[name][0]
+    if value == 'today':
+        return date.today().isoformat()
+    # Raises ValueError on anything that is not yyyy-mm-dd, which becomes a 400
+    return date.fromisoformat(value).isoformat()
+
+
+def _airport_param(params: dict[str, list[str]]) -> str | None:
+    # Extracted codes are upper case and /flights compares them as stored
+    return params['airport'][0].strip().upper() if 'airport' in params else None
+
+
+class ResultsHandler(BaseHTTPRequestHandler):
+    """
+    Read only JSON API over a ResultStore.
+
+        GET /flights?from=&to=&flight_number=&airport=&limit=&cursor=
+        GET /flights/<message_id>
+        GET /trips?from=&to=&airport=&limit=&cursor=
+        GET /trips/<trip_id>
+
+    `from` and `to` are inclusive ISO dates, `from=today` gives upcoming flights. A page
+    carries `next_cursor` to pass back as `cursor` for the next one. Trips are the flights
+    chained into journeys, each with its legs, and a trip is listed when it overlaps the
+    range. Every response has an ETag made from the store's write generation, so a client
+    that sends it back in If-None-Match gets a 304 without the store being queried while
+    nothing has been written.
+    """
+
+    store: ResultStore
+    server_version = "FlightResults/1.0"
+
+    def _send(self, status: HTTPStatus, body: dict | None = None, etag: str | None = None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        if parts[0] not in ('flights', 'trips') or len(parts) > 2:
+            self._send(HTTPStatus.NOT_FOUND, {'error': 'not found'})
+            return
+
+        # `from=today` means something else tomorrow, so the date is part of the tag
+        etag = f'W/"{self.store.generation()}-{date.today().isoformat()}"'
+        if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+            self._send(HTTPStatus.NOT_MODIFIED, etag=etag)
+            return
+
+        if len(parts) == 2:
+            if parts[0] == 'trips':
+                found = self.store.trip(int(parts[1])) if parts[1].isdigit() else None
+            else:
+                found = self.store.get(parts[1])
+            if found is None:
+                self._send(HTTPStatus.NOT_FOUND, {'error': 'not found'})
+            else:
+                self._send(HTTPStatus.OK, found, etag)
+            return
+
+        params = parse_qs(url.query)
+        if parts[0] == 'trips':
+            try:
+                trips = self.store.query_trips(start=_date_param(params, 'from'),
+                                               end=_date_param(params, 'to'),
+                                               airport=_airport_param(params),
+                                               cursor=params.get('cursor', [None])[0],
+                                               limit=int(params.get('limit', [DEFAULT_PAGE_SIZE])[0]))
+            except ValueError as error:
+                self._send(HTTPStatus.BAD_REQUEST, {'error': str(error)})
+                return
+            self._send(HTTPStatus.OK, {'trips': trips.trips, 'next_cursor': trips.next_cursor}, etag)
+            return
+
+        try:
+            page = self.store.query(start=_date_param(params, 'from'),
+                                    end=_date_param(params, 'to'),
+                                    flight_number=params.get('flight_number', [None])[0],
+                                    airport=_airport_param(params),
+                                    cursor=params.get('cursor', [None])[0],
+                                    limit=int(params.get('limit', [DEFAULT_PAGE_SIZE])[0]))
+        except ValueError as error:
+            self._send(HTTPStatus.BAD_REQUEST, {'error': str(error)})
+            return
+        self._send(HTTPStatus.OK, {'flights': page.flights, 'next_cursor': page.next_cursor}, etag)
+
+    def log_message(self, format: str, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+
+def make_server(store: ResultStore, host: str = '127.0.0.1', port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    handler = type('BoundResultsHandler', (ResultsHandler,), {'store': store})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve extracted flights to the dashboard")
+    parser.add_argument("--db", default=DEFAULT_RESULTS_DB)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    store = ResultStore(args.db)
+    server = make_server(store, args.host, args.port)
+    logger.info("Serving flights on http://%s:%d/flights", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
@@ -1,33 +1,128 @@
+import argparse
+import logging
 import os
-from tools import extract_unstructured_html
-from model import ClaudeExtractor
-from schemas import AIEmailPayload, ExtractedFlightInfo
-import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+import metrics
+from compaction import BoilerplateStore, Compactor, message_sender
+from dedupe import DuplicateIndex
+from message_store import MessageStore
+from pdf_text import PdfPreprocessor
+from pipeline import Pipeline, Stage
+from tools import attachment_extraction, extract_unstructured_html, extrace_html_from_gmail_payload, save_extraction
+from model import Extractor
+from results_store import ResultStore
+from routing import DEFAULT_AUDIT_RATE, DEFAULT_LLM_BATCH_SIZE, DEFAULT_LLM_WORKERS, LLM_BATCH_WAIT
+from schemas import AIEmailPayload
+from wiring import build_extractors, print_report
 import pathlib
 
 
-if __name__ == "__main__":
-    payloads = []
-    for root, dirs, files in os.walk('./data'):
+def iter_data_files(directory: str = './data') -> Iterator[str]:
+    for root, dirs, files in os.walk(directory):
         for filename in files:
-            extracted = extract_unstructured_html(html=None, filename=os.path.join(root, filename))
-            if len(extracted) == 0:
-                continue
-            payloads.append({"payload": {'name': "Shrey Patel", 'html_text': extracted}, "id": filename})
-
-    extractor = ClaudeExtractor(schema_class=ExtractedFlightInfo)
-    payloads = [AIEmailPayload(text_context=payload['payload'],attachments=None, id=payload['id']) for payload in payloads]
-    op = extractor.extract(payloads)
-    
+            yield os.path.join(root, filename)
+
+
+def build_pipeline(source: Iterable,
+                   extractor: Extractor,
+                   cpu_pool: ProcessPoolExecutor,
+                   pdf_preprocessor: PdfPreprocessor,
+                   compactor: Compactor,
+                   duplicates: DuplicateIndex,
+                   results: ResultStore,
+                   output_dir: pathlib.Path,
+                   store: MessageStore | None = None,
+                   name: str = "Shrey Patel",
+                   llm_batch_size: int = DEFAULT_LLM_BATCH_SIZE,
+                   llm_workers: int = DEFAULT_LLM_WORKERS) -> Pipeline:
+    """
+    HTML extraction -> dedupe -> PDF text -> compaction -> LLM -> output over files in ./data,
+    or over the messages of a message store when `store` is given.
+    """
+    # Emails are parsed in a process pool and streamed to the extractor in batches instead of
+    # building every payload first
+    def extract_text(item) -> AIEmailPayload | None:
+        if store is not None:
+            # Offline replay of everything the Gmail sync has already downloaded
+            html = extrace_html_from_gmail_payload(None, item, item['id'])
+            with metrics.timer('html_parse_seconds'):
+                extracted = cpu_pool.submit(extract_unstructured_html, html).result()
+            payload_id, sender = item['id'], message_sender(item)
+            attachments = attachment_extraction(None, item, store)
+        else:
+            with metrics.timer('html_parse_seconds'):
+                extracted = cpu_pool.submit(extract_unstructured_html, None, item).result()
+            payload_id, sender, attachments = os.path.basename(item), None, []
+        if len(extracted) == 0 and not attachments:
+            return None
+        return AIEmailPayload(text_context={'name': name, 'html_text': extracted}, attachments=attachments or None,
+                              id=payload_id, sender=sender)
+
+    # Save each schema as a JSON file, and to the results store the API reads, as soon as
+    # its batch shard comes back. Requests that ran out of attempts stay in the retry queue
+    def save(result):
+        payload, schema = result
+        if extractor.failed(payload):
+            return
+        save_extraction(output_dir, payload, schema)
+        results.upsert(payload.id, schema)
+
+    return Pipeline(source, [
+        Stage('extract', extract_text, workers=os.cpu_count() or 1, queue_size=200),
+        Stage('dedupe', duplicates.add_payload, queue_size=200),
+        Stage('pdf', pdf_preprocessor.process_payload, workers=os.cpu_count() or 1, queue_size=200),
+        Stage('compact', compactor.compact_payload, queue_size=200),
+        Stage('llm', extractor.extract_iter, workers=llm_workers, queue_size=1000, batch_size=llm_batch_size,
+              batch_wait=LLM_BATCH_WAIT),
+        Stage('output', save, queue_size=1000),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", help="replay messages from a message store directory instead of ./data")
+    parser.add_argument("--llm-batch-size", type=int, default=DEFAULT_LLM_BATCH_SIZE,
+                        help="most payloads sent to the model in one batch")
+    parser.add_argument("--llm-workers", type=int, default=DEFAULT_LLM_WORKERS, help="sets of payloads in flight at once")
+    parser.add_argument("--audit-rate", type=float, default=DEFAULT_AUDIT_RATE,
+                        help="share of cheaper route results also sent to the strongest model to check them")
+    parser.add_argument("--metrics", help="record stage timings and counters to this file, .json or Prometheus text")
+    parser.add_argument("--profile", help="sample stacks while running and write them here in collapsed format")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # A handful of new emails go to the real time endpoint and backfills go through batches
+    duplicates = DuplicateIndex()
+    chain = build_extractors(duplicates, audit_rate=args.audit_rate)
+
     # Create outputs directory if it doesn't exist
     output_dir = pathlib.Path('./outputs')
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Save each schema as a JSON file
-    for i, schema in enumerate(op):
-        output_file = output_dir / f'{filenames[i]}.json'
-        with open(output_file, 'w') as f:
-            if schema is not None:
-                json.dump(schema.model_dump(), f, indent=2)
-            else:
-                json.dump({}, f, indent=2)
+    cpu_pool = ProcessPoolExecutor()
+    pdf_preprocessor = PdfPreprocessor(cpu_pool)
+    compactor = Compactor(BoilerplateStore())
+    store = MessageStore(args.store) if args.store else None
+    results = ResultStore()
+
+    pipeline = build_pipeline(store.iter_messages() if store is not None else iter_data_files(), chain.extractor, cpu_pool,
+                              pdf_preprocessor, compactor, duplicates, results, output_dir, store,
+                              llm_batch_size=args.llm_batch_size, llm_workers=args.llm_workers)
+    try:
+        with metrics.recording(args.metrics, args.profile):
+            # Requests a previous run could not finish are resubmitted first, on their own
+            for payload, schema in chain.router.retry_pending():
+                if not chain.router.failed(payload):
+                    save_extraction(output_dir, payload, schema)
+                    results.upsert(payload.id, schema)
+            stats = pipeline.run()
+        print_report(stats, chain, pdf_preprocessor)
+    finally:
+        cpu_pool.shutdown()
+        compactor.store.close()
+        chain.close()
+        results.close()
+        duplicates.close()
+        if store is not None:
+            store.close()
@@ -0,0 +1,191 @@
+import json
+import logging
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Iterable, Iterator
+
+import anthropic
+from anthropic import Anthropic
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Message Batches API limits per batch
+MAX_BATCH_REQUESTS = 100_000
+MAX_BATCH_BYTES = 256 * 1024 * 1024
+
+_SHARD_DONE = object()
+
+# Error types of batch results, by the HTTP status a whole shard failed with
+STATUS_ERROR_TYPES = {400: 'invalid_request_error', 401: 'authentication_error', 403: 'permission_error',
+                      404: 'not_found_error', 413: 'request_too_large', 429: 'rate_limit_error'}
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+def errored_result(custom_id: str, error: Exception) -> SimpleNamespace:
+    """Batch result of a request whose whole shard failed, shaped like an API errored result."""
+    error_type = STATUS_ERROR_TYPES.get(getattr(error, 'status_code', None), 'api_error')
+    return SimpleNamespace(custom_id=custom_id,
+                           result=SimpleNamespace(type='errored',
+                                                  error=SimpleNamespace(type='error',
+                                                                        error=SimpleNamespace(type=error_type,
+                                                                                              message=str(error)))))
+
+
+def shard_requests(requests: Iterable[dict],
+                   max_requests: int = MAX_BATCH_REQUESTS,
+                   max_bytes: int = MAX_BATCH_BYTES) -> Iterator[list[dict]]:
+    """
+    Lazily groups batch requests into shards that stay within both the request count and
+    the serialized size limit of a single batch.
+    """
+    shard: list[dict] = []
+    shard_bytes = 0
+    for request in requests:
+        size = len(json.dumps(request, separators=(',', ':')))
+        if shard and (len(shard) >= max_requests or shard_bytes + size > max_bytes):
+            yield shard
+            shard, shard_bytes = [], 0
+        shard.append(request)
+        shard_bytes += size
+    if shard:
+        yield shard
+
+
+class BatchScheduler:
+    """
+    Submits batch requests as concurrent shards and streams back their results.
+
+    At most `max_concurrent` shards are in flight, each polled with its own adaptive
+    interval: polls start at `min_poll` seconds and back off towards `max_poll` while the
+    shard makes no progress. Results are handed over through a bounded queue as soon as
+    their shard ends, so memory stays flat however many requests go in. Results come back
+    in completion order, match them to requests by `custom_id`.
+
+    A shard that cannot be submitted or read back does not end the stream, each of its
+    requests that has no result yet comes back as an errored result instead. Transient
+    errors while polling are logged and the shard is polled again.
+    """
+
+    def __init__(self,
+                 client: Anthropic,
+                 max_requests: int = MAX_BATCH_REQUESTS,
+                 max_bytes: int = MAX_BATCH_BYTES,
+                 max_concurrent: int = 4,
+                 min_poll: float = 5.0,
+                 max_poll: float = 60.0,
+                 poll_backoff: float = 1.5,
+                 result_buffer: int = 1000):
+        self.client = client
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_concurrent = max_concurrent
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.poll_backoff = poll_backoff
+        self.result_buffer = result_buffer
+
+    def _wait(self, batch_id: str, stop: threading.Event):
+        interval = self.min_poll
+        last_done = -1
+        while not stop.wait(interval):
+            try:
+                status = self.client.beta.messages.batches.retrieve(batch_id)
+            except anthropic.APIError as error:
+                if not is_transient(error):
+                    raise
+                logger.warning("Polling batch %s failed (%s), polling again", batch_id, error)
+                interval = min(self.max_poll, interval * self.poll_backoff)
+                continue
+            if status.processing_status == "ended":
+                return
+            counts = status.request_counts
+            done = counts.succeeded + counts.errored + counts.canceled + counts.expired
+            logger.debug("Batch %s: %d processing, %d done", batch_id, counts.processing, done)
+            # Poll at the short interval while the shard is moving, back off while it is queued
+            interval = self.min_poll if done > last_done and last_done >= 0 else min(self.max_poll, interval * self.poll_backoff)
+            last_done = done
+
+    @staticmethod
+    def _put(results: queue.Queue, item: Any, stop: threading.Event):
+        # Gives up once the consumer has gone away instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run_shard(self, shard: list[dict], results: queue.Queue, stop: threading.Event):
+        # Only the ids are kept once the shard is submitted, to report the requests if it fails
+        unanswered = {request['custom_id'] for request in shard}
+        try:
+            batch = self.client.beta.messages.batches.create(requests=shard)
+            logger.info("Submitted batch %s with %d requests", batch.id, len(shard))
+            metrics.count('batches_submitted')
+            metrics.count('batch_requests', len(shard))
+            del shard
+            submitted = time.monotonic()
+            self._wait(batch.id, stop)
+            if stop.is_set():
+                return
+            # Time the shard sat in the batch queue until it ended
+            metrics.observe('batch_queue_seconds', time.monotonic() - submitted)
+            for response in self.client.beta.messages.batches.results(batch.id):
+                unanswered.discard(response.custom_id)
+                self._put(results, response, stop)
+        except Exception as error:
+            logger.error("Batch shard failed, %d requests errored: %s", len(unanswered), error)
+            metrics.count('batch_shard_errors')
+            for custom_id in unanswered:
+                self._put(results, errored_result(custom_id, error), stop)
+        finally:
+            self._put(results, _SHARD_DONE, stop)
+
+    def stream(self, requests: Iterable[dict]) -> Iterator[Any]:
+        results: queue.Queue = queue.Queue(maxsize=self.result_buffer)
+        slots = threading.Semaphore(self.max_concurrent)
+        stop = threading.Event()
+        state = {'submitted': 0, 'finished': 0, 'all_submitted': False}
+
+        def submit_all():
+            try:
+                for shard in shard_requests(requests, self.max_requests, self.max_bytes):
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    state['submitted'] += 1
+                    threading.Thread(target=self._run_shard, args=(shard, results, stop),
+                                     name='batch-shard', daemon=True).start()
+            except Exception as error:
+                self._put(results, error, stop)
+            finally:
+                state['all_submitted'] = True
+                self._put(results, None, stop)
+
+        submitter = threading.Thread(target=submit_all, name='batch-submit', daemon=True)
+        submitter.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _SHARD_DONE:
+                    state['finished'] += 1
+                    slots.release()
+                elif isinstance(item, Exception):
+                    raise item
+                elif item is not None:
+                    yield item
+                if state['all_submitted'] and state['finished'] == state['submitted'] and results.empty():
+                    return
+        finally:
+            stop.set()
+            slots.release()
@@ -0,0 +1,208 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+from batch_scheduler import BatchScheduler
+from fakes import FakeAnthropic, FakeBatches, FakeGmailService, generate_mailbox, truth_responder
+import metrics
+from gmail_fetch import GmailFetcher
+from model import ClaudeExtractor
+from prefilter import PREFILTER_HEADERS, Prefilter
+from retry_queue import RetryQueue
+from schemas import AIEmailPayload, ExtractedFlightInfo
+from tools import extract_unstructured_html, extrace_html_from_gmail_payload, fetch_message_attachments
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """Nearest rank percentile, `q` between 0 and 100."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summarize(samples: list[float], items: int, wall_seconds: float) -> dict:
+    """Throughput over the whole stage and latency of each timed call, in milliseconds."""
+    return {
+        'calls': len(samples),
+        'items': items,
+        'seconds': round(wall_seconds, 4),
+        'items_per_second': round(items / wall_seconds, 1) if wall_seconds > 0 else None,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'max_ms': round(max(samples, default=0.0) * 1000, 3),
+    }
+
+
+def timed_calls(fn: Callable[[Any], Any], items: list) -> tuple[list, dict]:
+    outputs, samples = [], []
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        outputs.append(fn(item))
+        samples.append(time.perf_counter() - call_start)
+    return outputs, summarize(samples, len(items), time.perf_counter() - start)
+
+
+class TimedFetcher(GmailFetcher):
+    """GmailFetcher that records how long each batch round trip takes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_seconds: list[float] = []
+
+    def _run_batch(self, requests):
+        start = time.perf_counter()
+        results = super()._run_batch(requests)
+        self.batch_seconds.append(time.perf_counter() - start)
+        return results
+
+
+def run(messages: int = 2000,
+        seed: int = 0,
+        gmail_latency: float = 0.02,
+        batch_latency: float = 1.0,
+        batch_size: int = 500,
+        concurrency: int = 4) -> dict:
+    """
+    Runs every stage of an extraction over a synthetic mailbox, against the fake Gmail
+    service and the fake batch endpoint, and returns the stats of each stage. Gmail calls
+    cost `gmail_latency` seconds per batch round trip and every model batch ends
+    `batch_latency` seconds after it is created.
+    """
+    mailbox = generate_mailbox(messages, seed=seed)
+    service = FakeGmailService(mailbox, latency=gmail_latency, batch_latency=gmail_latency)
+    fetcher = TimedFetcher(service)
+    # Without credentials the fetcher runs batches one at a time, the fake needs no auth
+    fetcher.max_concurrency = concurrency
+    stages: dict[str, dict] = {}
+
+    page_seconds: list[float] = []
+    ids: list[str] = []
+    start = time.perf_counter()
+    pages = fetcher.list_pages()
+    while True:
+        page_start = time.perf_counter()
+        page = next(pages, None)
+        if page is None:
+            break
+        page_seconds.append(time.perf_counter() - page_start)
+        ids += [message['id'] for message in page]
+    stages['list'] = summarize(page_seconds, len(ids), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    metadata = list(fetcher.fetch(ids, format='metadata', metadata_headers=PREFILTER_HEADERS))
+    stages['fetch_metadata'] = summarize(fetcher.batch_seconds, len(metadata), time.perf_counter() - start)
+
+    prefilter = Prefilter.default()
+    results, stages['prefilter'] = timed_calls(prefilter.score, metadata)
+    passed = [result.msg_id for result in results if result.passed]
+
+    fetcher.batch_seconds = []
+    start = time.perf_counter()
+    full = list(fetcher.fetch(passed))
+    stages['fetch_full'] = summarize(fetcher.batch_seconds, len(full), time.perf_counter() - start)
+
+    fetcher.batch_seconds = []
+    start = time.perf_counter()
+    with_attachments = fetch_message_attachments(fetcher, full)
+    stages['fetch_attachments'] = summarize(fetcher.batch_seconds, sum(len(found) for _, found in with_attachments),
+                                            time.perf_counter() - start)
+
+    texts, stages['extract_unstructured_html'] = timed_calls(
+        lambda message: extract_unstructured_html(extrace_html_from_gmail_payload(None, message, message['id'])), full)
+    payloads = [AIEmailPayload(text_context={'name': "Shrey Patel", 'html_text': text}, attachments=found or None,
+                               id=message['id'])
+                for (message, found), text in zip(with_attachments, texts)]
+
+    batches = FakeBatches(latency=batch_latency, respond=truth_responder(mailbox))
+    extractor = ClaudeExtractor(schema_class=ExtractedFlightInfo, api_key='bench', retry_queue=RetryQueue(':memory:'))
+    extractor.client = FakeAnthropic(batches)
+    extractor.scheduler = BatchScheduler(extractor.client, max_requests=batch_size, max_concurrent=concurrency,
+                                         min_poll=min(0.5, batch_latency / 4 or 0.01), max_poll=batch_latency or 0.01)
+    requests, stages['build_request'] = timed_calls(extractor.build_params, payloads)
+    responses = [batches.respond(params) for params in requests]
+    _, stages['parse_response'] = timed_calls(extractor.parse_response, responses)
+
+    result_seconds: list[float] = []
+    correct = 0
+    start = time.perf_counter()
+    for payload, result in extractor.extract_iter(payloads):
+        result_seconds.append(time.perf_counter() - start)
+        correct += result == mailbox.truth[payload.id]
+    stages['batch_extract'] = summarize(result_seconds, len(result_seconds), time.perf_counter() - start)
+
+    return {
+        'messages': messages,
+        'passed_prefilter': len(passed),
+        'correct_extractions': correct,
+        'gmail_calls': service.calls,
+        'model_batches': batches.created,
+        'stages': stages,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Ratio of each stage's throughput and latencies to a baseline report, above 1 is faster."""
+    ratios = {}
+    for stage, stats in report['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old is None:
+            continue
+        ratios[stage] = {
+            'throughput': round(stats['items_per_second'] / old['items_per_second'], 3)
+                          if stats['items_per_second'] and old['items_per_second'] else None,
+            'p50': round(old['p50_ms'] / stats['p50_ms'], 3) if stats['p50_ms'] else None,
+            'p99': round(old['p99_ms'] / stats['p99_ms'], 3) if stats['p99_ms'] else None,
+        }
+    return ratios
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks every extraction stage against fake Gmail and batch APIs")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gmail-latency", type=float, default=0.02, help="seconds per Gmail round trip")
+    parser.add_argument("--batch-latency", type=float, default=1.0, help="seconds until a model batch ends")
+    parser.add_argument("--batch-size", type=int, default=500, help="requests per model batch")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--metrics", help="also record the instrumentation metrics to this file")
+    parser.add_argument("--profile", help="sample stacks during the run and write them here in collapsed format")
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'metrics', 'profile')},
+        'instrumented': bool(args.metrics or args.profile),
+    }
+    with metrics.recording(args.metrics, args.profile):
+        report.update(run(args.messages, args.seed, args.gmail_latency, args.batch_latency, args.batch_size,
+                          args.concurrency))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['compared_to'] = compare(report, json.load(baseline_file))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,63 @@
+import argparse
+import itertools
+import os
+import time
+
+import html_text
+from tools import extract_unstructured_html_bs4
+
+
+def load_corpus(directory: str) -> list[tuple[str, str]]:
+    corpus = []
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            path = os.path.join(root, filename)
+            with open(file=path, mode='r') as html_file:
+                corpus.append((path, html_file.read()))
+    return corpus
+
+
+def timed(engine, corpus: list[tuple[str, str]], repeat: int) -> tuple[float, list[str]]:
+    best = float('inf')
+    outputs: list[str] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [engine(raw_html) for _, raw_html in corpus]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the lxml HTML to text engine against the BeautifulSoup one")
+    parser.add_argument("directory", nargs="?", default="./data")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.directory)
+    if not corpus:
+        raise SystemExit(f"No files in {args.directory}")
+    total_bytes = sum(len(raw_html) for _, raw_html in corpus)
+    print(f"{len(corpus)} files, {total_bytes / 1024 / 1024:.1f} MiB")
+
+    legacy_time, legacy_outputs = timed(extract_unstructured_html_bs4, corpus, args.repeat)
+    fast_time, fast_outputs = timed(html_text.html_to_text, corpus, args.repeat)
+
+    mismatches = [(path, legacy, fast) for (path, _), legacy, fast in zip(corpus, legacy_outputs, fast_outputs)
+                  if legacy != fast]
+    for path, legacy, fast in mismatches:
+        # First line the engines disagree on, see html_to_text for the known differences
+        line, (legacy_line, fast_line) = next((i, pair) for i, pair in
+                                              enumerate(itertools.zip_longest(legacy.splitlines(), fast.splitlines()))
+                                              if pair[0] != pair[1])
+        print(f"Mismatch: {path} line {line + 1}: bs4 {legacy_line!r}, lxml {fast_line!r}")
+
+    start = time.perf_counter()
+    for _ in html_text.extract_directory(args.directory, processes=args.processes):
+        pass
+    bulk_time = time.perf_counter() - start
+
+    print(f"bs4:          {legacy_time:.3f}s ({len(corpus) / legacy_time:.0f} files/s)")
+    print(f"lxml:         {fast_time:.3f}s ({len(corpus) / fast_time:.0f} files/s, {legacy_time / fast_time:.1f}x)")
+    print(f"lxml bulk:    {bulk_time:.3f}s ({len(corpus) / bulk_time:.0f} files/s, {legacy_time / bulk_time:.1f}x)")
+    print(f"Equivalent:   {len(corpus) - len(mismatches)}/{len(corpus)}")
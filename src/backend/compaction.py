@@ -0,0 +1,287 @@
+import argparse
+import hashlib
+import logging
+import sqlite3
+import threading
+from email.utils import parseaddr
+from typing import Iterable, NamedTuple
+
+from prefilter import Prefilter
+from schemas import AIEmailPayload
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BOILERPLATE_DB = "boilerplate.db"
+
+# Same rough estimate the real time rate limiter uses
+CHARS_PER_TOKEN = 4
+DEFAULT_TOKEN_BUDGET = 1500
+# Lines kept on each side of a line with a hit, labels like "Departure" sit next to the values
+DEFAULT_WINDOW = 2
+# A lone three letter capital word scores 0.25, it needs company to count as a hit
+MIN_LINE_SCORE = 0.5
+# A line seen in this many earlier emails from the same domain is boilerplate
+MIN_REPEATS = 3
+# Lines still seen only once after this many more emails from their domain are forgotten
+PRUNE_AFTER = 200
+ELISION = "[...]"
+
+
+def sender_domain(sender: str | None) -> str | None:
+    """Lowercased domain of a From header or address, None when there is none."""
+    if not sender:
+        return None
+    address = parseaddr(sender)[1]
+    if '@' not in address:
+        return None
+    return address.rsplit('@', 1)[1].lower()
+
+
+def message_sender(message: dict) -> str | None:
+    """From header of a Gmail message in metadata or full format."""
+    for header in message.get('payload', {}).get('headers', []):
+        if header['name'].lower() == 'from':
+            return header['value']
+    return None
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def _line_hash(line: str) -> int:
+    normalized = ' '.join(line.lower().split())
+    return int.from_bytes(hashlib.blake2b(normalized.encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+class BoilerplateStore:
+    """
+    Per sender domain counts of how many emails each line has appeared in, kept in SQLite as
+    64 bit line hashes. Lines repeated across emails from the same domain are footers, legal
+    text and marketing copy that every email from that sender carries.
+    """
+
+    def __init__(self, path: str = DEFAULT_BOILERPLATE_DB, min_repeats: int = MIN_REPEATS, prune_after: int = PRUNE_AFTER):
+        self.min_repeats = min_repeats
+        self.prune_after = prune_after
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS domains (
+                domain TEXT PRIMARY KEY,
+                emails INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS seen (
+                domain TEXT NOT NULL,
+                email_id TEXT NOT NULL,
+                PRIMARY KEY (domain, email_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS lines (
+                domain TEXT NOT NULL,
+                line_hash INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                first_seen INTEGER NOT NULL,
+                PRIMARY KEY (domain, line_hash)
+            ) WITHOUT ROWID;
+        """)
+
+    def boilerplate(self, domain: str, hashes: Iterable[int]) -> set[int]:
+        """The hashes among `hashes` that are boilerplate for the domain."""
+        hashes = list(set(hashes))
+        found: set[int] = set()
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f"SELECT line_hash FROM lines WHERE domain = ? AND count >= ? "
+                                         f"AND line_hash IN ({placeholders})", [domain, self.min_repeats, *chunk])
+                found.update(row[0] for row in rows)
+        return found
+
+    def observe(self, domain: str, email_id: str, hashes: Iterable[int]):
+        """Counts the lines of one email, an email already counted is ignored."""
+        with self._lock, self.conn:
+            if self.conn.execute("INSERT OR IGNORE INTO seen (domain, email_id) VALUES (?, ?)", (domain, email_id)).rowcount == 0:
+                return
+            self.conn.execute("INSERT INTO domains (domain, emails) VALUES (?, 1) "
+                              "ON CONFLICT(domain) DO UPDATE SET emails = emails + 1", (domain,))
+            emails = self.conn.execute("SELECT emails FROM domains WHERE domain = ?", (domain,)).fetchone()[0]
+            self.conn.executemany("INSERT INTO lines (domain, line_hash, count, first_seen) VALUES (?, ?, 1, ?) "
+                                  "ON CONFLICT(domain, line_hash) DO UPDATE SET count = count + 1",
+                                  ((domain, line_hash, emails) for line_hash in set(hashes)))
+            if emails % self.prune_after == 0:
+                # Most lines are unique to one email, drop the ones that never came back
+                self.conn.execute("DELETE FROM lines WHERE domain = ? AND count = 1 AND first_seen <= ?",
+                                  (domain, emails - self.prune_after))
+
+    def close(self):
+        self.conn.close()
+
+
+class CompactionResult(NamedTuple):
+    text: str
+    original_tokens: int
+    tokens: int
+    boilerplate_lines: int
+
+
+class Compactor:
+    """
+    Shrinks email text before it goes to the model.
+
+    Lines that repeat across emails from the same sender domain are dropped. Of what is
+    left, only windows of `window` lines around lines with flight keyword, flight number,
+    time or airport code hits are kept, highest scoring windows first until
+    `token_budget` is used up, and put back in their original order. Emails without a
+    single hit keep their non boilerplate text, cut to the budget.
+    """
+
+    def __init__(self,
+                 store: BoilerplateStore | None = None,
+                 prefilter: Prefilter | None = None,
+                 token_budget: int = DEFAULT_TOKEN_BUDGET,
+                 window: int = DEFAULT_WINDOW,
+                 min_line_score: float = MIN_LINE_SCORE):
+        self.store = store or BoilerplateStore()
+        self.prefilter = prefilter or Prefilter.default()
+        self.token_budget = token_budget
+        self.window = window
+        self.min_line_score = min_line_score
+
+    def compact(self, text: str, sender: str | None = None, email_id: str | None = None) -> CompactionResult:
+        lines = text.splitlines()
+        original_tokens = estimate_tokens(text)
+
+        boilerplate = [False] * len(lines)
+        domain = sender_domain(sender)
+        if domain is not None:
+            hashes = [_line_hash(line) for line in lines]
+            repeated = self.store.boilerplate(domain, hashes)
+            boilerplate = [line_hash in repeated for line_hash in hashes]
+            if email_id is not None:
+                self.store.observe(domain, email_id, hashes)
+
+        scores = []
+        for i, line in enumerate(lines):
+            score, line_hits = self.prefilter.score_text(line)
+            # A repeated line that holds a flight number, time or code is the same trip booked
+            # again rather than boilerplate, only repeated keywords and prose are dropped
+            if boilerplate[i] and not any(name in line_hits for name in self.prefilter.pattern_names):
+                score = 0.0
+            else:
+                boilerplate[i] = False
+            scores.append(score)
+        hits = [i for i, score in enumerate(scores) if score >= self.min_line_score]
+        hit_lines = set(hits)
+        if not hits:
+            kept = [line for i, line in enumerate(lines) if not boilerplate[i]]
+            compacted = self._truncate('\n'.join(kept))
+            return CompactionResult(compacted, original_tokens, estimate_tokens(compacted), sum(boilerplate))
+
+        # Merge overlapping windows into segments, each scored by the hits inside it
+        segments: list[list] = []
+        for i in hits:
+            start, end = max(0, i - self.window), min(len(lines), i + self.window + 1)
+            if segments and start <= segments[-1][1]:
+                segments[-1][1] = max(segments[-1][1], end)
+                segments[-1][2] += scores[i]
+            else:
+                segments.append([start, end, scores[i]])
+
+        chosen: list[tuple[int, str]] = []
+        used = 0
+        for start, end, _ in sorted(segments, key=lambda segment: -segment[2]):
+            # Boilerplate inside a window stays only when it is right next to a hit, as a label
+            segment_text = '\n'.join(line for i, line in enumerate(lines[start:end], start)
+                                     if not boilerplate[i] or i - 1 in hit_lines or i + 1 in hit_lines)
+            cost = estimate_tokens(segment_text) + 1
+            if used + cost > self.token_budget:
+                if not chosen:
+                    chosen.append((start, self._truncate(segment_text)))
+                continue
+            chosen.append((start, segment_text))
+            used += cost
+
+        chosen.sort()
+        compacted = f'\n{ELISION}\n'.join(segment_text for _, segment_text in chosen)
+        return CompactionResult(compacted, original_tokens, estimate_tokens(compacted), sum(boilerplate))
+
+    def _truncate(self, text: str) -> str:
+        limit = self.token_budget * CHARS_PER_TOKEN
+        if len(text) <= limit:
+            return text
+        return text[:limit].rsplit('\n', 1)[0]
+
+    def compact_payload(self, payload: AIEmailPayload) -> AIEmailPayload:
+        """Copy of the payload with its html_text compacted."""
+        result = self.compact(payload.text_context['html_text'], sender=payload.sender, email_id=payload.id)
+        return AIEmailPayload(text_context={**payload.text_context, 'html_text': result.text},
+                              attachments=payload.attachments,
+                              id=payload.id,
+                              sender=payload.sender,
+                              prefilter_score=payload.prefilter_score,
+                              original_text=payload.original_text or payload.text_context['html_text'])
+
+
+def recall_check(extractor, payloads: list[AIEmailPayload], compactor: Compactor) -> dict:
+    """
+    Runs the extractor on the full and the compacted text of each payload and reports how
+    many of the fields found in the full text are still found, with the same value, in the
+    compacted text, along with the input tokens saved.
+    """
+    compacted = [compactor.compact_payload(payload) for payload in payloads]
+    full_results = extractor.extract(payloads)
+    compact_results = extractor.extract(compacted)
+
+    fields = extractor.SCHEMA_PROMPT.model_fields
+    expected = matched = 0
+    lost: list[tuple[str, str]] = []
+    for payload, full, compact in zip(payloads, full_results, compact_results):
+        if full is None:
+            continue
+        for field in fields:
+            value = getattr(full, field)
+            if value is None:
+                continue
+            expected += 1
+            if compact is not None and getattr(compact, field) == value:
+                matched += 1
+            else:
+                lost.append((payload.id, field))
+
+    original_tokens = sum(estimate_tokens(payload.text_context['html_text']) for payload in payloads)
+    compact_tokens = sum(estimate_tokens(payload.text_context['html_text']) for payload in compacted)
+    return {
+        'payloads': len(payloads),
+        'field_recall': matched / expected if expected else 1.0,
+        'fields_expected': expected,
+        'fields_lost': lost,
+        'original_tokens': original_tokens,
+        'compacted_tokens': compact_tokens,
+        'token_reduction': 1 - compact_tokens / original_tokens if original_tokens else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    from model import ClaudeExtractor
+    from schemas import ExtractedFlightInfo
+    from tools import load_payloads
+
+    parser = argparse.ArgumentParser(description="Compares extraction on compacted and full email text")
+    parser.add_argument("--store", help="read messages from a message store directory instead of ./data")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--budget", type=int, default=DEFAULT_TOKEN_BUDGET)
+    parser.add_argument("--db", default=DEFAULT_BOILERPLATE_DB)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.store, args.limit)
+    compactor = Compactor(BoilerplateStore(args.db), token_budget=args.budget)
+    report = recall_check(ClaudeExtractor(schema_class=ExtractedFlightInfo), payloads, compactor)
+    print(f"Payloads:        {report['payloads']}")
+    print(f"Field recall:    {report['field_recall']:.3f} ({report['fields_expected']} fields)")
+    print(f"Input tokens:    {report['original_tokens']} -> {report['compacted_tokens']} "
+          f"({report['token_reduction']:.1%} fewer)")
+    for payload_id, field in report['fields_lost']:
+        print(f"Lost {field} in {payload_id}")
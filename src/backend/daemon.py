@@ -0,0 +1,362 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from typing import Any, Callable
+
+# Only the standard library is imported up front, so the client starts in milliseconds and
+# the daemon has its socket open before the heavy modules load. Those are imported by
+# WarmState the first time a part that needs them is built.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "daemon.sock"
+# Requests and responses are single JSON lines
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+
+class WarmState:
+    """
+    Everything a run builds before touching its first email: the Gmail service and its
+    authorized https, the Anthropic clients and their connection pools, the compiled
+    prompts, the airline index, the prefilter automaton, the parser process pool and the
+    SQLite stores. Each part is built on first use and kept for the life of the daemon.
+    """
+
+    def __init__(self, output_dir: str = './outputs', name: str = "Shrey Patel", audit_rate: float = 0.0):
+        self.output_dir = output_dir
+        self.name = name
+        self.audit_rate = audit_rate
+        self.load_seconds: dict[str, float] = {}
+        self._parts: dict[str, Any] = {}
+        # Parts build on each other, so one reentrant lock covers all of them
+        self._lock = threading.RLock()
+
+    def _get(self, part: str, build: Callable[[], Any]) -> Any:
+        with self._lock:
+            if part not in self._parts:
+                start = time.perf_counter()
+                self._parts[part] = build()
+                self.load_seconds[part] = round(time.perf_counter() - start, 3)
+                logger.info("Loaded %s in %.2fs", part, self.load_seconds[part])
+            return self._parts[part]
+
+    @property
+    def cpu_pool(self):
+        def build():
+            from concurrent.futures import ProcessPoolExecutor
+            import tools
+            pool = ProcessPoolExecutor()
+            # Starts the workers and has them import the HTML parser now instead of on the first email
+            pool.submit(tools.extract_unstructured_html, '<p></p>').result()
+            return pool
+        return self._get('cpu_pool', build)
+
+    @property
+    def pdf_preprocessor(self):
+        def build():
+            from pdf_text import PdfPreprocessor
+            return PdfPreprocessor(self.cpu_pool)
+        return self._get('pdf_preprocessor', build)
+
+    @property
+    def compactor(self):
+        def build():
+            from compaction import BoilerplateStore, Compactor
+            return Compactor(BoilerplateStore())
+        return self._get('compactor', build)
+
+    @property
+    def prefilter(self):
+        def build():
+            from prefilter import Prefilter
+            return Prefilter.default()
+        return self._get('prefilter', build)
+
+    @property
+    def duplicates(self):
+        def build():
+            from dedupe import DuplicateIndex
+            return DuplicateIndex()
+        return self._get('duplicates', build)
+
+    @property
+    def results(self):
+        def build():
+            from results_store import ResultStore
+            return ResultStore()
+        return self._get('results', build)
+
+    @property
+    def extractors(self):
+        """The wiring.ExtractorChain every entry point runs."""
+        def build():
+            from wiring import build_extractors
+            return build_extractors(self.duplicates, audit_rate=self.audit_rate)
+        return self._get('extractors', build)
+
+    @property
+    def gmail(self) -> dict:
+        def build():
+            from googleapiclient.discovery import build as build_service
+            from gmail_fetch import GmailFetcher
+            from message_store import MessageStore
+            from script import get_credentials
+            from sync import SyncCheckpointStore
+            creds = get_credentials()
+            fetcher = GmailFetcher(build_service("gmail", "v1", credentials=creds), credentials=creds)
+            profile = fetcher.execute(fetcher.service.users().getProfile(userId=fetcher.user_id))
+            return {'fetcher': fetcher, 'mailbox': profile['emailAddress'], 'checkpoints': SyncCheckpointStore(),
+                    'store': MessageStore()}
+        return self._get('gmail', build)
+
+    def warm(self, gmail: bool = True):
+        """Builds every part now rather than on the first job."""
+        parts = ['cpu_pool', 'pdf_preprocessor', 'compactor', 'prefilter', 'duplicates', 'results', 'extractors']
+        for part in parts + (['gmail'] if gmail else []):
+            try:
+                getattr(self, part)
+            except Exception:
+                logger.exception("Could not load %s, it is retried on first use", part)
+
+    def loaded(self) -> list[str]:
+        # Not under the lock, status should answer while a part is still loading
+        return list(self._parts)
+
+    def routes(self) -> dict | None:
+        """Per route model use since the daemon started, None before the extractors are loaded."""
+        extractors = self._parts.get('extractors')
+        return extractors.router.report() if extractors is not None else None
+
+    def close(self):
+        with self._lock:
+            if 'cpu_pool' in self._parts:
+                self._parts['cpu_pool'].shutdown()
+            if 'compactor' in self._parts:
+                self._parts['compactor'].store.close()
+            if 'extractors' in self._parts:
+                self._parts['extractors'].close()
+            for part in ('duplicates', 'results'):
+                if part in self._parts:
+                    self._parts[part].close()
+            if 'gmail' in self._parts:
+                self._parts['gmail']['checkpoints'].close()
+                self._parts['gmail']['store'].close()
+
+
+def _stage_report(stats: list[dict]) -> list[dict]:
+    return [{key: stage[key] for key in ('stage', 'received', 'emitted', 'errors', 'per_second')} for stage in stats]
+
+
+class Jobs:
+    """The jobs the daemon runs, each one taking the request's JSON fields as arguments."""
+
+    def __init__(self, state: WarmState):
+        self.state = state
+        self.started = time.time()
+        self.counts: dict[str, int] = {}
+        # One mailbox sync at a time, two would race on the history checkpoint
+        self._sync_lock = threading.Lock()
+
+    def extract(self, paths: list[str]) -> dict:
+        """Extracts flights from HTML email files, like app.py over ./data."""
+        import pathlib
+        import app
+        state = self.state
+        extractors = state.extractors
+        output_dir = pathlib.Path(state.output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        missing = [path for path in paths if not os.path.isfile(path)]
+        if missing:
+            raise ValueError(f"No such file: {', '.join(missing)}")
+        pipeline = app.build_pipeline(paths, extractors.extractor, state.cpu_pool, state.pdf_preprocessor,
+                                      state.compactor, state.duplicates, state.results, output_dir, name=state.name)
+        stats = pipeline.run()
+        flights = {os.path.basename(path): state.results.get(os.path.basename(path)) for path in paths}
+        return {'stages': _stage_report(stats), 'flights': flights}
+
+    def sync(self, full: bool = False) -> dict:
+        """Extracts flights from mail that arrived since the last sync, like script.py."""
+        import pathlib
+        import script
+        from sync import MailboxSync
+        state = self.state
+        gmail = state.gmail
+        extractors = state.extractors
+        output_dir = pathlib.Path(state.output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with self._sync_lock:
+            sync = MailboxSync(gmail['fetcher'], gmail['checkpoints'], mailbox=gmail['mailbox'])
+            if full:
+                gmail['checkpoints'].clear(sync.mailbox)
+            pipeline = script.build_pipeline(gmail['fetcher'], sync, gmail['store'], state.prefilter,
+                                             extractors.extractor, state.cpu_pool, state.pdf_preprocessor,
+                                             state.compactor, output_dir, state.name, state.results, state.duplicates)
+            stats = pipeline.run()
+            committed = sync.commit()
+        return {'stages': _stage_report(stats), 'new_messages': stats[0]['emitted'], 'full_scan': sync.full_scan,
+                'committed': committed, 'unfinished': sync.unfinished}
+
+    def retry(self) -> dict:
+        """Resubmits the requests in the retry queue."""
+        import pathlib
+        from tools import save_extraction
+        state = self.state
+        router = state.extractors.router
+        output_dir = pathlib.Path(state.output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        recovered = 0
+        for payload, schema in router.retry_pending():
+            if not router.failed(payload):
+                save_extraction(output_dir, payload, schema)
+                state.results.upsert(payload.id, schema)
+                recovered += 1
+        return {'recovered': recovered, 'retry_queue': state.extractors.retry_queue.report()}
+
+    def status(self) -> dict:
+        return {'pid': os.getpid(),
+                'uptime_seconds': round(time.time() - self.started),
+                'loaded': self.state.loaded(),
+                'load_seconds': self.state.load_seconds,
+                'jobs': self.counts,
+                'routes': self.state.routes()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: 'DaemonServer'
+
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_BYTES)
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+            op = request.pop('op')
+            response = {'ok': True, 'result': self.server.dispatch(op, request)}
+        except Exception as error:
+            logger.exception("Job failed")
+            response = {'ok': False, 'error': f"{type(error).__name__}: {error}"}
+        response['seconds'] = round(time.perf_counter() - start, 3)
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server running jobs against one WarmState, a thread per connection. A
+    request is one JSON line with an `op` and its arguments, the reply one JSON line with
+    `ok` and the `result` or `error`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, state: WarmState):
+        self.state = state
+        self.jobs = Jobs(state)
+        self.ops: dict[str, Callable[..., Any]] = {
+            'extract': self.jobs.extract,
+            'sync': self.jobs.sync,
+            'retry': self.jobs.retry,
+            'status': self.jobs.status,
+            'stop': self.stop,
+        }
+        super().__init__(path, _Handler)
+
+    def dispatch(self, op: str, arguments: dict) -> Any:
+        if op not in self.ops:
+            raise ValueError(f"Unknown op {op!r}, expected one of {', '.join(self.ops)}")
+        import metrics
+        self.jobs.counts[op] = self.jobs.counts.get(op, 0) + 1
+        with metrics.timer('daemon_job_seconds', op=op):
+            return self.ops[op](**arguments)
+
+    def stop(self) -> dict:
+        # shutdown waits for serve_forever, which is waiting for this request to finish
+        threading.Thread(target=self.shutdown, daemon=True).start()
+        return {'stopping': os.getpid()}
+
+
+def _claim_socket(path: str):
+    """Removes a socket file left by a daemon that is gone, refuses to start over a live one."""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise SystemExit(f"A daemon is already listening on {path}")
+
+
+def serve(path: str = DEFAULT_SOCKET, warm: bool = True, gmail: bool = True, name: str = "Shrey Patel",
+          audit_rate: float = 0.0):
+    _claim_socket(path)
+    state = WarmState(name=name, audit_rate=audit_rate)
+    server = DaemonServer(path, state)
+    os.chmod(path, 0o600)
+    logger.info("Listening on %s", path)
+    if warm:
+        # The socket is already open, jobs that come in meanwhile wait for the parts they need
+        threading.Thread(target=state.warm, args=(gmail,), name='warm-up', daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        state.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def request(op: str, path: str = DEFAULT_SOCKET, **arguments) -> dict:
+    """Sends one job to the daemon and waits for its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps({'op': op, **arguments}).encode() + b'\n')
+        with client.makefile('rb') as reply:
+            return json.loads(reply.readline())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm extraction daemon and its client")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the daemon in the foreground")
+    serve_parser.add_argument("--lazy", action="store_true", help="load each part on first use instead of at start")
+    serve_parser.add_argument("--no-gmail", action="store_true", help="do not log in to Gmail until a sync job")
+    serve_parser.add_argument("--name", default="Shrey Patel", help="mailbox owner's name given to the model")
+    serve_parser.add_argument("--audit-rate", type=float, default=0.0,
+                              help="share of cheaper route results also sent to the strongest model to check them")
+    extract_parser = commands.add_parser("extract", help="extract flights from HTML email files")
+    extract_parser.add_argument("paths", nargs="+")
+    sync_parser = commands.add_parser("sync", help="extract flights from new Gmail messages")
+    sync_parser.add_argument("--full", action="store_true", help="ignore the history checkpoint and rescan the whole inbox")
+    commands.add_parser("retry", help="resubmit the requests in the retry queue")
+    commands.add_parser("status")
+    commands.add_parser("stop")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        logging.basicConfig(level=logging.INFO)
+        serve(args.socket, warm=not args.lazy, gmail=not args.no_gmail, name=args.name, audit_rate=args.audit_rate)
+        raise SystemExit
+
+    arguments: dict = {}
+    if args.command == "extract":
+        arguments['paths'] = [os.path.abspath(path) for path in args.paths]
+    elif args.command == "sync":
+        arguments['full'] = args.full
+    try:
+        reply = request(args.command, args.socket, **arguments)
+    except (ConnectionRefusedError, FileNotFoundError):
+        raise SystemExit(f"No daemon on {args.socket}, start one with: python daemon.py serve")
+    json.dump(reply, sys.stdout, indent=2)
+    print()
+    raise SystemExit(0 if reply['ok'] else 1)
@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, NamedTuple
+
+import metrics
+from airline_index import AirlineIndex
+from compaction import sender_domain
+from extraction_cache import prompt_fingerprint
+from model import Extractor, ExtractorSchemaT
+from rules import BOOKING_REFERENCE_RE, DATE_PATTERNS, find_flight_numbers, parse_date
+from schemas import AIEmailPayload
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEDUPE_DB = "dedupe.db"
+SIGNATURE_BITS = 64
+# Word n-grams hashed into the signature
+SHINGLE_WORDS = 3
+# Emails whose signatures differ in at most this many bits are near duplicates. The
+# signature is split into one more block than that, so two such signatures share at
+# least one block exactly and only emails in the same buckets are ever compared
+MAX_DISTANCE = 3
+BLOCKS = MAX_DISTANCE + 1
+BLOCK_BITS = SIGNATURE_BITS // BLOCKS
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+WORD_RE = re.compile(r'\w+')
+
+
+class EmailSignature(NamedTuple):
+    simhash: int
+    # Mailbox owner the email was read for, emails of one booking in two people's mailboxes
+    # name different passengers
+    owner: str | None
+    domain: str | None
+    booking_references: frozenset[str]
+    flight_numbers: frozenset[str]
+    dates: frozenset[str]
+    attachments: frozenset[str]
+
+    def booking_key(self) -> str | None:
+        """Same sender, booking and flights. Only set when the email names both."""
+        if not self.booking_references or not self.flight_numbers:
+            return None
+        return '|'.join([self.owner or '', self.domain or '', ','.join(sorted(self.booking_references)), ','.join(sorted(self.flight_numbers))])
+
+
+def simhash(text: str, words: int = SHINGLE_WORDS) -> int:
+    """64 bit SimHash of the set of word n-grams of `text`, lowercased."""
+    tokens = WORD_RE.findall(text.lower())
+    shingles = {' '.join(tokens[i:i + words]) for i in range(max(1, len(tokens) - words + 1))}
+    if not shingles:
+        return 0
+    hashes = [format(int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'big'), '064b')
+              for shingle in shingles]
+    # Reading the bit strings column by column counts the hashes with each bit set in one pass
+    half = len(hashes) / 2
+    signature = 0
+    for column in zip(*hashes):
+        signature = (signature << 1) | (column.count('1') > half)
+    return signature
+
+
+def _signed(value: int) -> int:
+    # SQLite integers are signed 64 bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _buckets(signature: 'EmailSignature') -> list[tuple]:
+    # Near duplicates must also name the same flights, so those go into the bucket key and
+    # the many emails one airline sends from the same template do not end up in one bucket
+    entities = signature[1:]
+    return [(i, (signature.simhash >> (i * BLOCK_BITS)) & BLOCK_MASK, entities) for i in range(BLOCKS)]
+
+
+class DuplicateIndex:
+    """
+    Clusters emails that carry the same flight: near identical text (SimHash within
+    MAX_DISTANCE bits) with the same flight numbers, booking references, dates and
+    attachments, or the same sender, booking reference and flight numbers where one
+    email's dates are a subset of the other's, like a check-in reminder for a confirmed
+    booking. A schedule change brings a new date and starts a cluster of its own.
+
+    Signatures live in SQLite and in memory, bucketed by signature block and flights and
+    by booking key, so each new email is matched with a handful of dict lookups and inserted in
+    place. Each cluster keeps the extraction result of its first email.
+    """
+
+    def __init__(self, path: str = DEFAULT_DEDUPE_DB, airlines: AirlineIndex | None = None):
+        self.airlines = airlines or AirlineIndex.default()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS emails (
+                payload_id TEXT PRIMARY KEY,
+                cluster_id TEXT NOT NULL,
+                simhash INTEGER NOT NULL,
+                signature TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS clusters (
+                cluster_id TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                result TEXT,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        self._signatures: dict[str, EmailSignature] = {}
+        self._clusters: dict[str, str] = {}
+        self._buckets: dict[tuple, list[str]] = {}
+        self._booking_keys: dict[str, list[str]] = {}
+        for payload_id, cluster_id, signed, signature in self.conn.execute(
+                "SELECT payload_id, cluster_id, simhash, signature FROM emails"):
+            fields = json.loads(signature)
+            self._insert(payload_id, cluster_id, EmailSignature(signed & ((1 << 64) - 1), fields.get('owner'),
+                                                                fields['domain'],
+                                                                *(frozenset(fields[key]) for key in
+                                                                  ('booking_references', 'flight_numbers', 'dates',
+                                                                   'attachments'))))
+
+    def signature(self, payload: AIEmailPayload) -> EmailSignature:
+        text = payload.key_context().get('html_text') or ''
+        dates = set()
+        for pattern, _ in DATE_PATTERNS:
+            for match in pattern.finditer(text):
+                date = parse_date(match)
+                if date is not None:
+                    dates.add(date.isoformat())
+        return EmailSignature(simhash=simhash(text),
+                              owner=payload.text_context.get('name'),
+                              domain=sender_domain(payload.sender),
+                              booking_references=frozenset(match.group(1) or match.group()
+                                                           for match in BOOKING_REFERENCE_RE.finditer(text)),
+                              flight_numbers=frozenset(number for _, number in find_flight_numbers(text, self.airlines)),
+                              dates=frozenset(dates),
+                              attachments=frozenset(attachment.sha256 for attachment in payload.attachments or []))
+
+    def _insert(self, payload_id: str, cluster_id: str, signature: EmailSignature):
+        self._signatures[payload_id] = signature
+        self._clusters[payload_id] = cluster_id
+        for bucket in _buckets(signature):
+            self._buckets.setdefault(bucket, []).append(payload_id)
+        key = signature.booking_key()
+        if key is not None:
+            self._booking_keys.setdefault(key, []).append(payload_id)
+
+    def _match(self, signature: EmailSignature) -> str | None:
+        key = signature.booking_key()
+        for other_id in self._booking_keys.get(key, []) if key is not None else []:
+            other = self._signatures[other_id]
+            if signature.dates <= other.dates or other.dates <= signature.dates:
+                return self._clusters[other_id]
+        seen = set()
+        for bucket in _buckets(signature):
+            for other_id in self._buckets.get(bucket, []):
+                if other_id in seen:
+                    continue
+                seen.add(other_id)
+                if (signature.simhash ^ self._signatures[other_id].simhash).bit_count() <= MAX_DISTANCE:
+                    return self._clusters[other_id]
+        return None
+
+    def cluster_of(self, payload_id: str) -> str | None:
+        return self._clusters.get(payload_id)
+
+    def add(self, payload: AIEmailPayload) -> str:
+        """Indexes the email and returns the id of its cluster, its own id if it starts one."""
+        if payload.id in self._clusters:
+            return self._clusters[payload.id]
+        signature = self.signature(payload)
+        with self._lock:
+            with metrics.timer('dedupe_match_seconds'):
+                cluster_id = self._match(signature) or payload.id
+            self._insert(payload.id, cluster_id, signature)
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO emails (payload_id, cluster_id, simhash, signature) "
+                                  "VALUES (?, ?, ?, ?)",
+                                  (payload.id, cluster_id, _signed(signature.simhash),
+                                   json.dumps({'owner': signature.owner,
+                                               'domain': signature.domain,
+                                               'booking_references': sorted(signature.booking_references),
+                                               'flight_numbers': sorted(signature.flight_numbers),
+                                               'dates': sorted(signature.dates),
+                                               'attachments': sorted(signature.attachments)})))
+        metrics.count('dedupe_emails', duplicate=cluster_id != payload.id)
+        return cluster_id
+
+    def add_payload(self, payload: AIEmailPayload) -> AIEmailPayload:
+        """Pipeline stage form of `add`, passes the payload on."""
+        self.add(payload)
+        return payload
+
+    def result(self, cluster_id: str, fingerprint: str) -> tuple[bool, str | None]:
+        """(found, JSON result or None for an empty extraction) of a cluster, made with this prompt."""
+        with self._lock:
+            row = self.conn.execute("SELECT result FROM clusters WHERE cluster_id = ? AND fingerprint = ?",
+                                    (cluster_id, fingerprint)).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def set_result(self, cluster_id: str, fingerprint: str, result: str | None):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO clusters (cluster_id, fingerprint, result, updated) "
+                              "VALUES (?, ?, ?, ?)", (cluster_id, fingerprint, result, time.time()))
+
+    def report(self) -> dict:
+        with self._lock:
+            clusters = len(set(self._clusters.values()))
+            return {'emails': len(self._clusters), 'clusters': clusters, 'duplicates': len(self._clusters) - clusters}
+
+    def close(self):
+        self.conn.close()
+
+
+class DedupingExtractor(Extractor[ExtractorSchemaT]):
+    """
+    Extractor that sends only one email of each DuplicateIndex cluster to the wrapped
+    extractor and answers the rest of the cluster with its result.
+
+    Duplicates of an email that is being extracted in the same call wait for its result.
+    If that extraction fails they are clustered again and one of them is sent in its place,
+    so the failure is retried for one of them rather than copied to all.
+    """
+
+    def __init__(self, extractor: Extractor[ExtractorSchemaT], index: DuplicateIndex | None = None):
+        super().__init__(schema_class=extractor.SCHEMA_PROMPT)
+        self.extractor = extractor
+        self.model_name = extractor.model_name
+        self.index = index or DuplicateIndex()
+        self.fingerprint = prompt_fingerprint(extractor)
+        self.shared = 0
+
+    def _load(self, result: str | None) -> ExtractorSchemaT | None:
+        return None if result is None else self.SCHEMA_PROMPT.model_validate_json(result)
+
+    def _extract(self,
+                 sends: list[AIEmailPayload],
+                 held: dict[str, list[AIEmailPayload]]
+                 ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        orphans: list[AIEmailPayload] = []
+        for payload, result in self.extractor.extract_iter(sends):
+            yield payload, result
+            cluster_id = self.index.cluster_of(payload.id) or payload.id
+            waiting = held.pop(cluster_id, [])
+            if self.extractor.failed(payload):
+                orphans += waiting
+                continue
+            self.index.set_result(cluster_id, self.fingerprint, None if result is None else result.model_dump_json())
+            self.shared += len(waiting)
+            metrics.count('dedupe_shared', len(waiting))
+            for duplicate in waiting:
+                yield duplicate, result
+        if orphans:
+            yield from self.extract_iter(orphans)
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Yields emails whose cluster already has a result straight away, then streams one
+        email per remaining cluster through the wrapped extractor.
+        """
+        sends: list[AIEmailPayload] = []
+        held: dict[str, list[AIEmailPayload]] = {}
+        for payload in payloads:
+            # Emails that skipped the dedupe stage are indexed here
+            cluster_id = self.index.cluster_of(payload.id) or self.index.add(payload)
+            found, result = self.index.result(cluster_id, self.fingerprint)
+            if found:
+                self.shared += 1
+                metrics.count('dedupe_shared')
+                yield payload, self._load(result)
+            elif cluster_id in held:
+                held[cluster_id].append(payload)
+            else:
+                held[cluster_id] = []
+                sends.append(payload)
+        yield from self._extract(sends, held)
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return self.extractor.failed(payload)
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractorSchemaT | None]:
+        position = {id(payload): i for i, payload in enumerate(payloads)}
+        output: list[ExtractorSchemaT | None] = [None] * len(payloads)
+        for payload, result in self.extract_iter(payloads):
+            output[position[id(payload)]] = result
+        return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on the duplicate email index")
+    parser.add_argument("--db", default=DEFAULT_DEDUPE_DB)
+    args = parser.parse_args()
+
+    index = DuplicateIndex(args.db)
+    report = index.report()
+    print(f"{report['emails']} emails in {report['clusters']} clusters, {report['duplicates']} duplicates")
+    index.close()
@@ -0,0 +1,222 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator
+
+import metrics
+from model import Extractor, ExtractorSchemaT
+from schemas import AIEmailPayload
+
+
+DEFAULT_CACHE_DB = "extraction_cache.db"
+DEFAULT_MAX_ENTRIES = 100_000
+
+def schema_name(schema_class: type) -> str:
+    return f"{schema_class.__module__}.{schema_class.__qualname__}"
+
+
+def prompt_fingerprint(extractor: Extractor) -> str:
+    """
+    Hash of everything about the request that is shared by every payload: the schema class,
+    its JSON schema, the system prompt and the model. Changing any of them changes every key.
+    """
+    schema_class = extractor.SCHEMA_PROMPT
+    fingerprint = {
+        'schema': schema_name(schema_class),
+        'json_schema': schema_class.model_json_schema(),
+        'system_prompt': extractor.prompt.system_prompt,
+        'model': extractor.model_name,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def payload_key(fingerprint: str, payload: AIEmailPayload) -> str:
+    # Attachments keep their digest, nothing is base64 encoded just to build the key
+    attachment_digests = [attachment.sha256 for attachment in payload.attachments or []]
+    content = json.dumps({'text_context': payload.key_context(), 'attachments': attachment_digests}, sort_keys=True)
+    return hashlib.sha256(f"{fingerprint}\0{content}".encode()).hexdigest()
+
+
+class ExtractionCache:
+    """
+    SQLite store of extraction results keyed by payload content and prompt fingerprint.
+    Entries past `max_entries` are evicted least recently used first.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_DB, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                schema TEXT NOT NULL,
+                model TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                result TEXT,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+            CREATE INDEX IF NOT EXISTS results_schema ON results (schema, fingerprint);
+        """)
+
+    def get_many(self, keys: list[str]) -> dict[str, str | None]:
+        """
+        Returns the cached JSON (None for an empty extraction) of each key that is present.
+        """
+        found: dict[str, str | None] = {}
+        now = time.time()
+        with self._lock:
+            # Chunked to stay under SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for key, result in self.conn.execute(f"SELECT key, result FROM results WHERE key IN ({placeholders})", chunk):
+                    found[key] = result
+            with self.conn:
+                self.conn.executemany("UPDATE results SET last_access = ? WHERE key = ?", ((now, key) for key in found))
+        return found
+
+    def put_many(self, entries: list[tuple[str, str | None]], schema: str, model: str, fingerprint: str):
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results (key, schema, model, fingerprint, result, last_access) "
+                                  "VALUES (?, ?, ?, ?, ?, ?)",
+                                  ((key, schema, model, fingerprint, result, now) for key, result in entries))
+        self.evict()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def evict(self):
+        with self._lock, self.conn:
+            overflow = len(self) - self.max_entries
+            if overflow > 0:
+                self.conn.execute("DELETE FROM results WHERE key IN "
+                                  "(SELECT key FROM results ORDER BY last_access LIMIT ?)", (overflow,))
+
+    def invalidate(self, schema: str | None = None, model: str | None = None, keep_fingerprint: str | None = None) -> int:
+        """
+        Deletes entries for a schema and/or model, all of them when neither is given.
+        With `keep_fingerprint` only entries made with a different prompt are removed.
+        """
+        clauses, params = [], []
+        if schema is not None:
+            clauses.append("schema = ?")
+            params.append(schema)
+        if model is not None:
+            clauses.append("model = ?")
+            params.append(model)
+        if keep_fingerprint is not None:
+            clauses.append("fingerprint != ?")
+            params.append(keep_fingerprint)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock, self.conn:
+            return self.conn.execute(f"DELETE FROM results{where}", params).rowcount
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedExtractor(Extractor[ExtractorSchemaT]):
+    """
+    Extractor that answers repeated payloads from an ExtractionCache and only sends the
+    misses to the wrapped extractor.
+    """
+
+    def __init__(self, extractor: Extractor[ExtractorSchemaT], cache: ExtractionCache | None = None):
+        super().__init__(schema_class=extractor.SCHEMA_PROMPT)
+        self.extractor = extractor
+        self.model_name = extractor.model_name
+        self.cache = cache if cache is not None else ExtractionCache()
+        self.fingerprint = prompt_fingerprint(extractor)
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate_stale(self) -> int:
+        """Drops this schema's entries that were made with an older prompt."""
+        return self.cache.invalidate(schema=schema_name(self.SCHEMA_PROMPT), keep_fingerprint=self.fingerprint)
+
+    def _load(self, cached: str | None) -> ExtractorSchemaT | None:
+        return None if cached is None else self.SCHEMA_PROMPT.model_validate_json(cached)
+
+    def _store(self, entries: list[tuple[str, str | None]]):
+        self.cache.put_many(entries,
+                            schema=schema_name(self.SCHEMA_PROMPT),
+                            model=self.model_name,
+                            fingerprint=self.fingerprint)
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Yields cache hits straight away, then streams the misses through the wrapped
+        extractor and caches their results as they arrive.
+        """
+        missing: list[tuple[str, AIEmailPayload]] = []
+        for chunk in _chunks(payloads, 500):
+            keys = [payload_key(self.fingerprint, payload) for payload in chunk]
+            cached = self.cache.get_many(keys)
+            for key, payload in zip(keys, chunk):
+                if key in cached:
+                    self.hits += 1
+                    metrics.count('extraction_cache_hits')
+                    yield payload, self._load(cached[key])
+                else:
+                    missing.append((key, payload))
+        self.misses += len(missing)
+        metrics.count('extraction_cache_misses', len(missing))
+
+        key_of = {id(payload): key for key, payload in missing}
+        entries: list[tuple[str, str | None]] = []
+        for payload, result in self.extractor.extract_iter(payload for _, payload in missing):
+            if self.extractor.failed(payload):
+                # Left out so the next run asks again instead of reading back "no flight"
+                yield payload, result
+                continue
+            entries.append((key_of[id(payload)], None if result is None else result.model_dump_json()))
+            if len(entries) >= 100:
+                self._store(entries)
+                entries = []
+            yield payload, result
+        if entries:
+            self._store(entries)
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return self.extractor.failed(payload)
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractorSchemaT | None]:
+        position = {id(payload): i for i, payload in enumerate(payloads)}
+        output: list[ExtractorSchemaT | None] = [None] * len(payloads)
+        for payload, result in self.extract_iter(payloads):
+            output[position[id(payload)]] = result
+        return output
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the extraction result cache")
+    parser.add_argument("--db", default=DEFAULT_CACHE_DB)
+    parser.add_argument("--schema", help="only entries for this schema, e.g. schemas.ExtractedFlightInfo")
+    parser.add_argument("--model", help="only entries for this model")
+    args = parser.parse_args()
+
+    cache = ExtractionCache(args.db)
+    print(f"Removed {cache.invalidate(schema=args.schema, model=args.model)} cached results")
+    cache.close()
@@ -0,0 +1,381 @@
+import base64
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import Callable, NamedTuple
+
+from schemas import ExtractedFlightInfo
+
+
+# (name, domain, IATA code) of the senders flight confirmations come from
+AIRLINES = [
+    ('United Airlines', 'united.com', 'UA'),
+    ('Delta Air Lines', 'delta.com', 'DL'),
+    ('American Airlines', 'aa.com', 'AA'),
+    ('JetBlue Airways', 'jetblue.com', 'B6'),
+    ('Alaska Airlines', 'alaskaair.com', 'AS'),
+    ('Southwest Airlines', 'southwest.com', 'WN'),
+]
+AIRPORTS = ['SFO', 'JFK', 'LAX', 'ORD', 'SEA', 'BOS', 'ATL', 'DEN', 'AUS', 'MIA', 'EWR', 'PHX']
+OTHER_SENDERS = [
+    ('The Daily Brief', 'news.example.com', "Today's top stories"),
+    ('Acme Store', 'shop.example.com', 'Your order has shipped'),
+    ('City Utilities', 'billing.example.org', 'Your monthly statement is ready'),
+    ('Team Calendar', 'calendar.example.com', 'Reminder: planning meeting'),
+    ('Travel Deals', 'deals.example.net', 'Fares to Europe from $399'),
+]
+FILLER = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt "
+          "ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation.")
+FOOTER = ("You are receiving this email because you have an account with us. Manage your email "
+          "preferences or unsubscribe. Privacy policy. Terms and conditions. All rights reserved.")
+_FLIGHT_NUMBER_RE = re.compile(r'\b[A-Z][A-Z0-9]\d{1,4}\b')
+
+
+class Mailbox(NamedTuple):
+    # Gmail messages in 'full' format, newest first, as messages.get returns them
+    messages: list[dict]
+    # Attachment bytes by (message id, attachment id)
+    attachments: dict[tuple[str, str], bytes]
+    # What a perfect extraction returns for each message id, None for non flight emails
+    truth: dict[str, ExtractedFlightInfo | None]
+
+
+def _b64(data: bytes) -> str:
+    # Gmail sends padded base64url
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def _pdf_string(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def make_pdf(lines: list[str]) -> bytes:
+    """
+    Single page PDF with `lines` as its text layer. Without lines the page only holds a
+    drawn box, like a scanned or image only itinerary.
+    """
+    if lines:
+        content = 'BT /F1 11 Tf 72 720 Td 14 TL ' + ' '.join(f'({_pdf_string(line)}) Tj T*' for line in lines) + ' ET'
+    else:
+        content = '0.5 g 72 400 468 300 re f'
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>',
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        f'<< /Length {len(content)} >>\nstream\n{content}\nendstream',
+    ]
+    output = '%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f'{number} 0 obj\n{body}\nendobj\n'
+    xref = len(output)
+    output += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'
+    output += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    output += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    return output.encode('latin-1')
+
+
+def _flight_html(airline: str, flight: ExtractedFlightInfo, confirmation: str, takeoff: date, rng: random.Random) -> str:
+    rows = [
+        ('Confirmation number', confirmation),
+        ('Passenger', flight.passenger_name),
+        ('Flight', flight.flight_number),
+        ('From', flight.airport_code_src),
+        ('To', flight.airport_code_dst),
+        ('Departs', f"{takeoff:%a, %b} {takeoff.day}, {takeoff.year} {rng.randint(5, 22)}:{rng.choice(['00', '15', '30', '45'])}"),
+        ('Seat', f"{rng.randint(1, 40)}{rng.choice('ABCDEF')}"),
+    ]
+    table = ''.join(f'<tr><td class="label">{label}</td><td class="value">{value}</td></tr>' for label, value in rows)
+    promos = ''.join(f'<div class="promo"><a href="https://example.com/p{i}">Offer {i}</a><p>{FILLER}</p></div>'
+                     for i in range(rng.randint(3, 12)))
+    return (f'<html><head><style>td.label {{ color: #555; }} .promo {{ margin: 8px; }}</style>'
+            f'<script>window.tracking = {{"id": "{confirmation}"}};</script></head><body>'
+            f'<div class="header"><img src="https://example.com/logo.png" alt="{airline}"></div>'
+            f'<h1>Your trip is confirmed</h1><p>Thanks for choosing {airline}. Your itinerary is below.</p>'
+            f'<table class="itinerary">{table}</table>{promos}'
+            f'<div class="footer"><p>{FOOTER}</p></div></body></html>')
+
+
+def _other_html(sender: str, subject: str, rng: random.Random) -> str:
+    paragraphs = ''.join(f'<p>{FILLER}</p>' for _ in range(rng.randint(5, 40)))
+    return (f'<html><head><style>p {{ line-height: 1.4; }}</style></head><body><h1>{subject}</h1>'
+            f'{paragraphs}<div class="footer"><p>{sender}. {FOOTER}</p></div></body></html>')
+
+
+def generate_mailbox(count: int,
+                     seed: int = 0,
+                     flight_ratio: float = 0.3,
+                     pdf_ratio: float = 0.3,
+                     scanned_ratio: float = 0.25,
+                     name: str = "Shrey Patel") -> Mailbox:
+    """
+    Synthetic mailbox of `count` messages. A `flight_ratio` share are airline confirmations
+    with an HTML itinerary, and `pdf_ratio` of those also carry a PDF itinerary as an
+    attachment, `scanned_ratio` of the PDFs without a text layer. The rest are newsletters,
+    receipts and reminders. The same seed always gives the same mailbox.
+    """
+    rng = random.Random(seed)
+    messages: list[dict] = []
+    attachments: dict[tuple[str, str], bytes] = {}
+    truth: dict[str, ExtractedFlightInfo | None] = {}
+    start = date(2024, 1, 1)
+    for index in range(count):
+        msg_id = f"{index:016x}"
+        received = start + timedelta(days=index * 730 // max(count, 1))
+        parts = []
+        if rng.random() < flight_ratio:
+            airline, domain, code = rng.choice(AIRLINES)
+            src, dst = rng.sample(AIRPORTS, 2)
+            takeoff = received + timedelta(days=rng.randint(1, 90))
+            flight = ExtractedFlightInfo(airport_code_src=src,
+                                         airport_code_dst=dst,
+                                         flight_takeoff_date=takeoff.isoformat(),
+                                         flight_number=f"{code}{rng.randint(1, 2999)}",
+                                         passenger_name=name)
+            confirmation = ''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(6))
+            sender = f'{airline} <reservations@{domain}>'
+            subject = f"Your {airline} confirmation {confirmation}: {src} to {dst}"
+            snippet = f"Thanks for choosing {airline}. Confirmation {confirmation}, flight {flight.flight_number}"
+            html = _flight_html(airline, flight, confirmation, takeoff, rng)
+            if rng.random() < pdf_ratio:
+                lines = [] if rng.random() < scanned_ratio else [
+                    f"{airline} electronic ticket receipt",
+                    f"Passenger: {name}", f"Confirmation: {confirmation}",
+                    f"Flight {flight.flight_number} from {src} to {dst} on {takeoff:%d %b %Y}",
+                    FILLER, FILLER, FOOTER,
+                ]
+                data = make_pdf(lines)
+                att_id = f"att{msg_id}"
+                attachments[(msg_id, att_id)] = data
+                parts.append({'partId': '1', 'mimeType': 'application/pdf', 'filename': 'itinerary.pdf',
+                              'headers': [], 'body': {'attachmentId': att_id, 'size': len(data)}})
+        else:
+            flight = None
+            sender_name, domain, subject = rng.choice(OTHER_SENDERS)
+            sender = f'{sender_name} <hello@{domain}>'
+            snippet = FILLER[:120]
+            html = _other_html(sender_name, subject, rng)
+        body = html.encode()
+        headers = [
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': f'{name} <me@example.com>'},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': f"{received:%a, %d %b %Y} 09:00:00 +0000"},
+        ]
+        html_part = {'partId': '0', 'mimeType': 'text/html', 'filename': '', 'headers': [],
+                     'body': {'size': len(body), 'data': _b64(body)}}
+        if parts:
+            payload = {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': headers,
+                       'body': {'size': 0}, 'parts': [html_part] + parts}
+        else:
+            payload = {**html_part, 'partId': '', 'headers': headers}
+        messages.append({'id': msg_id, 'threadId': msg_id, 'labelIds': ['INBOX'], 'snippet': snippet,
+                         'historyId': str(index + 1), 'internalDate': str(index), 'payload': payload,
+                         'sizeEstimate': len(body) + sum(part['body']['size'] for part in parts)})
+        truth[msg_id] = flight
+    messages.reverse()
+    return Mailbox(messages, attachments, truth)
+
+
+class FakeRequest:
+    """A built API request, runs `fn` after `latency` seconds when executed."""
+
+    def __init__(self, fn: Callable[[], dict], latency: float = 0.0):
+        self.fn = fn
+        self.latency = latency
+
+    def execute(self, http=None) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        return self.fn()
+
+
+class FakeBatchHttpRequest:
+    def __init__(self, service: 'FakeGmailService', callback: Callable):
+        self.service = service
+        self.callback = callback
+        self.requests: list[tuple[str, FakeRequest]] = []
+
+    def add(self, request: FakeRequest, request_id: str | None = None):
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self, http=None):
+        # One round trip for the whole batch, the calls in it cost nothing extra
+        if self.service.batch_latency:
+            time.sleep(self.service.batch_latency)
+        for request_id, request in self.requests:
+            try:
+                response = request.fn()
+            except Exception as error:
+                self.callback(request_id, None, error)
+            else:
+                self.callback(request_id, response, None)
+
+
+def _strip_bodies(part: dict) -> dict:
+    part = {**part, 'body': {'size': part['body'].get('size', 0)}}
+    if 'parts' in part:
+        part['parts'] = [_strip_bodies(child) for child in part['parts']]
+    return part
+
+
+class FakeGmailService:
+    """
+    In memory stand in for the slice of the Gmail API `googleapiclient` service the fetcher
+    and the sync use: users().getProfile, messages().list, messages().get,
+    messages().attachments().get and new_batch_http_request. `latency` is added to every
+    single request, `batch_latency` to every batch round trip. Search queries and label
+    filters are ignored, every message matches.
+    """
+
+    def __init__(self, mailbox: Mailbox, latency: float = 0.0, batch_latency: float = 0.0):
+        self.mailbox = mailbox
+        self.by_id = {message['id']: message for message in mailbox.messages}
+        self.latency = latency
+        self.batch_latency = batch_latency
+        self.calls: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def users(self) -> 'FakeGmailService':
+        return self
+
+    def messages(self) -> 'FakeGmailService':
+        return self
+
+    def attachments(self) -> SimpleNamespace:
+        return SimpleNamespace(get=self._get_attachment)
+
+    def new_batch_http_request(self, callback: Callable) -> FakeBatchHttpRequest:
+        self._count('batch')
+        return FakeBatchHttpRequest(self, callback)
+
+    def getProfile(self, userId: str = 'me') -> FakeRequest:
+        def run():
+            self._count('getProfile')
+            return {'emailAddress': 'me@example.com',
+                    'messagesTotal': len(self.mailbox.messages),
+                    'historyId': str(len(self.mailbox.messages))}
+        return FakeRequest(run, self.latency)
+
+    def list(self, userId: str = 'me', labelIds=None, q=None, maxResults: int = 100, pageToken: str | None = None) -> FakeRequest:
+        def run():
+            self._count('list')
+            offset = int(pageToken or 0)
+            page = self.mailbox.messages[offset:offset + maxResults]
+            result: dict = {'messages': [{'id': message['id'], 'threadId': message['threadId']} for message in page],
+                            'resultSizeEstimate': len(self.mailbox.messages)}
+            if offset + maxResults < len(self.mailbox.messages):
+                result['nextPageToken'] = str(offset + maxResults)
+            return result
+        return FakeRequest(run, self.latency)
+
+    def get(self, userId: str = 'me', id: str = '', format: str = 'full', metadataHeaders=None) -> FakeRequest:
+        def run():
+            self._count('get')
+            message = self.by_id[id]
+            if format == 'full':
+                return message
+            if format == 'minimal':
+                return {key: message[key] for key in ('id', 'threadId', 'labelIds', 'snippet', 'historyId')}
+            if format == 'metadata':
+                wanted = {name.lower() for name in metadataHeaders} if metadataHeaders else None
+                payload = _strip_bodies(message['payload'])
+                payload['headers'] = [header for header in payload['headers']
+                                      if wanted is None or header['name'].lower() in wanted]
+                return {**message, 'payload': payload}
+            raise ValueError(f"Unsupported format {format}")
+        return FakeRequest(run, self.latency)
+
+    def _get_attachment(self, userId: str = 'me', messageId: str = '', id: str = '') -> FakeRequest:
+        def run():
+            self._count('attachments.get')
+            data = self.mailbox.attachments[(messageId, id)]
+            return {'attachmentId': id, 'size': len(data), 'data': _b64(data)}
+        return FakeRequest(run, self.latency)
+
+
+def _empty_response(params: dict) -> str:
+    # Text after the "{" prefill
+    return '}'
+
+
+class FakeBatches:
+    """
+    Stand in for `client.beta.messages.batches`. A batch ends `latency` seconds after it is
+    created plus `per_request` seconds for each request in it. `respond` turns a request's
+    params into the text the model would write after the "{" prefill.
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 per_request: float = 0.0,
+                 respond: Callable[[dict], str] = _empty_response):
+        self.latency = latency
+        self.per_request = per_request
+        self.respond = respond
+        self.batches: dict[str, tuple[float, list[dict]]] = {}
+        self.created = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def create(self, requests: list[dict]) -> SimpleNamespace:
+        with self._lock:
+            batch_id = f"msgbatch_{next(self._ids):06d}"
+            self.created += 1
+            self.batches[batch_id] = (time.monotonic() + self.latency + self.per_request * len(requests), list(requests))
+        return SimpleNamespace(id=batch_id, processing_status='in_progress')
+
+    def retrieve(self, batch_id: str) -> SimpleNamespace:
+        ends_at, requests = self.batches[batch_id]
+        ended = time.monotonic() >= ends_at
+        counts = SimpleNamespace(processing=0 if ended else len(requests),
+                                 succeeded=len(requests) if ended else 0,
+                                 errored=0, canceled=0, expired=0)
+        return SimpleNamespace(id=batch_id, processing_status='ended' if ended else 'in_progress', request_counts=counts)
+
+    def results(self, batch_id: str):
+        _, requests = self.batches.pop(batch_id)
+        for request in requests:
+            text = self.respond(request['params'])
+            # Rough token counts, four characters a token
+            usage = SimpleNamespace(input_tokens=len(json.dumps(request['params'])) // 4,
+                                    output_tokens=max(1, len(text) // 4),
+                                    cache_read_input_tokens=0)
+            message = SimpleNamespace(content=[SimpleNamespace(type='text', text=text)], usage=usage)
+            yield SimpleNamespace(custom_id=request['custom_id'],
+                                  result=SimpleNamespace(type='succeeded', message=message))
+
+
+class FakeAnthropic:
+    """Just enough of the Anthropic client for the BatchScheduler: client.beta.messages.batches."""
+
+    def __init__(self, batches: FakeBatches | None = None):
+        self.batches = batches or FakeBatches()
+        self.beta = SimpleNamespace(messages=SimpleNamespace(batches=self.batches))
+
+
+def truth_responder(mailbox: Mailbox) -> Callable[[dict], str]:
+    """
+    `respond` function for FakeBatches that answers with the mailbox's ground truth, found
+    through the confirmation details in the prompt, so results can be checked for accuracy.
+    """
+    by_flight_number = {flight.flight_number: flight for flight in mailbox.truth.values() if flight is not None}
+
+    def respond(params: dict) -> str:
+        prompt = params['messages'][0]['content'][-1]['text']
+        for flight_number in _FLIGHT_NUMBER_RE.findall(prompt):
+            if flight_number in by_flight_number:
+                return json.dumps(by_flight_number[flight_number].model_dump())[1:]
+        return '}'
+    return respond
@@ -1,4 +1,4 @@
-import pandas as pd
+from airline_index import AirlineIndex
 
 
 # Common airline-related keywords and phrases for email filtering
@@ -102,16 +102,8 @@ common_patterns = [
 
 
 def get_airline_names() -> set:
-    to_remove = ["\\N", ""]
-    df = pd.read_csv('airline_codes.csv')
-    df.columns = ['index', 'airline_name', 'alias', 'IATA', 'ICAO', 'callsign', 'country', 'active']
-    df = df[df['active'] == 'Y']
-
-    airline_names = df['airline_name']
-    airline_names = airline_names.to_list()
-
-    airline_names = set(airline_names)
-    return airline_names
+    # Served from the memory mapped airline index, the CSV is only parsed when it changes
+    return AirlineIndex.default().active_names()
 
 
 
@@ -0,0 +1,312 @@
+import base64
+import contextlib
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator
+
+import google_auth_httplib2
+import httplib2
+from googleapiclient.errors import HttpError
+
+import metrics
+from ratelimit import QuotaLimiter
+
+
+logger = logging.getLogger(__name__)
+
+# Gmail accepts up to 100 calls per batch but starts rate limiting well before that,
+# 50 is the size Google recommends for messages.get
+MAX_BATCH_SIZE = 100
+DEFAULT_BATCH_SIZE = 50
+ATTACHMENT_BATCH_SIZE = 10
+
+# Gmail API quota units per method, anything else is charged as much as messages.get
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+
+_LIST_DONE = object()
+
+
+def is_retryable(error: Exception) -> bool:
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUS:
+        return True
+    # Gmail reports quota errors as 403 with a rate limit reason
+    if status == 403:
+        reasons = {detail.get('reason') for detail in (error.error_details or []) if isinstance(detail, dict)}
+        return bool(reasons & RETRYABLE_REASONS) or 'rate limit' in str(error).lower()
+    return False
+
+
+def request_units(request) -> int:
+    return QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_QUOTA_UNITS)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 64.0) -> float:
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _chunked(requests: Iterable[tuple[str, Callable[[], Any]]], size: int) -> Iterator[dict[str, Callable[[], Any]]]:
+    chunk: dict[str, Callable[[], Any]] = {}
+    for request_id, build_request in requests:
+        chunk[request_id] = build_request
+        if len(chunk) == size:
+            yield chunk
+            chunk = {}
+    if chunk:
+        yield chunk
+
+
+class GmailFetcher:
+    """
+    Fetches Gmail messages using batch HTTP requests.
+
+    messages.get calls are grouped into batches of `batch_size`, and up to `max_concurrency`
+    batches are in flight at once. Authorized http objects are lent to one call at a time,
+    since httplib2 is not thread safe, and kept between calls so their connections stay
+    open for the next batch, whichever thread runs it. Without credentials the service's own http is used and
+    batches run one at a time.
+
+    With a `quota` every call, retries included, is charged its Gmail quota units first and
+    waits while the user's or project's budget is spent.
+    """
+
+    def __init__(self,
+                 service,
+                 credentials=None,
+                 user_id: str = 'me',
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_concurrency: int = 4,
+                 max_retries: int = 5,
+                 list_prefetch: int = 2,
+                 quota: QuotaLimiter | None = None):
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+        self.service = service
+        self.credentials = credentials
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency if credentials is not None else 1
+        self.max_retries = max_retries
+        self.list_prefetch = list_prefetch
+        self.quota = quota
+        self._https: list = []
+        self._https_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _http(self):
+        if self.credentials is None:
+            yield None
+            return
+        with self._https_lock:
+            http = self._https.pop() if self._https else None
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+        try:
+            yield http
+        finally:
+            with self._https_lock:
+                self._https.append(http)
+
+    def execute(self, request) -> Any:
+        """
+        Executes a single API request on a pooled http, retrying quota errors.
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.quota is not None:
+                    self.quota.acquire(request_units(request))
+                metrics.count('gmail_requests', kind='single')
+                with metrics.timer('gmail_request_seconds', kind='single'), self._http() as http:
+                    return request.execute(http=http)
+            except HttpError as error:
+                if attempt >= self.max_retries or not is_retryable(error):
+                    metrics.count('gmail_errors', kind='single')
+                    raise
+                metrics.count('gmail_retries', kind='single')
+                delay = backoff_delay(attempt)
+                logger.warning("Gmail request failed with %s, retrying in %.1fs", error.resp.status, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def list_pages(self,
+                   query: str | None = None,
+                   label_ids: list[str] | None = None,
+                   page_size: int = 500) -> Iterator[list[dict]]:
+        """
+        Yields pages of messages.list results. Pages are pulled by a background thread up to
+        `list_prefetch` pages ahead of the consumer.
+        """
+        pages: queue.Queue = queue.Queue(maxsize=max(1, self.list_prefetch))
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            # Gives up once the consumer has stopped reading instead of blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            page_token = None
+            try:
+                while True:
+                    request = self.service.users().messages().list(userId=self.user_id,
+                                                                   labelIds=label_ids,
+                                                                   q=query,
+                                                                   maxResults=page_size,
+                                                                   pageToken=page_token)
+                    results = self.execute(request)
+                    if not put(results.get('messages', [])):
+                        return
+                    page_token = results.get('nextPageToken')
+                    if not page_token:
+                        break
+                put(_LIST_DONE)
+            except Exception as error:
+                put(error)
+
+        producer = threading.Thread(target=produce, name='gmail-list', daemon=True)
+        producer.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is _LIST_DONE:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+
+    def list_message_ids(self,
+                         query: str | None = None,
+                         label_ids: list[str] | None = None,
+                         page_size: int = 500) -> Iterator[str]:
+        for page in self.list_pages(query=query, label_ids=label_ids, page_size=page_size):
+            for msg in page:
+                yield msg['id']
+
+    def _get_request(self, msg_id: str, format: str, metadata_headers: list[str] | None):
+        kwargs = {'userId': self.user_id, 'id': msg_id, 'format': format}
+        if format == 'metadata' and metadata_headers:
+            kwargs['metadataHeaders'] = metadata_headers
+        return self.service.users().messages().get(**kwargs)
+
+    def _run_batch(self,
+                   requests: dict[str, Callable[[], Any]]) -> list[tuple[str, dict]]:
+        """
+        Runs one batch of requests keyed by request id, retrying the items that failed
+        with quota or backend errors. Items that fail permanently are logged and dropped.
+        """
+        pending = dict(requests)
+        results: list[tuple[str, dict]] = []
+        attempt = 0
+        while pending:
+            retry: dict[str, Callable[[], Any]] = {}
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results.append((request_id, response))
+                elif is_retryable(exception) and attempt < self.max_retries:
+                    retry[request_id] = pending[request_id]
+                else:
+                    metrics.count('gmail_errors', kind='batch')
+                    logger.error("Dropping Gmail request %s: %s", request_id, exception)
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            units = 0
+            for request_id, build_request in pending.items():
+                request = build_request()
+                units += request_units(request)
+                batch.add(request, request_id=request_id)
+            if self.quota is not None:
+                self.quota.acquire(units)
+            metrics.count('gmail_requests', len(pending), kind='batch')
+            try:
+                with metrics.timer('gmail_request_seconds', kind='batch'), self._http() as http:
+                    batch.execute(http=http)
+            except HttpError as error:
+                # The batch endpoint itself was throttled, nothing in it ran
+                if attempt >= self.max_retries or not is_retryable(error):
+                    raise
+                retry = pending
+
+            if retry:
+                metrics.count('gmail_retries', len(retry), kind='batch')
+                delay = backoff_delay(attempt)
+                logger.warning("Retrying %d Gmail requests in %.1fs", len(retry), delay)
+                time.sleep(delay)
+            pending = retry
+            attempt += 1
+        return results
+
+    def fetch(self,
+              ids: Iterable[str],
+              format: str = 'full',
+              metadata_headers: list[str] | None = None) -> Iterator[dict]:
+        """
+        Fetches messages by id with batched messages.get calls. `format` is one of
+        'minimal', 'metadata', 'full' or 'raw'. Messages are yielded as their batch
+        completes, so the output order is not the input order.
+        """
+        requests = ((msg_id, lambda msg_id=msg_id: self._get_request(msg_id, format, metadata_headers)) for msg_id in ids)
+        for _, message in self._run_batches(_chunked(requests, self.batch_size)):
+            yield message
+
+    def fetch_attachments(self,
+                          refs: Iterable[tuple[str, str]],
+                          batch_size: int = ATTACHMENT_BATCH_SIZE) -> Iterator[tuple[tuple[str, str], bytes]]:
+        """
+        Downloads attachments by (message id, attachment id) with batched attachments.get
+        calls and yields each ref with its decoded bytes, in completion order. Batches are
+        smaller than for messages since a single attachment can be up to 25MB.
+        """
+        by_request_id: dict[str, tuple[str, str]] = {}
+
+        def requests() -> Iterator[tuple[str, Callable[[], Any]]]:
+            # Attachment ids are too long to use as batch request ids
+            for index, (msg_id, att_id) in enumerate(refs):
+                request_id = str(index)
+                by_request_id[request_id] = (msg_id, att_id)
+                yield request_id, lambda msg_id=msg_id, att_id=att_id: self.service.users().messages().attachments().get(
+                    userId=self.user_id, messageId=msg_id, id=att_id)
+
+        for request_id, response in self._run_batches(_chunked(requests(), min(batch_size, self.batch_size))):
+            data = response['data']
+            yield by_request_id.pop(request_id), base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+    def _run_batches(self, batches: Iterator[dict[str, Callable[[], Any]]]) -> Iterator[tuple[str, dict]]:
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='gmail-batch') as pool:
+            in_flight: deque = deque()
+            for batch in batches:
+                in_flight.append(pool.submit(self._run_batch, batch))
+                # Keep at most max_concurrency batches queued so the id source is consumed lazily
+                while len(in_flight) >= self.max_concurrency:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        in_flight.remove(future)
+                        yield from future.result()
+            while in_flight:
+                yield from in_flight.popleft().result()
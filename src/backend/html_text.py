@@ -0,0 +1,153 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+UNWANTED_TAGS = frozenset([
+    'script', 'style', 'noscript', 'head', 'meta',
+    'link', 'title', 'svg', 'footer', 'header', 'nav', 'aside'
+])
+
+
+def available() -> bool:
+    return etree is not None
+
+
+# Strings inside a template are left out of bs4's get_text as well
+SKIPPED_TAGS = UNWANTED_TAGS | {'template'}
+# libxml2 reads the content of these as raw text, html.parser and so bs4 read it as markup
+RAW_TEXT_TAGS = frozenset(['textarea', 'xmp', 'plaintext', 'iframe', 'noembed', 'noframes'])
+
+
+class _TextTarget:
+    """
+    lxml parser target that collects the visible text as the document is parsed, no tree is
+    built. The text between two tags, comments included, is one piece, like a bs4 string.
+    """
+
+    def __init__(self):
+        self.pieces: list[str] = []
+        self._run: list[str] = []
+        # Depth inside a skipped tag
+        self._skip = 0
+        # Text of the link with an href being read, and the depth inside it
+        self._link: list[str] | None = None
+        self._link_depth = 0
+        self._raw: list[str] | None = None
+
+    def _flush(self):
+        # Text in a link is joined without separators whatever tags split it
+        if self._link is None and self._run:
+            self.pieces.append(''.join(self._run))
+            self._run = []
+
+    def _string(self, text: str):
+        if self._link is not None:
+            self._link.append(text)
+        else:
+            self._flush()
+            self.pieces.append(text)
+
+    def start(self, tag: str, attrib):
+        self._flush()
+        if self._skip or tag in SKIPPED_TAGS:
+            self._skip += 1
+        elif tag in RAW_TEXT_TAGS:
+            self._raw = []
+        elif self._link is not None:
+            self._link_depth += 1
+        elif tag == 'a' and attrib.get('href'):
+            self._link = []
+            self._link_depth = 1
+
+    def end(self, tag: str):
+        self._flush()
+        if self._skip:
+            self._skip -= 1
+        elif self._raw is not None:
+            # Parsed again as markup, the way html.parser reads it
+            raw, self._raw = ''.join(self._raw), None
+            inner = _pieces(raw)
+            if self._link is not None:
+                self._link.append(''.join(inner))
+            else:
+                self.pieces += inner
+        elif self._link is not None:
+            self._link_depth -= 1
+            if not self._link_depth:
+                link, self._link = self._link, None
+                self.pieces.append(''.join(link).strip())
+
+    def data(self, data: str):
+        if self._skip:
+            return
+        if self._raw is not None:
+            self._raw.append(data)
+        elif self._link is not None:
+            self._link.append(data)
+        else:
+            self._run.append(data)
+
+    def comment(self, text: str):
+        # libxml2 reports CDATA sections, which bs4 keeps as text, as comments
+        if self._skip:
+            return
+        if text.startswith('[CDATA[') and text.endswith(']]'):
+            self._string(text[7:-2])
+        else:
+            self._flush()
+
+    def close(self) -> list[str]:
+        self._flush()
+        return self.pieces
+
+
+def _pieces(raw_html: str) -> list[str]:
+    if not raw_html.strip():
+        return []
+    # A parser is bound to its target, a fresh pair per document keeps this thread safe
+    parser = etree.HTMLParser(target=_TextTarget(), encoding='utf-8', remove_comments=False, remove_pis=False)
+    return etree.fromstring(raw_html.encode('utf-8', errors='surrogatepass'), parser)
+
+
+def html_to_text(raw_html: str) -> str:
+    """
+    Visible text of an HTML document, one chunk per line, the same as the bs4 engine gives
+    for nearly every email. Unwanted tags are dropped with their contents, links with an
+    href collapse to their text and comments are skipped, all while libxml2 parses the
+    document. Content after </html> is kept.
+
+    libxml2 repairs broken markup where html.parser reads it token by token, so a few
+    things still come out differently from bs4:
+    - tags libxml2 drops as misplaced, such as the </b> of <b><i>x</b>y</i>z or a second
+      <body>, do not split the text around them into separate lines
+    - text libxml2 moves out of <head>, like a <p> inside it, is kept where bs4 drops it
+    - entities inside a <textarea> are decoded before its content is read as markup
+    - NUL characters come out as U+FFFD
+    """
+    pieces = _pieces(raw_html)
+    if not pieces:
+        return ""
+    visible_text = '\n'.join(pieces)
+    lines = (line.strip() for line in visible_text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def _extract_file(path: str) -> tuple[str, str]:
+    with open(file=path, mode='r') as html_file:
+        return path, html_to_text(html_file.read())
+
+
+def extract_directory(directory: str, processes: int | None = None, chunksize: int = 16) -> Iterator[tuple[str, str]]:
+    """
+    Extracts the text of every file under `directory` across a pool of processes. Yields
+    (path, text) pairs in directory walk order.
+    """
+    paths = [os.path.join(root, filename) for root, _, files in os.walk(directory) for filename in files]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        yield from pool.map(_extract_file, paths, chunksize=chunksize)
@@ -0,0 +1,414 @@
+import bisect
+import collections
+import datetime
+import re
+import sqlite3
+from typing import Iterable, NamedTuple
+
+from schemas import ExtractedFlightInfo
+
+
+# Longest stay between two legs of one trip, a leg flying out of the airport the previous
+# one landed at within this many days continues the trip. Legs arrive in any order, so a
+# longer window also chains the legs of back to back trips more often
+DEFAULT_MAX_STAY_DAYS = 14
+# Legs out of the most common departure airport before it is taken to be home
+MIN_HOME_DEPARTURES = 3
+
+AIRPORT_RE = re.compile(r'^[A-Z]{3,4}$')
+# Airline prefix, IATA (two characters) or ICAO (three letters), then the number
+FLIGHT_RE = re.compile(r'^([A-Z0-9]{2}[A-Z]?)(\d{1,4})$')
+CARRIER_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# A flight number of 0 means the email did not say
+UNKNOWN_FLIGHT = 0
+
+
+def encode_airport(code: str | None) -> int | None:
+    """
+    Airport code as an integer, letters as base 27 digits 1 to 26 so three and four letter
+    codes never collide. Contiguous US ICAO codes are the IATA code behind a K, KJFK is JFK.
+    """
+    code = (code or '').strip().upper()
+    if not AIRPORT_RE.match(code):
+        return None
+    if len(code) == 4 and code[0] == 'K':
+        code = code[1:]
+    value = 0
+    for char in code:
+        value = value * 27 + ord(char) - ord('A') + 1
+    return value
+
+
+def decode_airport(value: int) -> str:
+    chars = []
+    while value:
+        value, digit = divmod(value, 27)
+        chars.append(chr(ord('A') + digit - 1))
+    return ''.join(reversed(chars))
+
+
+def encode_flight(flight_number: str | None) -> int:
+    """Flight number as (airline prefix in base 37) * 10000 + number, UNKNOWN_FLIGHT when unreadable."""
+    match = FLIGHT_RE.match((flight_number or '').replace(' ', '').upper())
+    if match is None:
+        return UNKNOWN_FLIGHT
+    prefix = 0
+    for char in match.group(1):
+        prefix = prefix * 37 + CARRIER_DIGITS.index(char) + 1
+    return prefix * 10000 + int(match.group(2))
+
+
+def decode_flight(value: int) -> str | None:
+    if value == UNKNOWN_FLIGHT:
+        return None
+    prefix, number = divmod(value, 10000)
+    chars = []
+    while prefix:
+        prefix, digit = divmod(prefix, 37)
+        chars.append(CARRIER_DIGITS[digit - 1])
+    return ''.join(reversed(chars)) + str(number)
+
+
+def encode_day(takeoff: str | None) -> int | None:
+    """Takeoff date as a proleptic Gregorian ordinal, None when it is not an ISO date."""
+    try:
+        return datetime.date.fromisoformat((takeoff or '').strip()[:10]).toordinal()
+    except ValueError:
+        return None
+
+
+def decode_day(day: int) -> str:
+    return datetime.date.fromordinal(day).isoformat()
+
+
+class Leg(NamedTuple):
+    day: int
+    flight: int
+    src: int
+    dst: int
+
+
+def normalize_leg(result: ExtractedFlightInfo | None) -> Leg | None:
+    """The typed leg an extraction describes, None when it lacks a date or either airport."""
+    if result is None:
+        return None
+    day = encode_day(result.flight_takeoff_date)
+    src, dst = encode_airport(result.airport_code_src), encode_airport(result.airport_code_dst)
+    if day is None or src is None or dst is None or src == dst:
+        return None
+    return Leg(day, encode_flight(result.flight_number), src, dst)
+
+
+class Trip(NamedTuple):
+    trip_id: int
+    start_day: int
+    end_day: int
+    origin: int
+    destination: int
+
+    def closed(self) -> bool:
+        # Back where it started, the next flight out of there is another trip
+        return self.origin == self.destination
+
+
+class TripIndex:
+    """
+    Legs of the extracted flights chained into trips, kept in the results database.
+
+    Each message's flight is normalized into a leg of integer columns (day ordinal,
+    packed flight number and airport codes). Emails about the same leg share one row. A
+    new leg joins the trip that ended at its origin at most `max_stay_days` before it,
+    and the trip that starts at its destination at most that long after, linking the two
+    when both exist. A trip back where it started, or at home once the most common
+    departure airport is clear, takes no more legs.
+
+    Trips are held in memory in sorted lists keyed by start airport, end airport and
+    start day, so a leg is placed with a few bisections plus a pass over its own trip
+    when it changes the trip's origin, and a date range of trips is read without going
+    over the whole history.
+
+    The index does no locking or committing of its own, the ResultStore calls it under its
+    lock inside the transaction that writes the flights.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, max_stay_days: int = DEFAULT_MAX_STAY_DAYS):
+        self.conn = conn
+        self.max_stay_days = max_stay_days
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS legs (
+                leg_id INTEGER PRIMARY KEY,
+                day INTEGER NOT NULL,
+                flight INTEGER NOT NULL,
+                src INTEGER NOT NULL,
+                dst INTEGER NOT NULL,
+                passenger_name TEXT,
+                trip_id INTEGER,
+                -- Order of the leg in its trip, same day connections share a day
+                seq INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS legs_route ON legs (day, src, dst);
+            CREATE INDEX IF NOT EXISTS legs_trip ON legs (trip_id, seq);
+            CREATE TABLE IF NOT EXISTS leg_messages (
+                message_id TEXT PRIMARY KEY,
+                leg_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS leg_messages_leg ON leg_messages (leg_id);
+            CREATE TABLE IF NOT EXISTS trips (
+                trip_id INTEGER PRIMARY KEY,
+                start_day INTEGER NOT NULL,
+                end_day INTEGER NOT NULL,
+                origin INTEGER NOT NULL,
+                destination INTEGER NOT NULL
+            );
+        """)
+        self.trips: dict[int, Trip] = {}
+        # airport -> sorted (day, trip_id) of the trips starting or ending there
+        self._starts: dict[int, list[tuple[int, int]]] = {}
+        self._ends: dict[int, list[tuple[int, int]]] = {}
+        # Sorted (start_day, trip_id) of every trip, and the longest trip, for range reads
+        self._by_start: list[tuple[int, int]] = []
+        self._max_span = 0
+        # airport -> legs flying out of it
+        self._departures: collections.Counter[int] = collections.Counter(
+            dict(self.conn.execute("SELECT src, COUNT(*) FROM legs GROUP BY src").fetchall()))
+        for row in self.conn.execute("SELECT trip_id, start_day, end_day, origin, destination FROM trips"):
+            self._index(Trip(*row))
+
+    def backfill(self, rows: Iterable[tuple[str, ExtractedFlightInfo | None]]) -> int:
+        """Chains (message_id, result) pairs written before trips were assembled, returns how many."""
+        count = 0
+        for message_id, result in rows:
+            self.apply(message_id, result)
+            count += 1
+        return count
+
+    def _index(self, trip: Trip):
+        self.trips[trip.trip_id] = trip
+        bisect.insort(self._starts.setdefault(trip.origin, []), (trip.start_day, trip.trip_id))
+        bisect.insort(self._ends.setdefault(trip.destination, []), (trip.end_day, trip.trip_id))
+        bisect.insort(self._by_start, (trip.start_day, trip.trip_id))
+        self._max_span = max(self._max_span, trip.end_day - trip.start_day)
+
+    def _unindex(self, trip: Trip):
+        del self.trips[trip.trip_id]
+        for entries, key in ((self._starts[trip.origin], (trip.start_day, trip.trip_id)),
+                             (self._ends[trip.destination], (trip.end_day, trip.trip_id)),
+                             (self._by_start, (trip.start_day, trip.trip_id))):
+            del entries[bisect.bisect_left(entries, key)]
+
+    def _save(self, trip: Trip):
+        self.conn.execute("INSERT OR REPLACE INTO trips (trip_id, start_day, end_day, origin, destination) "
+                          "VALUES (?, ?, ?, ?, ?)", trip)
+        self._index(trip)
+
+    def _replace(self, old: Trip, new: Trip):
+        self._unindex(old)
+        self._save(new)
+
+    def _ending_at(self, airport: int, day: int) -> Trip | None:
+        """Latest open trip ending at `airport` from `max_stay_days` before `day` up to `day`."""
+        entries = self._ends.get(airport, [])
+        low = bisect.bisect_left(entries, (day - self.max_stay_days, -1))
+        for i in range(bisect.bisect_right(entries, (day, float('inf'))) - 1, low - 1, -1):
+            trip = self.trips[entries[i][1]]
+            if not trip.closed():
+                return trip
+        return None
+
+    def _starting_at(self, airport: int, day: int) -> Trip | None:
+        """Earliest open trip starting at `airport` from `day` up to `max_stay_days` after it."""
+        entries = self._starts.get(airport, [])
+        high = bisect.bisect_right(entries, (day + self.max_stay_days, float('inf')))
+        for i in range(bisect.bisect_left(entries, (day, -1)), high):
+            trip = self.trips[entries[i][1]]
+            if not trip.closed():
+                return trip
+        return None
+
+    def home(self) -> int | None:
+        """The airport most legs fly out of, once there are a few of them."""
+        for airport, departures in self._departures.most_common(1):
+            if departures >= MIN_HOME_DEPARTURES:
+                return airport
+        return None
+
+    def _link(self, leg_id: int, leg: Leg):
+        # Trips start and end at home rather than pass through it
+        home = self.home()
+        before = self._ending_at(leg.src, leg.day) if leg.src != home else None
+        after = self._starting_at(leg.dst, leg.day) if leg.dst != home else None
+        if before is not None and leg.dst == before.origin:
+            # The leg flies the trip home, whatever leaves from there later is another trip
+            after = None
+        elif after is not None and leg.src == after.destination:
+            before = None
+        if after == before:
+            after = None
+        if before is None and after is None:
+            trip_id, seq = self.conn.execute("INSERT INTO trips (start_day, end_day, origin, destination) "
+                                             "VALUES (?, ?, ?, ?)", (leg.day, leg.day, leg.src, leg.dst)).lastrowid, 0
+            self._index(Trip(trip_id, leg.day, leg.day, leg.src, leg.dst))
+        elif after is None:
+            trip_id, seq = before.trip_id, self._seq(before.trip_id, 'MAX') + 1
+            self._replace(before, before._replace(end_day=leg.day, destination=leg.dst))
+        elif before is None:
+            trip_id, seq = after.trip_id, self._seq(after.trip_id, 'MIN') - 1
+            self._replace(after, after._replace(start_day=leg.day, origin=leg.src))
+        else:
+            # The leg joins two trips into one, the later one's legs move over behind it
+            trip_id, seq = before.trip_id, self._seq(before.trip_id, 'MAX') + 1
+            self.conn.execute("UPDATE legs SET trip_id = ?, seq = seq + ? WHERE trip_id = ?",
+                              (trip_id, seq + 1 - self._seq(after.trip_id, 'MIN'), after.trip_id))
+            self.conn.execute("DELETE FROM trips WHERE trip_id = ?", (after.trip_id,))
+            self._unindex(after)
+            self._replace(before, before._replace(end_day=after.end_day, destination=after.destination))
+        self.conn.execute("UPDATE legs SET trip_id = ?, seq = ? WHERE leg_id = ?", (trip_id, seq, leg_id))
+        if after is not None:
+            self._split_home(trip_id)
+
+    def _split_home(self, trip_id: int):
+        """
+        Ends a trip at the first leg back at its origin. Legs arrive in any order, so a
+        return flight can be chained to the next trip's outbound one before the outbound
+        flight of its own trip shows where home is.
+        """
+        rows = self.conn.execute("SELECT leg_id, day, flight, src, dst FROM legs WHERE trip_id = ? ORDER BY seq",
+                                 (trip_id,)).fetchall()
+        legs = [(row[0], Leg(*row[1:])) for row in rows]
+        origin = legs[0][1].src
+        home = next((i for i, (_, leg) in enumerate(legs[:-1]) if leg.dst == origin), None)
+        if home is None:
+            return
+        trip = self.trips[trip_id]
+        self._replace(trip, trip._replace(end_day=legs[home][1].day, destination=origin))
+        rest = legs[home + 1:]
+        self.conn.executemany("UPDATE legs SET trip_id = NULL WHERE leg_id = ?", [(leg_id,) for leg_id, _ in rest])
+        for leg_id, leg in rest:
+            self._link(leg_id, leg)
+
+    def _seq(self, trip_id: int, end: str) -> int:
+        """Position of the first (MIN) or last (MAX) leg of a trip."""
+        return self.conn.execute(f"SELECT {end}(seq) FROM legs WHERE trip_id = ?", (trip_id,)).fetchone()[0]
+
+    def _unlink(self, leg_id: int, trip_id: int):
+        """Removes a leg and chains the rest of its trip again, which may split it in two."""
+        self._departures[self.conn.execute("SELECT src FROM legs WHERE leg_id = ?", (leg_id,)).fetchone()[0]] -= 1
+        self.conn.execute("DELETE FROM legs WHERE leg_id = ?", (leg_id,))
+        rest = self.conn.execute("SELECT leg_id, day, flight, src, dst FROM legs WHERE trip_id = ? ORDER BY seq",
+                                 (trip_id,)).fetchall()
+        self.conn.execute("DELETE FROM trips WHERE trip_id = ?", (trip_id,))
+        self._unindex(self.trips[trip_id])
+        self.conn.execute("UPDATE legs SET trip_id = NULL WHERE trip_id = ?", (trip_id,))
+        for row in rest:
+            self._link(row[0], Leg(*row[1:]))
+
+    def _find(self, leg: Leg) -> tuple[int, int] | None:
+        """(leg_id, flight) of the stored leg this one is a duplicate of."""
+        for leg_id, flight in self.conn.execute("SELECT leg_id, flight FROM legs WHERE day = ? AND src = ? AND dst = ?",
+                                                (leg.day, leg.src, leg.dst)):
+            # A reminder that leaves out the flight number is still about the same flight
+            if UNKNOWN_FLIGHT in (flight, leg.flight) or flight == leg.flight:
+                return leg_id, flight
+        return None
+
+    def apply(self, message_id: str, result: ExtractedFlightInfo | None):
+        """Brings the legs and trips up to date with one message's extraction."""
+        leg = normalize_leg(result)
+        row = self.conn.execute("SELECT l.leg_id, l.day, l.flight, l.src, l.dst, l.trip_id FROM leg_messages m "
+                                "JOIN legs l ON l.leg_id = m.leg_id WHERE m.message_id = ?", (message_id,)).fetchone()
+        if row is not None:
+            old_id, old, trip_id = row[0], Leg(*row[1:5]), row[5]
+            if (leg is not None and (leg.day, leg.src, leg.dst) == (old.day, old.src, old.dst) and
+                    UNKNOWN_FLIGHT in (leg.flight, old.flight) or leg == old):
+                if old.flight == UNKNOWN_FLIGHT and leg.flight != UNKNOWN_FLIGHT:
+                    self.conn.execute("UPDATE legs SET flight = ? WHERE leg_id = ?", (leg.flight, old_id))
+                return
+            self.conn.execute("DELETE FROM leg_messages WHERE message_id = ?", (message_id,))
+            if self.conn.execute("SELECT 1 FROM leg_messages WHERE leg_id = ? LIMIT 1", (old_id,)).fetchone() is None:
+                self._unlink(old_id, trip_id)
+        if leg is None:
+            return
+        found = self._find(leg)
+        if found is not None:
+            leg_id, flight = found
+            if flight == UNKNOWN_FLIGHT and leg.flight != UNKNOWN_FLIGHT:
+                self.conn.execute("UPDATE legs SET flight = ? WHERE leg_id = ?", (leg.flight, leg_id))
+        else:
+            leg_id = self.conn.execute("INSERT INTO legs (day, flight, src, dst, passenger_name) VALUES (?, ?, ?, ?, ?)",
+                                       (*leg, result.passenger_name)).lastrowid
+            self._departures[leg.src] += 1
+            self._link(leg_id, leg)
+        self.conn.execute("INSERT INTO leg_messages (message_id, leg_id) VALUES (?, ?)", (message_id, leg_id))
+
+    def _legs(self, trip_ids: list[int]) -> dict[int, list[dict]]:
+        legs: dict[int, list[tuple[int, Leg, str | None]]] = {trip_id: [] for trip_id in trip_ids}
+        placeholders = ','.join('?' * len(trip_ids))
+        for leg_id, day, flight, src, dst, passenger_name, trip_id in self.conn.execute(
+                f"SELECT leg_id, day, flight, src, dst, passenger_name, trip_id FROM legs "
+                f"WHERE trip_id IN ({placeholders}) ORDER BY seq", trip_ids):
+            legs[trip_id].append((leg_id, Leg(day, flight, src, dst), passenger_name))
+        messages: dict[int, list[str]] = {}
+        for message_id, leg_id in self.conn.execute(
+                f"SELECT m.message_id, m.leg_id FROM leg_messages m JOIN legs l ON l.leg_id = m.leg_id "
+                f"WHERE l.trip_id IN ({placeholders}) ORDER BY m.message_id", trip_ids):
+            messages.setdefault(leg_id, []).append(message_id)
+        return {trip_id: [{'flight_takeoff_date': decode_day(leg.day),
+                           'flight_number': decode_flight(leg.flight),
+                           'airport_code_src': decode_airport(leg.src),
+                           'airport_code_dst': decode_airport(leg.dst),
+                           'passenger_name': passenger_name,
+                           'message_ids': messages.get(leg_id, [])}
+                          for leg_id, leg, passenger_name in rows]
+                for trip_id, rows in legs.items()}
+
+    def _view(self, trip: Trip, legs: list[dict]) -> dict:
+        return {'trip_id': trip.trip_id,
+                'start': decode_day(trip.start_day),
+                'end': decode_day(trip.end_day),
+                'origin': decode_airport(trip.origin),
+                'destination': decode_airport(trip.destination),
+                'legs': legs}
+
+    def get(self, trip_id: int) -> dict | None:
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            return None
+        return self._view(trip, self._legs([trip_id])[trip_id])
+
+    def query(self,
+              start: str | None = None,
+              end: str | None = None,
+              airport: str | None = None,
+              cursor: tuple[int, int] | None = None,
+              limit: int = 50) -> tuple[list[dict], tuple[int, int] | None]:
+        """
+        Trips overlapping `start` to `end` (ISO dates, both inclusive) in start order, optionally
+        only those starting or ending at one airport. Returns the page and the (start_day,
+        trip_id) key of its last trip when there are more.
+        """
+        first = encode_day(start) if start is not None else None
+        last = encode_day(end) if end is not None else None
+        if (start is not None and first is None) or (end is not None and last is None):
+            raise ValueError(f"Invalid date range {start!r} to {end!r}")
+        code = encode_airport(airport) if airport is not None else None
+        # A trip overlapping the range starts at most the longest trip's span before it
+        low = bisect.bisect_left(self._by_start, (first - self._max_span, -1)) if first is not None else 0
+        if cursor is not None:
+            low = max(low, bisect.bisect_right(self._by_start, cursor))
+        high = bisect.bisect_right(self._by_start, (last, float('inf'))) if last is not None else len(self._by_start)
+        page: list[Trip] = []
+        more = False
+        for _, trip_id in self._by_start[low:high]:
+            trip = self.trips[trip_id]
+            if first is not None and trip.end_day < first:
+                continue
+            if airport is not None and code not in (trip.origin, trip.destination):
+                continue
+            if len(page) == limit:
+                more = True
+                break
+            page.append(trip)
+        legs = self._legs([trip.trip_id for trip in page]) if page else {}
+        next_key = (page[-1].start_day, page[-1].trip_id) if more else None
+        return [self._view(trip, legs[trip.trip_id]) for trip in page], next_key
+
@@ -0,0 +1,422 @@
+import argparse
+import itertools
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, NamedTuple
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+import metrics
+from compaction import BoilerplateStore, Compactor
+from dedupe import DuplicateIndex
+from gmail_fetch import GmailFetcher
+from message_store import DEFAULT_STORE_DIR, MessageStore
+from model import Extractor
+from pdf_text import PdfPreprocessor
+from pipeline import Pipeline, Stage
+from prefilter import Prefilter
+from ratelimit import QuotaLimiter, TokenBucket
+from routing import DEFAULT_AUDIT_RATE, DEFAULT_LLM_BATCH_SIZE, DEFAULT_LLM_WORKERS, LLM_BATCH_WAIT
+from schemas import AIEmailPayload, ExtractedFlightInfo
+from script import SCOPES, ingest_stages
+from sync import MailboxSync, SyncCheckpointStore
+from tools import save_extraction
+from wiring import build_extractors
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_DB = "mailbox_jobs.db"
+DEFAULT_PROJECT = "default"
+# Gmail API limits: 15,000 quota units per user and 1,200,000 per project each minute
+USER_QUOTA_PER_SECOND = 250
+PROJECT_QUOTA_PER_SECOND = 20_000
+# Messages of one mailbox handled before the next mailbox gets its turn
+DEFAULT_SLICE_SIZE = 500
+DEFAULT_WORKERS = 4
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_STOP = object()
+
+
+class MailboxJob(NamedTuple):
+    user: str
+    token_path: str
+    name: str
+    project: str
+    status: str
+    slices: int
+    listed: int
+    extracted: int
+    quota_units: float
+    error: str | None
+
+
+class MailboxJobStore:
+    """
+    SQLite record of every mailbox to sync and how far its current run got. A run that
+    stops halfway, crash included, leaves its unfinished mailboxes queued or running and
+    the next run picks up only those. Which messages were already handled is kept by the
+    SyncCheckpointStore, so a resumed mailbox does not redo them.
+    """
+
+    def __init__(self, path: str = DEFAULT_JOBS_DB):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS mailboxes (
+                user TEXT PRIMARY KEY,
+                token_path TEXT NOT NULL,
+                name TEXT NOT NULL,
+                project TEXT NOT NULL,
+                status TEXT NOT NULL,
+                slices INTEGER NOT NULL DEFAULT 0,
+                listed INTEGER NOT NULL DEFAULT 0,
+                extracted INTEGER NOT NULL DEFAULT 0,
+                quota_units REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL NOT NULL
+            );
+        """)
+
+    def add(self, user: str, token_path: str, name: str, project: str = DEFAULT_PROJECT):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO mailboxes (user, token_path, name, project, status, updated) "
+                              "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(user) DO UPDATE SET "
+                              "token_path = excluded.token_path, name = excluded.name, project = excluded.project",
+                              (user, token_path, name, project, DONE, time.time()))
+
+    def remove(self, user: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM mailboxes WHERE user = ?", (user,))
+
+    def start_run(self) -> list[MailboxJob]:
+        """
+        Mailboxes of the interrupted run if there is one, otherwise every mailbox, queued
+        with fresh counters.
+        """
+        with self._lock, self.conn:
+            unfinished = self.conn.execute("SELECT COUNT(*) FROM mailboxes WHERE status IN (?, ?)",
+                                           (QUEUED, RUNNING)).fetchone()[0]
+            if unfinished:
+                logger.info("Resuming %d mailboxes of an interrupted run", unfinished)
+                self.conn.execute("UPDATE mailboxes SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+            else:
+                self.conn.execute("UPDATE mailboxes SET status = ?, slices = 0, listed = 0, extracted = 0, "
+                                  "quota_units = 0, error = NULL", (QUEUED,))
+        return [job for job in self.jobs() if job.status == QUEUED]
+
+    def update(self, user: str, **fields):
+        assignments = ', '.join(f"{field} = ?" for field in fields)
+        with self._lock, self.conn:
+            self.conn.execute(f"UPDATE mailboxes SET {assignments}, updated = ? WHERE user = ?",
+                              (*fields.values(), time.time(), user))
+
+    def jobs(self) -> list[MailboxJob]:
+        with self._lock:
+            rows = self.conn.execute("SELECT user, token_path, name, project, status, slices, listed, extracted, "
+                                     "quota_units, error FROM mailboxes ORDER BY user").fetchall()
+        return [MailboxJob(*row) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def load_credentials(token_path: str) -> Credentials:
+    """Stored OAuth token of one user, refreshed if expired. Never starts an interactive login."""
+    creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+    if not creds.valid:
+        if not (creds.expired and creds.refresh_token):
+            raise ValueError(f"{token_path} holds no usable token, log in with script.py first")
+        creds.refresh(Request())
+        with open(token_path, "w") as token:
+            token.write(creds.to_json())
+    return creds
+
+
+class _Mailbox:
+    """Live state of one mailbox during a run."""
+
+    def __init__(self, job: MailboxJob, fetcher: GmailFetcher, sync: MailboxSync, quota: QuotaLimiter,
+                 store: MessageStore, output_dir: pathlib.Path):
+        self.job = job
+        self.fetcher = fetcher
+        self.sync = sync
+        self.quota = quota
+        self.store = store
+        self.output_dir = output_dir
+        # Listing goes on across slices, a new slice picks up where the last one stopped
+        self.ids: Iterator[str] = sync.new_message_ids()
+        self.slices = job.slices
+        self.listed = job.listed
+        self.extracted = job.extracted
+        self.listing_done = False
+        self.failed = False
+        self.committed = False
+        # Payloads handed to the shared extraction and not saved yet
+        self.outstanding = 0
+        self.lock = threading.Lock()
+
+
+class MailboxScheduler:
+    """
+    Syncs many mailboxes with a pool of `workers` threads.
+
+    Mailboxes take turns in a round robin: a worker runs one slice of at most `slice_size`
+    messages of a mailbox through the fetch and parse stages and puts the mailbox back at
+    the end of the line, so one huge inbox gets the same share of workers as a small one.
+    Every Gmail call is charged to its user's and its project's token bucket, sized to
+    Gmail's quotas, and waits rather than run into rate limit errors.
+
+    Payloads of all mailboxes meet in one extraction pipeline, so model batches fill up
+    with requests from many users instead of each user sending small ones. A mailbox's
+    history checkpoint is committed once its listing is done and all its payloads are
+    saved. A payload whose extraction failed keeps the checkpoint where it was, so the
+    next run of that mailbox extracts it again.
+    """
+
+    def __init__(self,
+                 jobs: MailboxJobStore,
+                 extractor: Extractor,
+                 checkpoints: SyncCheckpointStore,
+                 cpu_pool: ProcessPoolExecutor,
+                 pdf_preprocessor: PdfPreprocessor,
+                 compactor: Compactor,
+                 duplicates: DuplicateIndex | None = None,
+                 prefilter: Prefilter | None = None,
+                 output_dir: pathlib.Path = pathlib.Path('./outputs'),
+                 workers: int = DEFAULT_WORKERS,
+                 slice_size: int = DEFAULT_SLICE_SIZE,
+                 user_quota: float = USER_QUOTA_PER_SECOND,
+                 project_quota: float = PROJECT_QUOTA_PER_SECOND,
+                 llm_batch_size: int = DEFAULT_LLM_BATCH_SIZE,
+                 llm_workers: int = DEFAULT_LLM_WORKERS):
+        self.jobs = jobs
+        self.extractor = extractor
+        self.checkpoints = checkpoints
+        self.cpu_pool = cpu_pool
+        self.pdf_preprocessor = pdf_preprocessor
+        self.compactor = compactor
+        self.duplicates = duplicates
+        self.prefilter = prefilter or Prefilter.default()
+        self.output_dir = output_dir
+        self.workers = workers
+        self.slice_size = slice_size
+        self.user_quota = user_quota
+        self.project_quota = project_quota
+        self.llm_batch_size = llm_batch_size
+        self.llm_workers = llm_workers
+        self.projects: dict[str, TokenBucket] = {}
+        self._owners: dict[int, _Mailbox] = {}
+        self._owners_lock = threading.Lock()
+        self._payloads: queue.Queue = queue.Queue(maxsize=1000)
+        self._ready: deque[_Mailbox] = deque()
+        self._running = 0
+        self._ready_changed = threading.Condition()
+
+    def open(self, job: MailboxJob) -> _Mailbox:
+        creds = load_credentials(job.token_path)
+        bucket = self.projects.setdefault(job.project, TokenBucket(self.project_quota))
+        quota = QuotaLimiter(TokenBucket(self.user_quota), bucket)
+        fetcher = GmailFetcher(build("gmail", "v1", credentials=creds), credentials=creds, quota=quota)
+        sync = MailboxSync(fetcher, self.checkpoints, mailbox=job.user)
+        output_dir = self.output_dir / job.user
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return _Mailbox(job, fetcher, sync, quota, MessageStore(os.path.join(DEFAULT_STORE_DIR, job.user)), output_dir)
+
+    def _submit(self, mailbox: _Mailbox, payload: AIEmailPayload) -> None:
+        with self._owners_lock:
+            self._owners[id(payload)] = mailbox
+        with mailbox.lock:
+            mailbox.outstanding += 1
+        self._payloads.put(payload)
+        return None
+
+    def _save(self, result: tuple[AIEmailPayload, ExtractedFlightInfo | None]):
+        payload, schema = result
+        with self._owners_lock:
+            mailbox = self._owners.pop(id(payload))
+        # The retry queue does not know which mailbox a request came from and nothing drains
+        # it here, a failed payload is left unprocessed so the next run lists it again
+        if not self.extractor.failed(payload):
+            save_extraction(mailbox.output_dir, payload, schema)
+            mailbox.sync.mark_processed(payload.id)
+        with mailbox.lock:
+            mailbox.outstanding -= 1
+            mailbox.extracted += 1
+        self._finish(mailbox)
+
+    def _finish(self, mailbox: _Mailbox, abandoned: bool = False):
+        """
+        Commits the mailbox's checkpoint once nothing of it is left to do. With `abandoned`
+        payloads the extraction never returned are given up on instead of waited for.
+        """
+        with mailbox.lock:
+            if mailbox.committed or not mailbox.listing_done or (mailbox.outstanding and not abandoned):
+                return
+            mailbox.committed = True
+        if mailbox.failed:
+            mailbox.sync.flush()
+        elif not mailbox.sync.commit():
+            # Messages dropped on the way keep the old checkpoint, the next run lists them again
+            self.jobs.update(mailbox.job.user, status=FAILED, extracted=mailbox.extracted,
+                             quota_units=mailbox.job.quota_units + mailbox.quota.used,
+                             error=f"{mailbox.sync.unfinished} messages were not processed")
+            logger.warning("Finished %s with %d messages not processed", mailbox.job.user, mailbox.sync.unfinished)
+        else:
+            self.jobs.update(mailbox.job.user, status=DONE, extracted=mailbox.extracted,
+                             quota_units=mailbox.job.quota_units + mailbox.quota.used)
+            logger.info("Finished %s: %d listed, %d extracted", mailbox.job.user, mailbox.listed, mailbox.extracted)
+        mailbox.store.close()
+
+    def run_slice(self, mailbox: _Mailbox) -> bool:
+        """Runs the next slice of a mailbox. Returns whether it has more messages to go."""
+        ids = list(itertools.islice(mailbox.ids, self.slice_size))
+        if ids:
+            stages = ingest_stages(mailbox.fetcher, mailbox.sync, mailbox.store, self.prefilter, self.cpu_pool,
+                                   self.pdf_preprocessor, self.compactor, mailbox.job.name, self.duplicates)
+            stages.append(Stage('handoff', lambda payload: self._submit(mailbox, payload), queue_size=200))
+            Pipeline(ids, stages).run()
+        # Messages filtered out on the way are done, save them so a crash does not repeat them
+        mailbox.sync.flush()
+        mailbox.slices += 1
+        mailbox.listed += len(ids)
+        more = len(ids) == self.slice_size
+        self.jobs.update(mailbox.job.user, slices=mailbox.slices, listed=mailbox.listed, extracted=mailbox.extracted,
+                         quota_units=mailbox.job.quota_units + mailbox.quota.used)
+        metrics.count('mailbox_slices')
+        if not more:
+            with mailbox.lock:
+                mailbox.listing_done = True
+            self._finish(mailbox)
+        return more
+
+    def _work(self):
+        while True:
+            with self._ready_changed:
+                while not self._ready and self._running:
+                    self._ready_changed.wait()
+                if not self._ready:
+                    return
+                mailbox = self._ready.popleft()
+                self._running += 1
+            more = False
+            try:
+                more = self.run_slice(mailbox)
+            except Exception as error:
+                logger.exception("Mailbox %s failed", mailbox.job.user)
+                self.jobs.update(mailbox.job.user, status=FAILED, error=str(error))
+                with mailbox.lock:
+                    mailbox.failed = True
+                    mailbox.listing_done = True
+                self._finish(mailbox)
+            with self._ready_changed:
+                self._running -= 1
+                if more:
+                    self._ready.append(mailbox)
+                self._ready_changed.notify_all()
+
+    def run(self) -> list[MailboxJob]:
+        """Syncs every mailbox due in this run and returns their final state."""
+        mailboxes = []
+        for job in self.jobs.start_run():
+            try:
+                mailboxes.append(self.open(job))
+                self._ready.append(mailboxes[-1])
+                self.jobs.update(job.user, status=RUNNING)
+            except Exception as error:
+                logger.error("Cannot open mailbox %s: %s", job.user, error)
+                self.jobs.update(job.user, status=FAILED, error=str(error))
+
+        extraction = Pipeline(iter(self._payloads.get, _STOP), [
+            # Payloads of every mailbox share model batches
+            Stage('llm', self.extractor.extract_iter, workers=self.llm_workers, queue_size=1000,
+                  batch_size=self.llm_batch_size, batch_wait=LLM_BATCH_WAIT),
+            Stage('output', self._save, queue_size=1000),
+        ])
+        extraction_thread = threading.Thread(target=extraction.run, name='mailbox-extraction', daemon=True)
+        extraction_thread.start()
+        workers = [threading.Thread(target=self._work, name=f'mailbox-worker-{i}', daemon=True)
+                   for i in range(self.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self._payloads.put(_STOP)
+        extraction_thread.join()
+        # Payloads whose extraction never returned were not saved, their mailboxes are still open
+        for mailbox in mailboxes:
+            self._finish(mailbox, abandoned=True)
+        return self.jobs.jobs()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync and extract flights from many mailboxes")
+    parser.add_argument("--db", default=DEFAULT_JOBS_DB)
+    parser.add_argument("--add", metavar="USER", help="register a mailbox, with --token and --name")
+    parser.add_argument("--token", help="authorized user token file of the mailbox being added")
+    parser.add_argument("--name", help="mailbox owner's name given to the model")
+    parser.add_argument("--project", default=DEFAULT_PROJECT, help="Google Cloud project whose quota the token uses")
+    parser.add_argument("--remove", metavar="USER")
+    parser.add_argument("--status", action="store_true", help="show the state of every mailbox and exit")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--slice-size", type=int, default=DEFAULT_SLICE_SIZE)
+    parser.add_argument("--llm-batch-size", type=int, default=DEFAULT_LLM_BATCH_SIZE,
+                        help="most payloads sent to the model in one batch")
+    parser.add_argument("--llm-workers", type=int, default=DEFAULT_LLM_WORKERS, help="sets of payloads in flight at once")
+    parser.add_argument("--audit-rate", type=float, default=DEFAULT_AUDIT_RATE,
+                        help="share of cheaper route results also sent to the strongest model to check them")
+    parser.add_argument("--metrics", help="record stage timings and counters to this file, .json or Prometheus text")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    jobs = MailboxJobStore(args.db)
+    if args.add:
+        if not args.token or not args.name:
+            parser.error("--add needs --token and --name")
+        jobs.add(args.add, args.token, args.name, args.project)
+    if args.remove:
+        jobs.remove(args.remove)
+    if args.add or args.remove or args.status:
+        for job in jobs.jobs():
+            print(f"{job.user}: {job.status}, {job.slices} slices, {job.listed} listed, {job.extracted} extracted, "
+                  f"{job.quota_units:.0f} quota units" + (f", {job.error}" if job.error else ""))
+        jobs.close()
+        raise SystemExit
+
+    checkpoints = SyncCheckpointStore()
+    compactor = Compactor(BoilerplateStore())
+    duplicates = DuplicateIndex()
+    cpu_pool = ProcessPoolExecutor()
+    pdf_preprocessor = PdfPreprocessor(cpu_pool)
+    # The same extractor chain script.py uses, shared by every mailbox
+    chain = build_extractors(duplicates, audit_rate=args.audit_rate)
+    try:
+        scheduler = MailboxScheduler(jobs, chain.extractor, checkpoints, cpu_pool, pdf_preprocessor, compactor, duplicates,
+                                     workers=args.workers, slice_size=args.slice_size,
+                                     llm_batch_size=args.llm_batch_size, llm_workers=args.llm_workers)
+        with metrics.recording(args.metrics):
+            for job in scheduler.run():
+                print(f"{job.user}: {job.status}, {job.listed} listed, {job.extracted} extracted, "
+                      f"{job.quota_units:.0f} quota units")
+    finally:
+        cpu_pool.shutdown()
+        compactor.store.close()
+        chain.close()
+        duplicates.close()
+        checkpoints.close()
+        jobs.close()
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator
+
+from gmail_fetch import GmailFetcher
+
+
+DEFAULT_STORE_DIR = "message_store"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# A stored 'full' copy can answer a 'metadata' or 'minimal' read, 'raw' only answers 'raw'
+FORMAT_RANK = {'minimal': 0, 'metadata': 1, 'full': 2}
+
+
+def format_key(format: str, metadata_headers: list[str] | None = None) -> str:
+    """
+    What a copy is stored under. A 'metadata' copy fetched with `metadata_headers` holds
+    only those headers, so its key names them, like 'metadata:from,subject'.
+    """
+    if format == 'metadata' and metadata_headers:
+        return 'metadata:' + ','.join(sorted({header.lower() for header in metadata_headers}))
+    return format
+
+
+def _split_key(key: str) -> tuple[str, set[str] | None]:
+    format, _, headers = key.partition(':')
+    return format, set(headers.split(',')) if headers else None
+
+
+def format_covers(stored: str, wanted: str) -> bool:
+    if stored == wanted:
+        return True
+    stored_format, stored_headers = _split_key(stored)
+    wanted_format, wanted_headers = _split_key(wanted)
+    if stored_format == wanted_format == 'metadata':
+        # A copy with every header answers any metadata read, one with some only reads of those
+        return stored_headers is None or (wanted_headers is not None and wanted_headers <= stored_headers)
+    return (stored_format in FORMAT_RANK and wanted_format in FORMAT_RANK and
+            FORMAT_RANK[stored_format] >= FORMAT_RANK[wanted_format])
+
+
+class MessageStore:
+    """
+    Content addressed on-disk cache for Gmail message payloads and decoded attachment bytes.
+
+    Blobs are written once per SHA-256 under `root/blobs/` and indexed in SQLite by message id
+    and attachment id, so the same PDF sent in several emails is stored once. Reads return a
+    memoryview over a memory mapped file instead of copying the blob into Python.
+
+    Once the blobs exceed `max_bytes` the least recently read ones are evicted down to
+    `low_watermark` of the limit along with the index rows that point at them.
+    """
+
+    def __init__(self,
+                 root: str = DEFAULT_STORE_DIR,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 low_watermark: float = 0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        self.conn = sqlite3.connect(os.path.join(root, "index.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+            CREATE TABLE IF NOT EXISTS messages (
+                msg_id TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                format TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS attachments (
+                msg_id TEXT NOT NULL,
+                att_id TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                filename TEXT,
+                mime_type TEXT,
+                PRIMARY KEY (msg_id, att_id)
+            );
+            CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+        """)
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    # Blobs
+
+    def put_blob(self, data: bytes | memoryview) -> str:
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha256)
+        with self._lock:
+            exists = self.conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if exists and os.path.exists(path):
+                return sha256
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as blob_file:
+                blob_file.write(data)
+            os.replace(tmp_path, path)
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO blobs (sha256, size, last_access) VALUES (?, ?, ?)",
+                                  (sha256, len(data), time.time()))
+            if not exists:
+                self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return sha256
+
+    def get_blob(self, sha256: str) -> memoryview | None:
+        try:
+            with open(self._blob_path(sha256), "rb") as blob_file:
+                size = os.fstat(blob_file.fileno()).st_size
+                if size == 0:
+                    return memoryview(b"")
+                # The mapping stays valid after the file is closed and is released once
+                # the last view on it goes away
+                mapped = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        self._touched[sha256] = time.time()
+        if len(self._touched) >= 256:
+            self.flush_access_times()
+        return memoryview(mapped)
+
+    def flush_access_times(self):
+        with self._lock, self.conn:
+            touched, self._touched = self._touched, {}
+            self.conn.executemany("UPDATE blobs SET last_access = ? WHERE sha256 = ?",
+                                  ((accessed, sha256) for sha256, accessed in touched.items()))
+
+    def evict(self):
+        self.flush_access_times()
+        target = int(self.max_bytes * self.low_watermark)
+        with self._lock:
+            victims = []
+            freed = 0
+            for sha256, size in self.conn.execute("SELECT sha256, size FROM blobs ORDER BY last_access"):
+                if self.total_bytes - freed <= target:
+                    break
+                victims.append(sha256)
+                freed += size
+            with self.conn:
+                for sha256 in victims:
+                    self.conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                    self.conn.execute("DELETE FROM messages WHERE sha256 = ?", (sha256,))
+                    self.conn.execute("DELETE FROM attachments WHERE sha256 = ?", (sha256,))
+            for sha256 in victims:
+                try:
+                    os.remove(self._blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+            self.total_bytes -= freed
+
+    # Messages
+
+    def put_message(self,
+                    msg_id: str,
+                    message: dict,
+                    format: str = 'full',
+                    metadata_headers: list[str] | None = None) -> str:
+        format = format_key(format, metadata_headers)
+        with self._lock:
+            row = self.conn.execute("SELECT format, sha256 FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()
+        if row is not None and row[0] != format and format_covers(row[0], format):
+            # Never replace a full copy with a thinner one
+            return row[1]
+        sha256 = self.put_blob(json.dumps(message, separators=(',', ':')).encode())
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO messages (msg_id, sha256, format) VALUES (?, ?, ?)",
+                              (msg_id, sha256, format))
+        return sha256
+
+    def get_message_bytes(self,
+                          msg_id: str,
+                          format: str = 'full',
+                          metadata_headers: list[str] | None = None) -> memoryview | None:
+        with self._lock:
+            row = self.conn.execute("SELECT sha256, format FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()
+        if row is None or not format_covers(row[1], format_key(format, metadata_headers)):
+            return None
+        return self.get_blob(row[0])
+
+    def get_message(self,
+                    msg_id: str,
+                    format: str = 'full',
+                    metadata_headers: list[str] | None = None) -> dict | None:
+        data = self.get_message_bytes(msg_id, format, metadata_headers)
+        if data is None:
+            return None
+        with data:
+            return json.loads(data.tobytes())
+
+    def message_ids(self) -> list[str]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT msg_id FROM messages ORDER BY msg_id")]
+
+    def iter_messages(self, format: str = 'full') -> Iterator[dict]:
+        for msg_id in self.message_ids():
+            message = self.get_message(msg_id, format)
+            if message is not None:
+                yield message
+
+    # Attachments
+
+    def put_attachment(self,
+                       msg_id: str,
+                       att_id: str,
+                       data: bytes | memoryview,
+                       filename: str | None = None,
+                       mime_type: str | None = None) -> str:
+        sha256 = self.put_blob(data)
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO attachments (msg_id, att_id, sha256, filename, mime_type) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (msg_id, att_id, sha256, filename, mime_type))
+        return sha256
+
+    def get_attachment(self, msg_id: str, att_id: str) -> memoryview | None:
+        with self._lock:
+            row = self.conn.execute("SELECT sha256 FROM attachments WHERE msg_id = ? AND att_id = ?",
+                                    (msg_id, att_id)).fetchone()
+        return self.get_blob(row[0]) if row else None
+
+    def close(self):
+        self.flush_access_times()
+        self.conn.close()
+
+
+def fetch_through(store: MessageStore,
+                  fetcher: GmailFetcher,
+                  ids: Iterable[str],
+                  format: str = 'full',
+                  metadata_headers: list[str] | None = None) -> Iterator[dict]:
+    """
+    Yields messages from the store and fetches only the ones it is missing, saving them
+    for the next run.
+    """
+    missing: list[str] = []
+    for msg_id in ids:
+        message = store.get_message(msg_id, format, metadata_headers)
+        if message is None:
+            missing.append(msg_id)
+        else:
+            yield message
+    for message in fetcher.fetch(missing, format=format, metadata_headers=metadata_headers):
+        store.put_message(message['id'], message, format, metadata_headers)
+        yield message
@@ -0,0 +1,259 @@
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+from typing import Iterable
+
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached lookup up to a model batch
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0, 300.0, 900.0, 3600.0)
+PROFILE_INTERVAL = 0.01
+PROFILE_DEPTH = 40
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the `q` quantile, like Prometheus' histogram_quantile."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry: 'Registry', name: str, labels: LabelKey):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry._observe(self.name, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def _label_key(labels: dict[str, object]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items())) if labels else ()
+
+
+class Registry:
+    """
+    Counters and latency histograms keyed by metric name and labels.
+
+    Disabled, which is the default, every call returns after one attribute check, and
+    `timer` hands back a shared no-op context manager, so instrumented code pays close to
+    nothing. Enabled, updates take one lock. Everything is exported as Prometheus text
+    exposition format or as JSON.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: dict[str, dict[LabelKey, float]] = {}
+        self.histograms: dict[str, dict[LabelKey, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def _observe(self, name: str, key: LabelKey, value: float):
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            self._observe(name, _label_key(labels), value)
+
+    def timer(self, name: str, **labels):
+        """Context manager that records how long its block took into the `name` histogram."""
+        if not self.enabled:
+            return _NOOP_TIMER
+        return _Timer(self, name, _label_key(labels))
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                'counters': {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                             for name, series in self.counters.items()},
+                'histograms': {name: [{'labels': dict(key),
+                                       'count': histogram.count,
+                                       'sum': round(histogram.sum, 6),
+                                       'p50': histogram.quantile(0.5),
+                                       'p99': histogram.quantile(0.99),
+                                       'buckets': dict(zip([*map(str, histogram.buckets), '+Inf'], histogram.counts))}
+                                      for key, histogram in series.items()]
+                               for name, series in self.histograms.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        def render(key: LabelKey, extra: tuple[tuple[str, str], ...] = ()) -> str:
+            pairs = key + extra
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+        lines: list[str] = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                lines += [f'{name}{render(key)} {value}' for key, value in series.items()]
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{render(key, (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_bucket{render(key, (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{render(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{render(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Writes JSON to a .json path and Prometheus text, for node_exporter's textfile collector, otherwise."""
+        with open(path, 'w') as output:
+            if path.endswith('.json'):
+                json.dump(self.to_json(), output, indent=2)
+            else:
+                output.write(self.to_prometheus())
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every other thread each `interval` seconds and counts the stacks
+    seen, written out in the collapsed format flamegraph.pl and speedscope read. Costs
+    nothing until started.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, depth: int = PROFILE_DEPTH):
+        self.interval = interval
+        self.depth = depth
+        self.samples: collections.Counter[str] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path: str):
+        with open(path, 'w') as output:
+            for stack, count in self.samples.most_common():
+                output.write(f'{stack} {count}\n')
+
+
+REGISTRY = Registry()
+
+count = REGISTRY.count
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+
+
+@contextlib.contextmanager
+def recording(metrics_path: str | None = None, profile_path: str | None = None):
+    """
+    Turns on the default registry for the block when `metrics_path` is given and samples
+    stacks when `profile_path` is given, and writes both out when the block ends.
+    """
+    profiler = SamplingProfiler() if profile_path else None
+    if metrics_path:
+        REGISTRY.enable()
+    if profiler is not None:
+        profiler.start()
+    try:
+        yield REGISTRY
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(profile_path)
+            logger.info("Wrote %d stack samples to %s", sum(profiler.samples.values()), profile_path)
+        if metrics_path:
+            REGISTRY.write(metrics_path)
+            REGISTRY.disable()
+            logger.info("Wrote metrics to %s", metrics_path)
@@ -1,23 +1,32 @@
 import json
-import time
-from typing import Any, Generic, Type, TypeVar, Optional
+from typing import Any, Generic, Iterable, Iterator, Type, TypeVar, Optional
 import typing
 import anthropic
 import dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from anthropic import Anthropic
 import abc
 import logging
 
-from schemas import AIEmailPayload, Attachment, ExtractedFlightInfo, Promptable, SanityCheck
+import metrics
+from batch_scheduler import BatchScheduler
+from retry_queue import INVALID_JSON, REPAIRABLE, SCHEMA_FAILURE, SUCCEEDED, RetryQueue
+from schemas import AIEmailPayload, CompiledPrompt, ExtractedFlightInfo, Promptable, SanityCheck
 import dotenv
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 # Generic type variable for the schema
 ExtractorSchemaT = TypeVar('ExtractorSchemaT', bound=Promptable)
 
+# Batch item errors that come back the same however often the request is sent
+PERMANENT_ERRORS = {'invalid_request_error', 'authentication_error', 'permission_error', 'not_found_error',
+                    'request_too_large'}
+# Validation errors quoted back in a repair prompt are cut to this length
+MAX_REPAIR_ERROR_CHARS = 1000
+
 class Extractor(Generic[ExtractorSchemaT], abc.ABC):
     """
     Base class for email extractors that parse emails into structured data using LLMs.
@@ -27,10 +36,11 @@ class Extractor(Generic[ExtractorSchemaT], abc.ABC):
     def __init__(self, schema_class: Type[ExtractorSchemaT]):
         self.model_name: str = "base"
         self.SCHEMA_PROMPT = schema_class
+        self.prompt: CompiledPrompt = schema_class.compile_prompt()
     
     @abc.abstractmethod
     def extract(self,
-                payloads: list[AIEmailPayload]) -> ExtractorSchemaT:
+                payloads: list[AIEmailPayload]) -> list[ExtractorSchemaT | None]:
         """
         Extract structured information from email content into a Pydantic model.
         
@@ -38,175 +48,254 @@ class Extractor(Generic[ExtractorSchemaT], abc.ABC):
             payloads: Raw email content as string + attachments
             
         Returns:
-            Parsed data in specified Pydantic schema
+            Parsed data in specified Pydantic schema for each payload, in payload order.
+            None when nothing could be extracted from a payload
         """
         pass
 
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Yields (payload, result) pairs. Extractors that can return results before the whole
+        set is done override this, the default just runs extract.
+        """
+        payloads = list(payloads)
+        yield from zip(payloads, self.extract(payloads))
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        """
+        Whether a None result for this payload means the extraction failed, rather than
+        that there was nothing to extract. Failed results must not be cached.
+        """
+        return False
+
     def get_meta_schema(self) -> dict:
-        properties = self.SCHEMA_PROMPT.model_json_schema()['properties']
-        toReturn = {}
-        for k,v in properties.items():
-            toReturn[k] = {'types' : [v['type']] if 'type' in v else [p['type'] for p in v['anyOf']]}
-            if ("description" in v):
-                toReturn[k]['description'] = v['description']
-        print(toReturn)
-        return toReturn 
+        return self.prompt.meta_schema
 
 class ClaudeExtractor(Extractor[ExtractorSchemaT]):
     def __init__(self, 
                  schema_class: Type[ExtractorSchemaT],
                  api_key: str | None = None, 
-                 model: str = "claude-3-haiku-20240307"):
+                 model: str = "claude-3-haiku-20240307",
+                 scheduler: BatchScheduler | None = None,
+                 retry_queue: RetryQueue | None = None,
+                 repair: bool = True,
+                 max_tokens: int = 512):
         super().__init__(schema_class=schema_class)
         self.model_name = model
+        self.max_tokens = max_tokens
         self.client = Anthropic(api_key=api_key)
-        
-    def extract(self,
-                payloads: list[AIEmailPayload]
-                ) -> list[ExtractorSchemaT | None]:
-        requests = []
-        idx = 0
-
-        print(f"Received {len(payloads)} requests")
-
-        for payload in payloads:  
-            ai_payload = []
-
-            if payload.attachments:
-                for attachment in payload.attachments:
-                    pdf_block = {
-                        "type" : "document",
-                        "source": {
-                            "type" : "base64",
-                            "media_type": "application/pdf",
-                            "data": attachment.to_base64()
-                        }
+        self.scheduler = scheduler or BatchScheduler(self.client)
+        self.retry_queue = retry_queue or RetryQueue()
+        # Send unparsable or invalid replies back to the model with the error on retry
+        self.repair = repair
+        # Payload id -> outcome of the last attempt, for the requests that were given up on and
+        # not answered since
+        self.failures: dict[str, str] = {}
+        # Tokens used by the replies this extractor read
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def build_params(self, payload: AIEmailPayload) -> dict:
+        with metrics.timer('request_build_seconds', model=self.model_name):
+            return self._build_params(payload)
+
+    def _build_params(self, payload: AIEmailPayload) -> dict:
+        ai_payload = []
+
+        if payload.attachments:
+            for attachment in payload.attachments:
+                pdf_block = {
+                    "type" : "document",
+                    "source": {
+                        "type" : "base64",
+                        "media_type": "application/pdf",
+                        "data": attachment.to_base64()
                     }
-                    ai_payload.append(pdf_block)
-                
-            ai_payload.append({'type':'text', 'text': self.SCHEMA_PROMPT.get_user_prompt(content=payload.text_context)})   
-            requests.append(
-                {
-                    "custom_id": payload.id,
-                    "params": {
-                        "model": self.model_name,
-                        "max_tokens": 512,
-                        "temperature": 0,
-                        "top_p" : 1,
-                        "system" : self.SCHEMA_PROMPT.get_system_prompt(self.get_meta_schema()),
-                        "messages": [{"role": "user", "content": ai_payload},
-                                     # Claude prefill output, starts next token prediction from {
-                                     {"role": "assistant", "content": "{"}],
-                    },
                 }
-            )
-            idx += 1
-        
-        print(f"Sending {len(requests)} requests")
+                ai_payload.append(pdf_block)
+            
+        ai_payload.append({'type':'text', 'text': self.SCHEMA_PROMPT.get_user_prompt(content=payload.text_context)})   
+        return {
+            "model": self.model_name,
+            "max_tokens": self.max_tokens,
+            "temperature": 0,
+            "top_p" : 1,
+            # Static block marked for prompt caching, the same for every request of this schema
+            "system" : self.prompt.system_blocks,
+            "messages": [{"role": "user", "content": ai_payload},
+                         # Claude prefill output, starts next token prediction from {
+                         {"role": "assistant", "content": "{"}],
+        }
 
-        messages = self.client.beta.messages.batches.create(
-            requests=requests
-        )
+    def parse_response(self, text: str) -> ExtractorSchemaT | None:
+        prefill = '{'
+        unvalidated = prefill + text
+        logger.debug("Unvalidated response: %s", unvalidated)
+        with metrics.timer('result_validation_seconds', model=self.model_name):
+            unvalidated = json.loads(unvalidated)
+            if unvalidated == {}:
+                return None
+            return self.SCHEMA_PROMPT.model_validate(unvalidated)
 
-        while True:
-            time.sleep(10)
-            print("Pinging batch service")
-            status = self.client.beta.messages.batches.retrieve(messages.id)
-            print(f"Status: {status}")
-            if status.processing_status == "ended":
-                break
+    def read_reply(self, text: str) -> tuple[str, ExtractorSchemaT | None, str | None]:
+        """(outcome, result, error) of one reply, a reply that cannot be used does not raise."""
+        try:
+            return SUCCEEDED, self.parse_response(text), None
+        except ValidationError as error:
+            return SCHEMA_FAILURE, None, str(error)
+        except ValueError as error:
+            return INVALID_JSON, None, str(error)
 
-        result_stream = self.client.beta.messages.batches.results(messages.id)
+    def repair_params(self, params: dict, reply: str, error: str) -> dict:
+        """The original request followed by the unusable reply and what was wrong with it."""
+        messages = params["messages"][:-1] + [
+            {"role": "assistant", "content": ("{" + reply).rstrip()},
+            {"role": "user", "content": "That reply could not be used: " + error[:MAX_REPAIR_ERROR_CHARS] +
+                                        "\nReply again with only the JSON object, following the schema exactly."},
+            {"role": "assistant", "content": "{"},
+        ]
+        return {**params, "messages": messages}
 
-        payload_output: list[ExtractorSchemaT | None] = []
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return payload.id in self.failures
 
-        for response in result_stream:
-            response_content = response.result.model_dump()
-            prefill = '{'
-            unvalidated = prefill + response_content['message']['content'][0]['text']
-            print(f"Unvalidated Batch Response: {unvalidated}")
-            unvalidated = json.loads(unvalidated)
-            if unvalidated == {}:
-                payload_output.append(None)
+    def failure(self, payload: AIEmailPayload) -> str | None:
+        """Outcome of the last attempt when the request was given up on, otherwise None."""
+        return self.failures.get(payload.id)
+
+    def _settle(self,
+                payload: AIEmailPayload,
+                params: dict,
+                retried: bool,
+                outcome: str,
+                result: ExtractorSchemaT | None,
+                error: str | None = None,
+                reply: str | None = None,
+                retryable: bool = True) -> dict | None:
+        """
+        Books the outcome of one attempt. Returns the params to send next when the request
+        is to be retried, otherwise None and the result is final.
+        """
+        metrics.count('results', outcome=outcome if outcome != SUCCEEDED or result is not None else 'empty')
+        if outcome == SUCCEEDED:
+            self.failures.pop(payload.id, None)
+            if retried:
+                metrics.count('retries_recovered')
+            # A fresh submission may answer what an earlier run left pending or dead
+            self.retry_queue.resolve(payload.id)
+            return None
+        if self.retry_queue.record_failure(payload.id, params, outcome, error, reply, retryable, fresh=not retried):
+            metrics.count('retries', outcome=outcome)
+            if self.repair and outcome in REPAIRABLE:
+                return self.repair_params(params, reply or '', error or outcome)
+            return params
+        logger.warning("Giving up on %s after %s: %s", payload.id, outcome, error)
+        self.failures[payload.id] = outcome
+        return None
+
+    def _read_batch_result(self, response) -> tuple[str, ExtractorSchemaT | None, str | None, str | None, bool]:
+        """(outcome, result, error, reply text, retryable) of one batch result."""
+        if response.result.type != "succeeded":
+            error = getattr(getattr(response.result, 'error', None), 'error', None)
+            retryable = getattr(error, 'type', None) not in PERMANENT_ERRORS
+            return response.result.type, None, getattr(error, 'message', None), None, retryable
+        self.record_usage(getattr(response.result.message, 'usage', None), route='batch')
+        text = response.result.message.content[0].text
+        outcome, result, error = self.read_reply(text)
+        return outcome, result, error, text, True
+
+    def record_usage(self, usage, route: str):
+        # Usage block of a Messages response, batch and real time results carry the same one
+        if usage is None:
+            return
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        metrics.count('model_input_tokens', usage.input_tokens, model=self.model_name, route=route)
+        metrics.count('model_output_tokens', usage.output_tokens, model=self.model_name, route=route)
+        metrics.count('model_cache_read_tokens', getattr(usage, 'cache_read_input_tokens', None) or 0,
+                      model=self.model_name, route=route)
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Streams (payload, result) pairs as each batch shard ends, in completion order.
+        Payloads are read lazily so the caller can feed a generator.
+        """
+        def requests() -> Iterator[tuple[AIEmailPayload, dict, dict]]:
+            for payload in payloads:
+                # A payload sent again, as the daemon does, is judged by this attempt alone
+                self.failures.pop(payload.id, None)
+                params = self.build_params(payload)
+                yield payload, params, params
+
+        yield from self._run(requests(), retried=False)
+
+    def _run(self,
+             requests: Iterable[tuple[AIEmailPayload, dict, dict]],
+             retried: bool
+             ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Sends (payload, original params, params to send) through the batch API. Items that
+        fail are recorded in the retry queue and only they go into a follow-up batch, until
+        they succeed or run out of attempts.
+        """
+        # Payload ids are file names or Gmail ids and may not be valid custom_ids, so requests
+        # are numbered and mapped back
+        by_custom_id: dict[str, tuple[AIEmailPayload, dict]] = {}
+
+        def batch_requests() -> Iterator[dict]:
+            for idx, (payload, params, send) in enumerate(requests):
+                custom_id = str(idx)
+                by_custom_id[custom_id] = (payload, params)
+                yield {"custom_id": custom_id, "params": send}
+
+        retry: list[tuple[AIEmailPayload, dict, dict]] = []
+        for response in self.scheduler.stream(batch_requests()):
+            payload, params = by_custom_id.pop(response.custom_id)
+            outcome, result, error, reply, retryable = self._read_batch_result(response)
+            send = self._settle(payload, params, retried, outcome, result, error, reply, retryable)
+            if send is not None:
+                retry.append((payload, params, send))
             else:
-                parsed_obj = self.SCHEMA_PROMPT.model_validate(unvalidated)
-                payload_output.append(parsed_obj)
-        return payload_output
-    
+                yield payload, result
+        if retry:
+            logger.info("Retrying %d failed requests in a follow-up batch", len(retry))
+            yield from self._run(retry, retried=True)
 
+    def retry_pending(self) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Resubmits the requests a previous run left in the retry queue. The payloads yielded
+        only carry their id, their text is not kept.
+        """
+        def requests() -> Iterator[tuple[AIEmailPayload, dict, dict]]:
+            for failed in self.retry_queue.pending():
+                payload = AIEmailPayload(text_context={}, attachments=None, id=failed.payload_id)
+                send = failed.params
+                if self.repair and failed.outcome in REPAIRABLE:
+                    send = self.repair_params(failed.params, failed.reply or '', failed.error or failed.outcome)
+                yield payload, failed.params, send
+
+        yield from self._run(requests(), retried=True)
 
-class DeepSeekExtractor(Extractor[ExtractorSchemaT]):
-    def __init__(self, 
-                 schema_class: Type[ExtractorSchemaT],
-                 api_key: str | None = None, 
-                 model: str = "claude-3-5-sonnet-latest"):
-        super().__init__(schema_class=schema_class)
-        self.model_name = model
-        self.client = Anthropic(api_key=api_key)
-        
     def extract(self,
-                text_payloads: list[dict[str, str]], 
-                attachment_payloads: list[list[Attachment]]
-                ) -> list[ExtractorSchemaT]:
-        requests = []
-        idx = 0
-
-        for content, attachments_in_payload in zip(text_payloads, attachment_payloads):  
-            ai_payload = []
-
-            if attachments_in_payload:
-                for attachment in attachments_in_payload:
-                    pdf_block = {
-                        "type" : "document",
-                        "source": {
-                            "type" : "base64",
-                            "media_type": "application/pdf",
-                            "data": attachment.to_base64()
-                        }
-                    }
-                    ai_payload.append(pdf_block)
-                
-            ai_payload.append({'type':'text', 'text': self.SCHEMA_PROMPT.get_user_prompt(content=content)})   
-            requests.append(
-                {
-                    "custom_id": f"{idx}",
-                    "params": {
-                        "model": "claude-3-5-sonnet-latest",
-                        "max_tokens": 1024,
-                        "system" : self.SCHEMA_PROMPT.get_system_prompt(self.get_meta_schema()),
-                        "messages": [{"role": "user", "content": ai_payload}],
-                    },
-                }
-            )
-            idx += 1
-        
-        print(f"Requests {requests}")
-        messages = self.client.beta.messages.batches.create(
-            requests=requests
-        )
-
-        while True:
-            time.sleep(5)
-            logging.info("Pinging batch service")
-            status = self.client.beta.messages.batches.retrieve(messages.id)
-            if status.processing_status == "ended":
-                break
-
-        result_stream = self.client.beta.messages.batches.results(messages.id)
-
-        payload_output: list[ExtractorSchemaT] = []
-
-        for response in result_stream:
-            response_content = response.result.model_dump()
-            unvalidated = json.loads(response_content['message']['content'][0]['text'])
-            logging.debug(f"Unvalidated Batch Response: {unvalidated}")
-            parsed_obj = self.SCHEMA_PROMPT.model_validate_json(unvalidated)
-            payload_output.append(parsed_obj)
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractorSchemaT | None]:
+        logger.info("Received %d requests", len(payloads))
+
+        position = {id(payload): i for i, payload in enumerate(payloads)}
+        payload_output: list[ExtractorSchemaT | None] = [None] * len(payloads)
+        for payload, parsed_obj in self.extract_iter(payloads):
+            payload_output[position[id(payload)]] = parsed_obj
         return payload_output
+    
+
 
 if __name__ == "__main__":
     extractor = ClaudeExtractor(schema_class=ExtractedFlightInfo)
-    payloads = [{'name': "Shrey Patel", 'html_text': "Train Ticket, Depart January 5th 2024 Arrive January 6th 2027"}]
-    attachments = [[]]
-    op = extractor.extract(text_payloads=payloads, attachment_payloads=attachments)
+    payload = AIEmailPayload(text_context={'name': "Shrey Patel", 'html_text': "Train Ticket, Depart January 5th 2024 Arrive January 6th 2027"},
+                             attachments=None, id='example')
+    print(extractor.extract([payload]))
 
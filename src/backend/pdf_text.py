@@ -0,0 +1,135 @@
+import io
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import NamedTuple
+
+from pdfreader import SimplePDFViewer
+
+from schemas import AIEmailPayload, Attachment
+
+
+logger = logging.getLogger(__name__)
+
+# Rough input cost of a PDF document block, each page goes in as both text and an image
+PDF_PAGE_TOKENS = 1500
+CHARS_PER_TOKEN = 4
+
+# Below this a page is scanned, image only or just a logo and a barcode
+MIN_CHARS_PER_PAGE = 100
+MIN_PRINTABLE_RATIO = 0.95
+MIN_WORD_RATIO = 0.4
+# Text layers that place every glyph on its own come out as one or two letter tokens
+MIN_AVERAGE_TOKEN_LENGTH = 2.5
+MAX_PAGES = 30
+
+_WORD_RE = re.compile(r'[^\W\d_]{2,}')
+
+
+class PdfText(NamedTuple):
+    text: str
+    pages: int
+    usable: bool
+
+
+def text_is_usable(text: str, pages: int) -> bool:
+    """
+    Whether an extracted text layer can stand in for the PDF: enough text per page, almost
+    all of it printable, and mostly made of words rather than glyph soup.
+    """
+    if pages == 0 or len(text) < MIN_CHARS_PER_PAGE * pages:
+        return False
+    printable = sum(1 for ch in text if ch.isprintable() or ch in '\n\t') - text.count('�')
+    if printable / len(text) < MIN_PRINTABLE_RATIO:
+        return False
+    tokens = text.split()
+    if not tokens or sum(len(token) for token in tokens) / len(tokens) < MIN_AVERAGE_TOKEN_LENGTH:
+        return False
+    words = sum(1 for token in tokens if _WORD_RE.search(token))
+    return words / len(tokens) >= MIN_WORD_RATIO
+
+
+def extract_pdf_text(data: bytes, max_pages: int = MAX_PAGES) -> PdfText:
+    """
+    Reads the text layer of a PDF. Runs in a worker process, so it takes and returns plain
+    picklable values. PDFs that fail to parse or run past `max_pages` are never usable.
+    """
+    try:
+        viewer = SimplePDFViewer(io.BytesIO(data))
+        pages = []
+        for canvas in viewer:
+            if len(pages) == max_pages:
+                return PdfText('', len(pages) + 1, False)
+            pages.append('\n'.join(fragment.strip() for fragment in canvas.strings if fragment.strip()))
+    except Exception as error:
+        logger.debug("Could not read PDF text layer: %s", error)
+        return PdfText('', 0, False)
+    text = '\n\n'.join(pages)
+    return PdfText(text, len(pages), text_is_usable(text, len(pages)))
+
+
+class PdfPreprocessor:
+    """
+    Swaps PDF attachments that have a good text layer for their text, so the model reads a
+    few hundred tokens instead of a document block. Scanned and image only PDFs stay
+    attached. Text layers are read in `pool`, a process pool, and kept per SHA-256 so the
+    same PDF is only read once. Bytes and estimated tokens saved are counted for the run.
+    """
+
+    def __init__(self, pool: Executor, cache_size: int = 1024):
+        self.pool = pool
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, PdfText] = OrderedDict()
+        self._lock = threading.Lock()
+        self.pdfs = 0
+        self.converted = 0
+        self.bytes_saved = 0
+        self.tokens_saved = 0
+
+    def _read(self, attachment: Attachment) -> PdfText:
+        with self._lock:
+            cached = self._cache.get(attachment.sha256)
+            if cached is not None:
+                self._cache.move_to_end(attachment.sha256)
+                return cached
+        result = self.pool.submit(extract_pdf_text, attachment.data.tobytes()).result()
+        with self._lock:
+            self._cache[attachment.sha256] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def process_payload(self, payload: AIEmailPayload) -> AIEmailPayload:
+        if not payload.attachments:
+            return payload
+        kept: list[Attachment] = []
+        texts: list[str] = []
+        for attachment in payload.attachments:
+            result = self._read(attachment)
+            with self._lock:
+                self.pdfs += 1
+                if result.usable:
+                    self.converted += 1
+                    self.bytes_saved += len(attachment)
+                    self.tokens_saved += result.pages * PDF_PAGE_TOKENS - len(result.text) // CHARS_PER_TOKEN
+            if result.usable:
+                texts.append(f"{attachment.filename or 'attachment.pdf'}:\n{result.text}")
+            else:
+                kept.append(attachment)
+        if not texts:
+            return payload
+        text_context = {**payload.text_context, 'attachment_text': '\n\n'.join(texts)}
+        return AIEmailPayload(text_context=text_context, attachments=kept or None, id=payload.id, sender=payload.sender,
+                              prefilter_score=payload.prefilter_score, original_text=payload.original_text)
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                'pdfs': self.pdfs,
+                'converted_to_text': self.converted,
+                'sent_as_document': self.pdfs - self.converted,
+                'bytes_saved': self.bytes_saved,
+                'tokens_saved': self.tokens_saved,
+            }
@@ -0,0 +1,250 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StageStats:
+    """Counters for one stage, updated by all of its workers."""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.received = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.errors = 0
+        # Time spent in the stage function, and time spent waiting on a full downstream queue
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self, elapsed: float, queue_depth: int | None = None) -> dict:
+        with self._lock:
+            return {
+                'stage': self.name,
+                'workers': self.workers,
+                'received': self.received,
+                'emitted': self.emitted,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'per_second': round(self.received / elapsed, 1) if elapsed > 0 else 0.0,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'blocked_seconds': round(self.blocked_seconds, 3),
+                'queue_depth': queue_depth,
+            }
+
+
+class Stage:
+    """
+    One step of a Pipeline run by `workers` threads reading from a queue of at most
+    `queue_size` items.
+
+    `fn` takes one item and returns the item to pass on, or None to drop it. With a
+    `batch_size` it takes a list of up to that many items instead, gathered for at most
+    `batch_wait` seconds, and returns an iterable of outputs that are passed on as they
+    are produced.
+    """
+
+    def __init__(self,
+                 name: str,
+                 fn: Callable[[Any], Any],
+                 workers: int = 1,
+                 queue_size: int = 100,
+                 batch_size: int | None = None,
+                 batch_wait: float = 1.0):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stats = StageStats(name, workers)
+
+
+class Pipeline:
+    """
+    Runs items from `source` through a chain of stages joined by bounded queues.
+
+    Every stage has its own worker threads, so network, CPU and model waits in different
+    stages overlap. A full queue blocks the stage feeding it, which keeps the number of
+    items in memory bounded by the queue sizes however long the source is. Stage counters
+    and queue depths are logged every `report_interval` seconds and returned by `run`.
+
+    An item whose stage function raises is logged, counted as an error and dropped. An
+    error in the source stops the whole pipeline and is raised from `run`.
+    """
+
+    def __init__(self, source: Iterable, stages: list[Stage], report_interval: float = 30.0):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.source = source
+        self.stages = stages
+        self.report_interval = report_interval
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self.source_stats = StageStats('source', 1)
+        self._running = [stage.workers for stage in stages]
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error: BaseException | None = None
+        self._started = time.monotonic()
+
+    def _put(self, target: queue.Queue, item: Any) -> float:
+        # Gives up once the pipeline is stopping instead of blocking on a full queue forever,
+        # returns how long the put was blocked
+        start = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        return time.monotonic() - start
+
+    def _get(self, source: queue.Queue, timeout: float | None = None) -> Any:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._stop.is_set():
+            wait = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if wait <= 0:
+                raise queue.Empty
+            try:
+                return source.get(timeout=wait)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _take(self, stage: Stage, inbox: queue.Queue) -> list | None:
+        """Next item, or batch of items, for a worker. None once the stage's input is done."""
+        first = self._get(inbox)
+        if first is _DONE:
+            # Put the marker back for the other workers of this stage
+            self._put(inbox, _DONE)
+            return None
+        items = [first]
+        if stage.batch_size is None:
+            return items
+        deadline = time.monotonic() + stage.batch_wait
+        while len(items) < stage.batch_size:
+            try:
+                item = self._get(inbox, timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if item is _DONE:
+                self._put(inbox, _DONE)
+                break
+            items.append(item)
+        return items
+
+    def _feed(self):
+        try:
+            for item in self.source:
+                if self._stop.is_set():
+                    return
+                blocked = self._put(self.queues[0], item)
+                self.source_stats.add(emitted=1, blocked_seconds=blocked)
+        except BaseException as error:
+            self._fail(error)
+        finally:
+            self._put(self.queues[0], _DONE)
+
+    def _work(self, index: int):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        try:
+            while True:
+                items = self._take(stage, inbox)
+                if items is None:
+                    return
+                stage.stats.add(received=len(items))
+                start = time.monotonic()
+                blocked = 0.0
+                emitted = 0
+                dropped = 0
+                try:
+                    outputs = stage.fn(items) if stage.batch_size is not None else [stage.fn(items[0])]
+                    for output in outputs:
+                        # Whatever the last stage returns is discarded, None only means dropped mid pipeline
+                        if output is None and outbox is not None:
+                            dropped += 1
+                            continue
+                        emitted += 1
+                        if outbox is not None:
+                            blocked += self._put(outbox, output)
+                except Exception:
+                    logger.exception("Stage %s failed on %d item(s)", stage.name, len(items))
+                    stage.stats.add(errors=len(items))
+                busy = time.monotonic() - start - blocked
+                stage.stats.add(emitted=emitted,
+                                dropped=dropped,
+                                busy_seconds=busy,
+                                blocked_seconds=blocked)
+                metrics.observe('pipeline_stage_seconds', busy, stage=stage.name)
+                metrics.count('pipeline_items', len(items), stage=stage.name)
+        finally:
+            with self._running_lock:
+                self._running[index] -= 1
+                last = self._running[index] == 0
+            # The last worker out tells the next stage nothing more is coming
+            if last and outbox is not None:
+                self._put(outbox, _DONE)
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _report(self, done: threading.Event):
+        while not done.wait(self.report_interval):
+            for stats in self.stats():
+                logger.info("%(stage)s: %(received)d in, %(emitted)d out, %(errors)d errors, "
+                            "%(per_second).1f/s, queue %(queue_depth)s", stats)
+
+    def stats(self) -> list[dict]:
+        elapsed = time.monotonic() - self._started
+        source = self.source_stats.snapshot(elapsed)
+        source['per_second'] = round(source['emitted'] / elapsed, 1) if elapsed > 0 else 0.0
+        return [source] + [stage.stats.snapshot(elapsed, stage_queue.qsize())
+                           for stage, stage_queue in zip(self.stages, self.queues)]
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self) -> list[dict]:
+        """Runs until every item has gone through every stage and returns the final stats."""
+        self._started = time.monotonic()
+        threads = [threading.Thread(target=self._feed, name='pipeline-source', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=self._work, args=(index,), name=f'pipeline-{stage.name}', daemon=True)
+                        for _ in range(stage.workers)]
+        reporter_done = threading.Event()
+        reporter = threading.Thread(target=self._report, args=(reporter_done,), name='pipeline-report', daemon=True)
+
+        for thread in threads:
+            thread.start()
+        reporter.start()
+        try:
+            for thread in threads:
+                # Joined with a timeout so KeyboardInterrupt still reaches the main thread
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except BaseException as error:
+            self._fail(error)
+            raise
+        finally:
+            reporter_done.set()
+        if self._error is not None:
+            raise self._error
+        return self.stats()
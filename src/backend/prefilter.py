@@ -0,0 +1,210 @@
+import functools
+import re
+from typing import Iterable, Iterator, NamedTuple
+
+from firstpass import common_patterns, flight_keywords, get_airline_names
+
+
+# Headers the prefilter reads, pass these as metadataHeaders when fetching in metadata format
+PREFILTER_HEADERS = ['Subject', 'From']
+
+CATEGORY_WEIGHTS = {
+    'booking_terms': 2.0,
+    'flight_identifiers': 2.0,
+    'timing_terms': 1.5,
+    'location_terms': 0.5,
+    'document_terms': 2.0,
+    'action_terms': 1.0,
+    'passenger_terms': 1.0,
+    'airline': 3.0,
+}
+
+# Same order as firstpass.common_patterns. Airport codes match any three capital letters so
+# they count for very little on their own
+PATTERN_NAMES = ['flight_number', 'airport_code', 'time', 'booking_reference', 'ticket_number']
+PATTERN_WEIGHTS = {
+    'flight_number': 3.0,
+    'airport_code': 0.25,
+    'time': 0.5,
+    'booking_reference': 1.0,
+    'ticket_number': 2.0,
+}
+PDF_ATTACHMENT_WEIGHT = 2.0
+DEFAULT_THRESHOLD = 4.0
+
+# Airline names shorter than this are mostly noise ("L", "88", "Zz") and are not matched
+MIN_AIRLINE_NAME_LENGTH = 4
+
+
+class AhoCorasick:
+    """
+    Multi-pattern matcher that finds every occurrence of every pattern in one pass over
+    the text. Patterns are matched case insensitively on whole words only. A pattern
+    edge that is not a letter or digit, like the "#" of "flight #", is its own boundary
+    and may touch a word.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: list[str] = []
+        goto: list[dict[str, int]] = [{}]
+        outputs: list[list[int]] = [[]]
+        for pattern in patterns:
+            pattern = pattern.lower()
+            if not pattern or pattern in self.patterns:
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    outputs.append([])
+                state = nxt
+            outputs[state].append(len(self.patterns))
+            self.patterns.append(pattern)
+
+        # Breadth first pass to set failure links and merge the outputs of each failure chain
+        fail = [0] * len(goto)
+        frontier = list(goto[0].values())
+        while frontier:
+            next_frontier = []
+            for state in frontier:
+                for ch, nxt in goto[state].items():
+                    fallback = fail[state]
+                    while fallback and ch not in goto[fallback]:
+                        fallback = fail[fallback]
+                    fail[nxt] = goto[fallback].get(ch, 0)
+                    outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+                    next_frontier.append(nxt)
+            frontier = next_frontier
+
+        self._goto = goto
+        self._fail = fail
+        self._outputs = [tuple(out) for out in outputs]
+        # Whether each pattern needs a word boundary before and after it
+        self._bounded_start = [pattern[0].isalnum() for pattern in self.patterns]
+        self._bounded_end = [pattern[-1].isalnum() for pattern in self.patterns]
+
+    def find(self, text: str) -> set[int]:
+        """
+        Returns the indexes of the patterns that occur in text as whole words.
+        """
+        text = text.lower()
+        goto, fail, outputs, patterns = self._goto, self._fail, self._outputs, self.patterns
+        bounded_start, bounded_end = self._bounded_start, self._bounded_end
+        found: set[int] = set()
+        state = 0
+        length = len(text)
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if outputs[state]:
+                word_after = i + 1 < length and text[i + 1].isalnum()
+                for idx in outputs[state]:
+                    if idx in found or (word_after and bounded_end[idx]):
+                        continue
+                    start = i + 1 - len(patterns[idx])
+                    if start == 0 or not bounded_start[idx] or not text[start - 1].isalnum():
+                        found.add(idx)
+        return found
+
+
+class PrefilterResult(NamedTuple):
+    msg_id: str
+    score: float
+    passed: bool
+    hits: dict[str, list[str]]
+
+
+def _header(message: dict, name: str) -> str:
+    for header in message.get('payload', {}).get('headers', []):
+        if header['name'].lower() == name.lower():
+            return header['value']
+    return ''
+
+
+def _has_pdf(message: dict) -> bool:
+    parts = list(message.get('payload', {}).get('parts', []))
+    while parts:
+        part = parts.pop()
+        if part.get('filename', '').lower().endswith('.pdf') or part.get('mimeType') == 'application/pdf':
+            return True
+        parts.extend(part.get('parts', []))
+    return False
+
+
+def message_text(message: dict) -> str:
+    """
+    Text the prefilter scores for a Gmail message in metadata or full format.
+    """
+    return '\n'.join([_header(message, 'Subject'), _header(message, 'From'), message.get('snippet', '')])
+
+
+class Prefilter:
+    """
+    Local replacement for the firstpass Gmail search query. Every flight keyword and active
+    airline name is compiled into one Aho-Corasick automaton, the common_patterns regexes are
+    compiled into one alternation, and each message gets a weighted score from its subject,
+    sender and snippet. Only messages scoring at least `threshold` should go on to the full
+    body fetch and the LLM.
+    """
+
+    def __init__(self,
+                 keywords: dict[str, list[str]] = flight_keywords,
+                 airline_names: Iterable[str] = (),
+                 patterns: list[str] = common_patterns,
+                 threshold: float = DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        terms: list[tuple[str, str]] = []
+        for category, values in keywords.items():
+            terms.extend((category, value) for value in values)
+        terms.extend(('airline', name.strip()) for name in airline_names
+                     if len(name.strip()) >= MIN_AIRLINE_NAME_LENGTH)
+
+        self.automaton = AhoCorasick(term for _, term in terms)
+        # A term listed in several categories keeps the first one
+        self.categories: list[str] = [''] * len(self.automaton.patterns)
+        index = {pattern: i for i, pattern in enumerate(self.automaton.patterns)}
+        for category, term in reversed(terms):
+            if term.lower() in index:
+                self.categories[index[term.lower()]] = category
+
+        self.pattern_names = PATTERN_NAMES[:len(patterns)]
+        self.regex = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in zip(self.pattern_names, patterns)))
+
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def default(cls) -> 'Prefilter':
+        return cls(airline_names=get_airline_names())
+
+    def score_text(self, text: str) -> tuple[float, dict[str, list[str]]]:
+        hits: dict[str, list[str]] = {}
+        for idx in self.automaton.find(text):
+            hits.setdefault(self.categories[idx], []).append(self.automaton.patterns[idx])
+        for match in self.regex.finditer(text):
+            hits.setdefault(match.lastgroup, []).append(match.group())
+
+        score = 0.0
+        for category, values in hits.items():
+            if category in CATEGORY_WEIGHTS:
+                score += CATEGORY_WEIGHTS[category] * len(values)
+            else:
+                score += PATTERN_WEIGHTS.get(category, 0.0) * len(set(values))
+        return score, hits
+
+    def score(self, message: dict) -> PrefilterResult:
+        score, hits = self.score_text(message_text(message))
+        if _has_pdf(message):
+            score += PDF_ATTACHMENT_WEIGHT
+            hits['pdf_attachment'] = ['pdf']
+        return PrefilterResult(msg_id=message.get('id', ''), score=score, passed=score >= self.threshold, hits=hits)
+
+    def score_batch(self, messages: Iterable[dict]) -> list[PrefilterResult]:
+        return [self.score(message) for message in messages]
+
+    def filter(self, messages: Iterable[dict]) -> Iterator[dict]:
+        for message in messages:
+            if self.score(message).passed:
+                yield message
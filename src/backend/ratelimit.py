@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket refilled at `rate` tokens per second up to `capacity`.
+
+    `acquire` blocks until the tokens are available. Taking more than is available puts the
+    bucket into debt, so a request bigger than the capacity still goes through once the
+    bucket is full instead of waiting forever.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes `amount` tokens and returns how many seconds the caller has to wait before
+        using them.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            # Never wait for more than a full bucket
+            needed = min(amount, self.capacity)
+            wait = max(0.0, (needed - self.tokens) / self.rate)
+            self.tokens -= amount
+            return wait
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < min(amount, self.capacity):
+                return False
+            self.tokens -= amount
+            return True
+
+    def acquire(self, amount: float = 1.0):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def refund(self, amount: float):
+        """Gives back tokens that were reserved but not used, or takes more if negative."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class QuotaLimiter:
+    """
+    Charges every request to several token buckets at once, such as a per user and a per
+    project quota, and waits for the slowest of them. Keeps a running total of the units
+    charged.
+    """
+
+    def __init__(self, *buckets: TokenBucket):
+        self.buckets = buckets
+        self.used = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        with self._lock:
+            self.used += amount
+        wait = max((bucket.reserve(amount) for bucket in self.buckets), default=0.0)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AsyncTokenBucket(TokenBucket):
+    """TokenBucket whose acquire awaits instead of blocking the event loop."""
+
+    async def acquire(self, amount: float = 1.0):
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
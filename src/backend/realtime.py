@@ -0,0 +1,206 @@
+import asyncio
+import concurrent.futures
+import logging
+import random
+import threading
+from typing import Iterable, Iterator, Type
+
+import anthropic
+from anthropic import AsyncAnthropic
+
+import metrics
+from model import ClaudeExtractor, Extractor, ExtractorSchemaT
+from ratelimit import AsyncTokenBucket
+from retry_queue import ERRORED, RetryQueue
+from schemas import AIEmailPayload
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504, 529}
+
+# Rough size of a PDF page in input tokens, used to reserve token budget before sending
+TOKENS_PER_ATTACHMENT_KB = 5
+
+
+def estimate_input_tokens(params: dict) -> int:
+    system = params.get("system", "")
+    if isinstance(system, list):
+        system = "".join(block["text"] for block in system)
+    tokens = len(system) // 4
+    for message in params["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for block in content:
+            if block["type"] == "text":
+                tokens += len(block["text"]) // 4
+            elif block["type"] == "document":
+                # base64 is 4/3 of the raw size
+                tokens += len(block["source"].get("data", "")) * 3 // 4 // 1024 * TOKENS_PER_ATTACHMENT_KB
+    return max(tokens, 1)
+
+
+def _retryable(error: anthropic.APIError) -> bool:
+    return isinstance(error, anthropic.APIConnectionError) or getattr(error, 'status_code', None) in RETRYABLE_STATUS
+
+
+def _retry_after(error: anthropic.APIStatusError) -> float | None:
+    value = error.response.headers.get("retry-after") if error.response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AsyncClaudeExtractor(ClaudeExtractor[ExtractorSchemaT]):
+    """
+    Real time extractor that calls the Messages endpoint directly instead of going through
+    a batch, for single emails that should not wait minutes for a batch to end.
+
+    Requests share ClaudeExtractor's prompt, attachment and prefill building. At most
+    `max_concurrency` requests are in flight, requests and input/output tokens per minute
+    are held under the account limits with token buckets, and retryable errors back off
+    exponentially with full jitter.
+    """
+
+    def __init__(self,
+                 schema_class: Type[ExtractorSchemaT],
+                 api_key: str | None = None,
+                 model: str = "claude-3-haiku-20240307",
+                 max_concurrency: int = 8,
+                 requests_per_minute: float = 50,
+                 input_tokens_per_minute: float = 50_000,
+                 output_tokens_per_minute: float = 10_000,
+                 max_retries: int = 5,
+                 retry_queue: RetryQueue | None = None,
+                 max_tokens: int = 512):
+        super().__init__(schema_class=schema_class, api_key=api_key, model=model, retry_queue=retry_queue,
+                         max_tokens=max_tokens)
+        # Retries are handled here so they go through the rate limiter
+        self.async_client = AsyncAnthropic(api_key=api_key, max_retries=0)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.request_bucket = AsyncTokenBucket(rate=requests_per_minute / 60, capacity=max(1.0, requests_per_minute / 60))
+        self.input_bucket = AsyncTokenBucket(rate=input_tokens_per_minute / 60, capacity=input_tokens_per_minute)
+        self.output_bucket = AsyncTokenBucket(rate=output_tokens_per_minute / 60, capacity=output_tokens_per_minute)
+
+    async def _send(self, params: dict):
+        input_tokens = estimate_input_tokens(params)
+        attempt = 0
+        while True:
+            await self.request_bucket.acquire()
+            await self.input_bucket.acquire(input_tokens)
+            await self.output_bucket.acquire(params["max_tokens"])
+            try:
+                with metrics.timer('realtime_request_seconds', model=self.model_name):
+                    response = await self.async_client.messages.create(**params)
+            except (anthropic.APIConnectionError, anthropic.APIStatusError) as error:
+                # Nothing was processed, hand the reservations back before deciding what to do
+                self.input_bucket.refund(input_tokens)
+                self.output_bucket.refund(params["max_tokens"])
+                if not _retryable(error) or attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(60.0, 2.0 ** attempt))
+                if isinstance(error, anthropic.APIStatusError):
+                    delay = max(delay, _retry_after(error) or 0.0)
+                logger.warning("Messages request failed (%s), retrying in %.1fs", error, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            # Settle the reservations against what the request actually used
+            self.input_bucket.refund(input_tokens - response.usage.input_tokens)
+            self.output_bucket.refund(params["max_tokens"] - response.usage.output_tokens)
+            self.record_usage(response.usage, route='realtime')
+            return response
+
+    async def aextract_one(self, payload: AIEmailPayload, semaphore: asyncio.Semaphore | None = None) -> ExtractorSchemaT | None:
+        semaphore = semaphore or asyncio.Semaphore(1)
+        self.failures.pop(payload.id, None)
+        params = send = self.build_params(payload)
+        retried = False
+        # An unusable reply is retried right away, with the repair prompt when enabled. A request
+        # the API still refuses after _send's own retries is booked like an errored batch item,
+        # so one bad payload does not take the rest of the set down with it
+        while send is not None:
+            try:
+                async with semaphore:
+                    response = await self._send(send)
+            except anthropic.APIError as api_error:
+                result = None
+                send = self._settle(payload, params, retried, ERRORED, None, str(api_error),
+                                    retryable=_retryable(api_error))
+                retried = True
+                continue
+            text = response.content[0].text
+            outcome, result, error = self.read_reply(text)
+            send = self._settle(payload, params, retried, outcome, result, error, text)
+            retried = True
+        return result
+
+    async def aextract(self, payloads: list[AIEmailPayload]) -> list[ExtractorSchemaT | None]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return list(await asyncio.gather(*(self.aextract_one(payload, semaphore) for payload in payloads)))
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        # One long lived loop so the async client's connection pool is reused between calls
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='realtime-extractor', daemon=True).start()
+        return self._loop
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractorSchemaT | None]:
+        return asyncio.run_coroutine_threadsafe(self.aextract(payloads), self._event_loop()).result()
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Yields each (payload, result) pair as soon as its request returns.
+        """
+        loop = self._event_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        futures = {asyncio.run_coroutine_threadsafe(self.aextract_one(payload, semaphore), loop): payload
+                   for payload in payloads}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+class ExtractorRouter(Extractor[ExtractorSchemaT]):
+    """
+    Sends small or urgent sets of payloads to the real time extractor and bulk backfills to
+    the batch extractor.
+    """
+
+    def __init__(self,
+                 batch: Extractor[ExtractorSchemaT],
+                 realtime: Extractor[ExtractorSchemaT],
+                 realtime_max: int = 20):
+        super().__init__(schema_class=batch.SCHEMA_PROMPT)
+        self.batch = batch
+        self.realtime = realtime
+        self.model_name = batch.model_name
+        self.realtime_max = realtime_max
+
+    def route(self, payloads: list[AIEmailPayload], urgent: bool = False) -> Extractor[ExtractorSchemaT]:
+        return self.realtime if urgent or len(payloads) <= self.realtime_max else self.batch
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return self.batch.failed(payload) or self.realtime.failed(payload)
+
+    def extract(self,
+                payloads: list[AIEmailPayload],
+                urgent: bool = False
+                ) -> list[ExtractorSchemaT | None]:
+        return self.route(payloads, urgent).extract(payloads)
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload],
+                     urgent: bool = False
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        payloads = list(payloads)
+        yield from self.route(payloads, urgent).extract_iter(payloads)
@@ -0,0 +1,215 @@
+import argparse
+import base64
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+from itinerary import DEFAULT_MAX_STAY_DAYS, TripIndex, decode_day, encode_day
+from schemas import ExtractedFlightInfo
+
+
+DEFAULT_RESULTS_DB = "results.db"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+FIELDS = tuple(ExtractedFlightInfo.model_fields)
+
+
+class FlightPage(NamedTuple):
+    flights: list[dict]
+    # Opaque cursor for the next page, None on the last one
+    next_cursor: str | None
+
+
+class TripPage(NamedTuple):
+    trips: list[dict]
+    next_cursor: str | None
+
+
+def encode_cursor(date: str, message_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([date, message_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        date, message_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as error:
+        raise ValueError(f"Invalid cursor {cursor!r}") from error
+    if not isinstance(date, str) or not isinstance(message_id, str):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    return date, message_id
+
+
+class ResultStore:
+    """
+    SQLite store of extracted flights, one row per message, so the dashboard can query
+    them instead of reading every JSON file in ./outputs.
+
+    Flights are listed in (flight_takeoff_date, message_id) order and paged by keyset: the
+    cursor is the last row's key and the next page starts right after it, so every page is
+    one index range scan however deep it is. Every write bumps a generation number the API
+    uses as its ETag.
+
+    The same writes chain the flights into trips in a TripIndex, leg by leg, so trip views
+    never need the whole history regrouped.
+    """
+
+    def __init__(self, path: str = DEFAULT_RESULTS_DB, max_stay_days: int = DEFAULT_MAX_STAY_DAYS):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS flights (
+                message_id TEXT PRIMARY KEY,
+                airport_code_src TEXT,
+                airport_code_dst TEXT,
+                flight_takeoff_date TEXT,
+                flight_number TEXT,
+                passenger_name TEXT,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS flights_date ON flights (flight_takeoff_date, message_id);
+            CREATE INDEX IF NOT EXISTS flights_number ON flights (flight_number, flight_takeoff_date);
+            CREATE INDEX IF NOT EXISTS flights_src ON flights (airport_code_src, flight_takeoff_date);
+            CREATE INDEX IF NOT EXISTS flights_dst ON flights (airport_code_dst, flight_takeoff_date);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+        """)
+        self.trips = TripIndex(self.conn, max_stay_days)
+        # Flights saved before trips were assembled are chained once
+        with self.conn:
+            if self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('trips_assembled', 1)").rowcount:
+                rows = self.conn.execute(f"SELECT message_id, {', '.join(FIELDS)} FROM flights").fetchall()
+                self.trips.backfill((row['message_id'], ExtractedFlightInfo.model_construct(
+                    **{field: row[field] for field in FIELDS})) for row in rows)
+
+    def _bump(self):
+        self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def upsert(self, message_id: str, result: ExtractedFlightInfo | None):
+        """Saves the flight found in a message, an empty extraction removes the message's row."""
+        self.upsert_many([(message_id, result)])
+
+    def upsert_many(self, results: list[tuple[str, ExtractedFlightInfo | None]]):
+        if not results:
+            return
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO flights (message_id, {', '.join(FIELDS)}, updated) "
+                f"VALUES (?, {', '.join('?' * len(FIELDS))}, ?) "
+                f"ON CONFLICT(message_id) DO UPDATE SET "
+                f"{', '.join(f'{field} = excluded.{field}' for field in FIELDS)}, updated = excluded.updated",
+                [(message_id, *(getattr(result, field) for field in FIELDS), now)
+                 for message_id, result in results if result is not None])
+            self.conn.executemany("DELETE FROM flights WHERE message_id = ?",
+                                  [(message_id,) for message_id, result in results if result is None])
+            for message_id, result in results:
+                self.trips.apply(message_id, result)
+            self._bump()
+
+    def generation(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def get(self, message_id: str) -> dict | None:
+        with self._lock:
+            row = self.conn.execute(f"SELECT message_id, {', '.join(FIELDS)} FROM flights WHERE message_id = ?",
+                                    (message_id,)).fetchone()
+        return dict(row) if row else None
+
+    def query(self,
+              start: str | None = None,
+              end: str | None = None,
+              flight_number: str | None = None,
+              airport: str | None = None,
+              cursor: str | None = None,
+              limit: int = DEFAULT_PAGE_SIZE) -> FlightPage:
+        """
+        One page of flights taking off between `start` and `end` (ISO dates, both inclusive),
+        optionally only one flight number or flights from or to one airport. Flights without
+        a takeoff date are not listed.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        clauses, params = ["flight_takeoff_date IS NOT NULL"], []
+        if start is not None:
+            clauses.append("flight_takeoff_date >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("flight_takeoff_date <= ?")
+            params.append(end)
+        if flight_number is not None:
+            clauses.append("flight_number = ?")
+            params.append(flight_number)
+        if airport is not None:
+            clauses.append("(airport_code_src = ? OR airport_code_dst = ?)")
+            params += [airport, airport]
+        if cursor is not None:
+            clauses.append("(flight_takeoff_date, message_id) > (?, ?)")
+            params += decode_cursor(cursor)
+        # One extra row tells whether there is a next page
+        with self._lock:
+            rows = self.conn.execute(f"SELECT message_id, {', '.join(FIELDS)} FROM flights "
+                                     f"WHERE {' AND '.join(clauses)} "
+                                     f"ORDER BY flight_takeoff_date, message_id LIMIT ?", [*params, limit + 1]).fetchall()
+        flights = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(flights[-1]['flight_takeoff_date'], flights[-1]['message_id'])
+        return FlightPage(flights, next_cursor)
+
+    def trip(self, trip_id: int) -> dict | None:
+        with self._lock:
+            return self.trips.get(trip_id)
+
+    def query_trips(self,
+                    start: str | None = None,
+                    end: str | None = None,
+                    airport: str | None = None,
+                    cursor: str | None = None,
+                    limit: int = DEFAULT_PAGE_SIZE) -> TripPage:
+        """
+        One page of trips overlapping `start` to `end` (ISO dates, both inclusive) in start
+        order, each with its legs, optionally only trips starting or ending at one airport.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        key = None
+        if cursor is not None:
+            start_date, trip_id = decode_cursor(cursor)
+            if encode_day(start_date) is None or not trip_id.isdigit():
+                raise ValueError(f"Invalid cursor {cursor!r}")
+            key = (encode_day(start_date), int(trip_id))
+        with self._lock:
+            trips, next_key = self.trips.query(start, end, airport, key, limit)
+        return TripPage(trips, encode_cursor(decode_day(next_key[0]), str(next_key[1])) if next_key else None)
+
+    def import_outputs(self, output_dir: pathlib.Path) -> int:
+        """Loads the JSON files `script.py` has written so far, returns how many were read."""
+        results = []
+        for path in output_dir.glob('*.json'):
+            data = json.loads(path.read_text())
+            results.append((path.stem, ExtractedFlightInfo.model_validate(data) if data else None))
+        for i in range(0, len(results), 1000):
+            self.upsert_many(results[i:i + 1000])
+        return len(results)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load extraction outputs into the results store")
+    parser.add_argument("--db", default=DEFAULT_RESULTS_DB)
+    parser.add_argument("--outputs", default="./outputs", help="directory of JSON files written by the extraction run")
+    args = parser.parse_args()
+
+    store = ResultStore(args.db)
+    print(f"Imported {store.import_outputs(pathlib.Path(args.outputs))} results")
+    store.close()
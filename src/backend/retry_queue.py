@@ -0,0 +1,131 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+
+DEFAULT_RETRY_DB = "retry_queue.db"
+# Submissions of one request, the first one included, before it is given up on
+DEFAULT_MAX_ATTEMPTS = 3
+
+# What happened to one request
+SUCCEEDED = 'succeeded'
+ERRORED = 'errored'
+EXPIRED = 'expired'
+CANCELED = 'canceled'
+INVALID_JSON = 'invalid_json'
+SCHEMA_FAILURE = 'schema_failure'
+# Replies worth sending back with the error so the model can fix them
+REPAIRABLE = {INVALID_JSON, SCHEMA_FAILURE}
+
+PENDING = 'pending'
+DEAD = 'dead'
+
+
+class FailedRequest(NamedTuple):
+    payload_id: str
+    params: dict
+    attempts: int
+    outcome: str
+    error: str | None
+    # Text of the last unusable reply, for the repair prompt
+    reply: str | None
+
+
+class RetryQueue:
+    """
+    SQLite record of extraction requests whose reply was unusable: errored, expired or
+    canceled batch items, replies that are not JSON and replies the schema rejects.
+
+    A failed request is saved with its params as soon as it fails, so a crash between the
+    failure and its retry loses nothing, and removed once the payload is answered. After
+    `max_attempts` it is marked dead and left for inspection or `requeue_dead`.
+    """
+
+    def __init__(self, path: str = DEFAULT_RETRY_DB, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS failures (
+                payload_id TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                outcome TEXT NOT NULL,
+                error TEXT,
+                reply TEXT,
+                status TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS failures_status ON failures (status);
+        """)
+
+    def record_failure(self,
+                       payload_id: str,
+                       params: dict,
+                       outcome: str,
+                       error: str | None = None,
+                       reply: str | None = None,
+                       retryable: bool = True,
+                       fresh: bool = False) -> bool:
+        """
+        Counts a failed attempt, `params` being the original request. A `fresh` submission
+        of the payload starts counting again from one, whatever an earlier run left behind.
+        Returns whether the request should be tried again.
+        """
+        with self._lock, self.conn:
+            row = None if fresh else self.conn.execute("SELECT attempts FROM failures WHERE payload_id = ?",
+                                                       (payload_id,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            status = PENDING if retryable and attempts < self.max_attempts else DEAD
+            self.conn.execute("INSERT OR REPLACE INTO failures "
+                              "(payload_id, params, attempts, outcome, error, reply, status, updated) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (payload_id, json.dumps(params), attempts, outcome, error, reply, status, time.time()))
+        return status == PENDING
+
+    def resolve(self, payload_id: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM failures WHERE payload_id = ?", (payload_id,))
+
+    def pending(self, limit: int | None = None) -> list[FailedRequest]:
+        """Requests still due a retry, such as those left over from a run that stopped early."""
+        with self._lock:
+            rows = self.conn.execute("SELECT payload_id, params, attempts, outcome, error, reply FROM failures "
+                                     "WHERE status = ? ORDER BY updated LIMIT ?",
+                                     (PENDING, -1 if limit is None else limit)).fetchall()
+        return [FailedRequest(payload_id, json.loads(params), attempts, outcome, error, reply)
+                for payload_id, params, attempts, outcome, error, reply in rows]
+
+    def requeue_dead(self) -> int:
+        """Gives every dead request a fresh set of attempts."""
+        with self._lock, self.conn:
+            return self.conn.execute("UPDATE failures SET status = ?, attempts = 0 WHERE status = ?", (PENDING, DEAD)).rowcount
+
+    def report(self) -> dict[str, dict[str, int]]:
+        """Number of failed requests by status and last outcome."""
+        report: dict[str, dict[str, int]] = {}
+        with self._lock:
+            for status, outcome, count in self.conn.execute("SELECT status, outcome, COUNT(*) FROM failures GROUP BY status, outcome"):
+                report.setdefault(status, {})[outcome] = count
+        return report
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the extraction retry queue")
+    parser.add_argument("--db", default=DEFAULT_RETRY_DB)
+    parser.add_argument("--requeue-dead", action="store_true", help="retry requests that ran out of attempts on the next run")
+    args = parser.parse_args()
+
+    queue = RetryQueue(args.db)
+    if args.requeue_dead:
+        print(f"Requeued {queue.requeue_dead()} requests")
+    for status, outcomes in queue.report().items():
+        print(f"{status}: " + ', '.join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items())))
+    queue.close()
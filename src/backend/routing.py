@@ -0,0 +1,281 @@
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Iterable, Iterator, NamedTuple, Type
+
+import metrics
+from model import ClaudeExtractor, Extractor, ExtractorSchemaT
+from realtime import AsyncClaudeExtractor, ExtractorRouter
+from retry_queue import REPAIRABLE, RetryQueue
+from rules import FieldAgreement
+from schemas import AIEmailPayload
+
+
+logger = logging.getLogger(__name__)
+
+LIGHT_MODEL = "claude-3-haiku-20240307"
+STRONG_MODEL = "claude-3-5-sonnet-latest"
+# What the light route takes, about 6k tokens of text and one short PDF
+LIGHT_MAX_TEXT_CHARS = 24_000
+LIGHT_MAX_ATTACHMENTS = 1
+LIGHT_MAX_ATTACHMENT_BYTES = 2 * 1024 * 1024
+# Prefilter scores under this barely passed, those emails are mostly promotions with
+# flight words in them and rarely worth a stronger model whatever their length
+LOW_CONFIDENCE_SCORE = 6.0
+# Share of the payloads answered by a cheaper route that is also sent to the strongest one.
+# Audits pay for the strongest model on top, so they only run when asked for
+DEFAULT_AUDIT_RATE = 0.0
+# Payloads the llm pipeline stage hands over at once, with how many of those sets can be in
+# flight. At most realtime_max of them go to the real time endpoint, a full set goes out as
+# one Message Batch, so the size is one for batches and not for real time calls
+DEFAULT_LLM_BATCH_SIZE = 2000
+DEFAULT_LLM_WORKERS = 4
+# Seconds the stage waits for a set to fill before it sends what it has
+LLM_BATCH_WAIT = 30.0
+# Batch results take minutes to hours, real time ones seconds
+LATENCY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 14400.0, 86400.0)
+
+
+class PayloadProfile(NamedTuple):
+    text_chars: int
+    attachments: int
+    attachment_bytes: int
+    prefilter_score: float | None
+
+
+def payload_profile(payload: AIEmailPayload) -> PayloadProfile:
+    attachments = payload.attachments or []
+    return PayloadProfile(text_chars=sum(len(value) for value in payload.text_context.values() if value),
+                          attachments=len(attachments),
+                          attachment_bytes=sum(attachment.data.nbytes for attachment in attachments),
+                          prefilter_score=payload.prefilter_score)
+
+
+class Route(NamedTuple):
+    """
+    One model and max_tokens, behind a batch extractor and optionally a real time one. The
+    limits are the largest payload the route takes, None for no limit.
+    """
+    name: str
+    batch: ClaudeExtractor
+    realtime: ClaudeExtractor | None = None
+    max_text_chars: int | None = None
+    max_attachments: int | None = None
+    max_attachment_bytes: int | None = None
+
+    def fits(self, profile: PayloadProfile, ignore_text: bool = False) -> bool:
+        return ((ignore_text or self.max_text_chars is None or profile.text_chars <= self.max_text_chars) and
+                (self.max_attachments is None or profile.attachments <= self.max_attachments) and
+                (self.max_attachment_bytes is None or profile.attachment_bytes <= self.max_attachment_bytes))
+
+    def failure(self, payload: AIEmailPayload) -> str | None:
+        return self.batch.failure(payload) or (self.realtime.failure(payload) if self.realtime is not None else None)
+
+    def tokens(self) -> tuple[int, int]:
+        """(input, output) tokens used by the route's replies."""
+        extractors = [self.batch] + ([self.realtime] if self.realtime is not None else [])
+        return sum(e.input_tokens for e in extractors), sum(e.output_tokens for e in extractors)
+
+
+class RouteStats:
+    def __init__(self):
+        self.payloads = 0
+        self.failed = 0
+        self.escalated = 0
+        # Seconds from the route being handed a set of payloads to each result
+        self.latency = metrics.Histogram(LATENCY_BUCKETS)
+        # Audited results of this route against the strongest route's
+        self.agreement = FieldAgreement()
+
+
+class ModelRouter(Extractor[ExtractorSchemaT]):
+    """
+    Sends each payload to the cheapest route that can take it, judged by its text length,
+    attachment count and size and prefilter score. Routes are ordered cheapest first and
+    the last one takes whatever the others do not. Within a route a handful of payloads
+    go to its real time extractor and larger sets to its batch extractor.
+
+    A payload whose replies a route still could not parse or validate after its repair
+    attempts is escalated to the next route. With `audit_rate` above zero that share of
+    the payloads answered by a cheaper route also goes to the strongest one and how often
+    the two agree is tracked per route, the cheaper result is still the one returned.
+    """
+
+    def __init__(self,
+                 routes: list[Route],
+                 realtime_max: int = 20,
+                 low_confidence: float = LOW_CONFIDENCE_SCORE,
+                 audit_rate: float = 0.0):
+        super().__init__(schema_class=routes[0].batch.SCHEMA_PROMPT)
+        self.routes = routes
+        self.extractors: list[Extractor[ExtractorSchemaT]] = [
+            ExtractorRouter(batch=route.batch, realtime=route.realtime, realtime_max=realtime_max)
+            if route.realtime is not None else route.batch
+            for route in routes]
+        # Part of the cache and dedupe fingerprints, changing a route's model changes every key
+        self.model_name = '+'.join(dict.fromkeys(route.batch.model_name for route in routes))
+        self.low_confidence = low_confidence
+        self.audit_rate = audit_rate
+        # Every route shares one retry queue, escalations give the request a fresh set of attempts
+        self.retry_queue = routes[0].batch.retry_queue
+        self.stats = {route.name: RouteStats() for route in routes}
+        self.failed_ids: set[str] = set()
+
+    def classify(self, profile: PayloadProfile) -> int:
+        """Index of the route a payload with this profile goes to."""
+        unsure = profile.prefilter_score is not None and profile.prefilter_score < self.low_confidence
+        for index, route in enumerate(self.routes[:-1]):
+            if route.fits(profile, ignore_text=unsure):
+                return index
+        return len(self.routes) - 1
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return payload.id in self.failed_ids
+
+    def _run(self, groups: dict[int, list[AIEmailPayload]]) -> Iterator[tuple[int, AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Runs every route's payloads at the same time, so a batch of long emails does not wait
+        for the batch of short ones to end, and yields (route index, payload, result).
+        """
+        results: queue.Queue = queue.Queue()
+        done = object()
+
+        def run(index: int, payloads: list[AIEmailPayload]):
+            try:
+                for payload, result in self.extractors[index].extract_iter(payloads):
+                    results.put((index, payload, result))
+            except BaseException as error:
+                results.put(error)
+            finally:
+                results.put(done)
+
+        started = time.monotonic()
+        for index, payloads in groups.items():
+            self.stats[self.routes[index].name].payloads += len(payloads)
+            metrics.count('routed_payloads', len(payloads), route=self.routes[index].name)
+            threading.Thread(target=run, args=(index, payloads), name=f'route-{self.routes[index].name}',
+                             daemon=True).start()
+        running = len(groups)
+        while running:
+            item = results.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                index = item[0]
+                latency = time.monotonic() - started
+                self.stats[self.routes[index].name].latency.observe(latency)
+                metrics.observe('route_latency_seconds', latency, route=self.routes[index].name)
+                yield item
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """Yields results as the routes return them, escalated payloads after their retry."""
+        groups: dict[int, list[AIEmailPayload]] = {}
+        for payload in payloads:
+            groups.setdefault(self.classify(payload_profile(payload)), []).append(payload)
+        strongest = len(self.routes) - 1
+        # id(payload) -> (route index, result) of the payloads sent to the strongest route for audit
+        audited: dict[int, tuple[int, ExtractorSchemaT | None]] = {}
+
+        while groups:
+            escalate: dict[int, list[AIEmailPayload]] = {}
+            for index, payload, result in self._run(groups):
+                route = self.routes[index]
+                stats = self.stats[route.name]
+                if id(payload) in audited:
+                    audited_index, audited_result = audited.pop(id(payload))
+                    if route.failure(payload) is None:
+                        self.stats[self.routes[audited_index].name].agreement.add(audited_result, result)
+                    else:
+                        # The payload was answered, it is not owed a retry
+                        self.retry_queue.resolve(payload.id)
+                    continue
+                failure = route.failure(payload)
+                if failure is None:
+                    self.failed_ids.discard(payload.id)
+                    if index < strongest and self.audit_rate and random.random() < self.audit_rate:
+                        audited[id(payload)] = (index, result)
+                        escalate.setdefault(strongest, []).append(payload)
+                elif failure in REPAIRABLE and index < strongest:
+                    logger.info("Escalating %s from %s after %s", payload.id, route.name, failure)
+                    stats.escalated += 1
+                    metrics.count('route_escalations', route=route.name)
+                    self.retry_queue.resolve(payload.id)
+                    escalate.setdefault(index + 1, []).append(payload)
+                    continue
+                else:
+                    stats.failed += 1
+                    self.failed_ids.add(payload.id)
+                yield payload, result
+            groups = escalate
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractorSchemaT | None]:
+        position = {id(payload): i for i, payload in enumerate(payloads)}
+        output: list[ExtractorSchemaT | None] = [None] * len(payloads)
+        for payload, result in self.extract_iter(payloads):
+            output[position[id(payload)]] = result
+        return output
+
+    def retry_pending(self) -> Iterator[tuple[AIEmailPayload, ExtractorSchemaT | None]]:
+        """
+        Resubmits what a previous run left in the retry queue. The saved params name their
+        model, so every route's requests go through the first route's batch extractor.
+        """
+        batch = self.routes[0].batch
+        for payload, result in batch.retry_pending():
+            if batch.failed(payload):
+                self.failed_ids.add(payload.id)
+            else:
+                self.failed_ids.discard(payload.id)
+            yield payload, result
+
+    def report(self) -> dict[str, dict]:
+        report = {}
+        for route in self.routes:
+            stats = self.stats[route.name]
+            input_tokens, output_tokens = route.tokens()
+            report[route.name] = {
+                'model': route.batch.model_name,
+                'max_tokens': route.batch.max_tokens,
+                'payloads': stats.payloads,
+                'failed': stats.failed,
+                'escalated': stats.escalated,
+                'latency_p50': stats.latency.quantile(0.5),
+                'latency_p95': stats.latency.quantile(0.95),
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'agreement': stats.agreement.report() if stats.agreement.compared else None,
+            }
+        return report
+
+
+def default_router(schema_class: Type[ExtractorSchemaT],
+                   retry_queue: RetryQueue | None = None,
+                   audit_rate: float = DEFAULT_AUDIT_RATE) -> ModelRouter[ExtractorSchemaT]:
+    """
+    Haiku with a short reply for ordinary emails, Sonnet with room for several legs for
+    long emails, PDF itineraries and whatever Haiku could not answer.
+    """
+    retry_queue = retry_queue or RetryQueue()
+
+    def route(name: str, model: str, max_tokens: int, **limits) -> Route:
+        batch = ClaudeExtractor(schema_class=schema_class, model=model, retry_queue=retry_queue, max_tokens=max_tokens)
+        realtime = AsyncClaudeExtractor(schema_class=schema_class, model=model, retry_queue=retry_queue,
+                                        max_tokens=max_tokens)
+        # One record of given up requests per route, so a payload the batch gave up on that
+        # the real time endpoint answers later is no longer failed
+        realtime.failures = batch.failures
+        return Route(name, batch=batch, realtime=realtime, **limits)
+
+    return ModelRouter([
+        route('light', LIGHT_MODEL, 512, max_text_chars=LIGHT_MAX_TEXT_CHARS, max_attachments=LIGHT_MAX_ATTACHMENTS,
+              max_attachment_bytes=LIGHT_MAX_ATTACHMENT_BYTES),
+        route('strong', STRONG_MODEL, 1024),
+    ], audit_rate=audit_rate)
@@ -0,0 +1,336 @@
+import argparse
+import datetime
+import random
+import re
+import threading
+from typing import Iterable, Iterator, NamedTuple
+
+from airline_index import AirlineIndex
+from firstpass import common_patterns
+from model import Extractor
+from schemas import AIEmailPayload, ExtractedFlightInfo
+
+
+# common_patterns only matches AA1234, airlines also write "AA 123", "B6 123" and "U2 1234".
+# Nothing right after a clock time counts, "7:45 AM 14 Mar" is not flight AM14
+FLIGHT_NUMBER_RE = re.compile(rf'(?<!:\d\d\s)(?<!:\d\d)(?:{common_patterns[0]}|\b([A-Z][A-Z0-9]|[0-9][A-Z]) ?(\d{{1,4}})\b)')
+# common_patterns[1] without its word boundaries, so it can sit inside the route patterns
+AIRPORT_CODE = r'[A-Z]{3}'
+ROUTE_RE = re.compile(rf'\b({AIRPORT_CODE})\s*(?:-|–|—|→|->|>|to|TO|To)\s*({AIRPORT_CODE})\b')
+PARENTHESIZED_CODE_RE = re.compile(rf'\(({AIRPORT_CODE})\)')
+# Three capital letters that show up in emails and are not the airports people mean
+NOT_AIRPORTS = {'THE', 'AND', 'FOR', 'YOU', 'PDF', 'USD', 'EUR', 'GBP', 'CAD', 'AUD', 'UTC', 'GMT', 'EST', 'EDT',
+                'PST', 'PDT', 'CST', 'CDT', 'MST', 'MDT', 'CET', 'TSA', 'FAQ', 'APP', 'NEW', 'NOW', 'VIP', 'ALL'}
+
+# common_patterns[3] is one booking reference format, most confirmations label a six
+# character record locator instead, always written in capitals
+BOOKING_REFERENCE_RE = re.compile(
+    rf'{common_patterns[3]}|'
+    r'(?i:booking|confirmation|reservation|record locator|pnr)\s*(?i:reference|code|number|no\.?|#)?\s*:?\s*'
+    r'\b([A-Z0-9]{6})\b')
+# Words a booked flight comes with and a fare sale does not, common_patterns[4] is an e-ticket number
+BOOKING_CONTEXT_RE = re.compile(
+    rf'{common_patterns[4]}|'
+    r'\b(?:confirmation|confirmed|e-?tickets?|ticket (?:number|no)|itinerary|boarding pass|record locator|'
+    r'reservation|check-?in|booking (?:reference|code|number))\b', re.IGNORECASE)
+# How far from the flight number the booking words may be
+BOOKING_CONTEXT_CHARS = 1000
+
+MONTHS = {month: i for i, month in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+MONTH_NAME = r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\.?'
+DATE_PATTERNS = [
+    # 2024-05-01
+    (re.compile(r'\b(?P<y>\d{4})-(?P<m>\d{1,2})-(?P<d>\d{1,2})\b'), 1.0),
+    # 1 May 2024, 01MAY24
+    (re.compile(rf'\b(?P<d>\d{{1,2}})\s?(?P<mon>{MONTH_NAME}),?\s?(?P<y>\d{{4}}|\d{{2}})\b', re.IGNORECASE), 1.0),
+    # May 1, 2024
+    (re.compile(rf'\b(?P<mon>{MONTH_NAME})\s(?P<d>\d{{1,2}})(?:st|nd|rd|th)?,?\s(?P<y>\d{{4}})\b', re.IGNORECASE), 1.0),
+    # 05/01/2024 is read month first unless that is impossible, so it counts for less
+    (re.compile(r'\b(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4})\b'), 0.5),
+]
+
+FIELD_WEIGHTS = {
+    'flight_number': 0.35,
+    'airport_codes': 0.3,
+    'flight_takeoff_date': 0.2,
+    'passenger_name': 0.15,
+}
+# Several different flights in one email is a multi leg trip, which leg the schema means is
+# the model's call
+MULTIPLE_FLIGHTS_PENALTY = 0.6
+# Needs the passenger's name on top of flight, route and date
+DEFAULT_CONFIDENCE_THRESHOLD = 0.9
+# Most a result can score without a booking reference or booking words near the flight,
+# fare sales name flights, routes and dates just like confirmations do
+NO_BOOKING_CONFIDENCE = 0.5
+
+
+class RuleResult(NamedTuple):
+    result: ExtractedFlightInfo | None
+    confidence: float
+
+
+def _email_text(payload: AIEmailPayload) -> str:
+    return '\n'.join(payload.text_context.get(key) or '' for key in ('html_text', 'attachment_text'))
+
+
+def parse_date(match: re.Match) -> datetime.date | None:
+    parts = match.groupdict()
+    year = int(parts['y'])
+    if year < 100:
+        year += 2000
+    month = MONTHS[parts['mon'][:3].lower()] if parts.get('mon') else int(parts['m'])
+    day = int(parts['d'])
+    if month > 12 and day <= 12:
+        month, day = day, month
+    try:
+        return datetime.date(year, month, day)
+    except ValueError:
+        return None
+
+
+def find_flight_numbers(text: str, airlines: AirlineIndex) -> list[tuple[int, str]]:
+    """(position, canonical flight number) of each flight number of an active airline in `text`."""
+    found = []
+    for match in FLIGHT_NUMBER_RE.finditer(text):
+        parsed = airlines.parse_flight_number(match.group())
+        if parsed is not None and parsed[0].active:
+            found.append((match.start(), airlines.canonical_flight_number(match.group())))
+    return found
+
+
+class RuleExtractor(Extractor[ExtractedFlightInfo]):
+    """
+    Reads flight number, route, date and passenger straight out of templated confirmation
+    emails with regexes and the airline code index, no model call involved.
+
+    Every result comes with a confidence between 0 and 1: the weights of the fields that
+    were found, lowered when an email holds several different flights or only a month
+    first numeric date, and capped at NO_BOOKING_CONFIDENCE when nothing says the flight
+    was booked. Emails without a flight number from a known airline get None.
+    """
+
+    def __init__(self, airlines: AirlineIndex | None = None):
+        super().__init__(schema_class=ExtractedFlightInfo)
+        self.model_name = "rules"
+        self.airlines = airlines or AirlineIndex.default()
+
+    def _flight_numbers(self, text: str) -> list[tuple[int, str]]:
+        return find_flight_numbers(text, self.airlines)
+
+    @staticmethod
+    def _route(text: str) -> tuple[str, str] | None:
+        for match in ROUTE_RE.finditer(text):
+            src, dst = match.groups()
+            if src != dst and src not in NOT_AIRPORTS and dst not in NOT_AIRPORTS:
+                return src, dst
+        codes = []
+        for match in PARENTHESIZED_CODE_RE.finditer(text):
+            code = match.group(1)
+            if code not in NOT_AIRPORTS and code not in codes:
+                codes.append(code)
+            if len(codes) == 2:
+                return codes[0], codes[1]
+        return None
+
+    @staticmethod
+    def _date(text: str, near: int) -> tuple[datetime.date, float] | None:
+        # The date closest to the flight number, emails also carry send and expiry dates
+        best = None
+        for pattern, weight in DATE_PATTERNS:
+            for match in pattern.finditer(text):
+                date = parse_date(match)
+                if date is None:
+                    continue
+                distance = abs(match.start() - near)
+                if best is None or distance < best[0]:
+                    best = (distance, date, weight)
+        return (best[1], best[2]) if best else None
+
+    @staticmethod
+    def _booked(text: str, near: int) -> bool:
+        if BOOKING_REFERENCE_RE.search(text):
+            return True
+        window = text[max(0, near - BOOKING_CONTEXT_CHARS):near + BOOKING_CONTEXT_CHARS]
+        return BOOKING_CONTEXT_RE.search(window) is not None
+
+    @staticmethod
+    def _passenger(text: str, name: str | None) -> str | None:
+        # "Shrey Patel" also matches the "PATEL/SHREY" form tickets use
+        if not name:
+            return None
+        lowered = text.lower()
+        parts = name.lower().split()
+        return name if parts and all(re.search(rf'\b{re.escape(part)}\b', lowered) for part in parts) else None
+
+    def extract_one(self, payload: AIEmailPayload) -> RuleResult:
+        text = _email_text(payload)
+        flights = self._flight_numbers(text)
+        if not flights:
+            return RuleResult(None, 0.0)
+        position, flight_number = flights[0]
+        confidence = FIELD_WEIGHTS['flight_number']
+
+        route = self._route(text)
+        if route is not None:
+            confidence += FIELD_WEIGHTS['airport_codes']
+        date = self._date(text, position)
+        if date is not None:
+            confidence += FIELD_WEIGHTS['flight_takeoff_date'] * date[1]
+        passenger = self._passenger(text, payload.text_context.get('name'))
+        if passenger is not None:
+            confidence += FIELD_WEIGHTS['passenger_name']
+        if len({number for _, number in flights}) > 1:
+            confidence *= MULTIPLE_FLIGHTS_PENALTY
+        if not self._booked(text, position):
+            confidence = min(confidence, NO_BOOKING_CONFIDENCE)
+
+        result = ExtractedFlightInfo(airport_code_src=route[0] if route else None,
+                                     airport_code_dst=route[1] if route else None,
+                                     flight_takeoff_date=date[0].isoformat() if date else None,
+                                     flight_number=flight_number,
+                                     passenger_name=passenger)
+        return RuleResult(result, round(confidence, 3))
+
+    def extract_with_confidence(self, payloads: list[AIEmailPayload]) -> list[RuleResult]:
+        return [self.extract_one(payload) for payload in payloads]
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractedFlightInfo | None]:
+        return [self.extract_one(payload).result for payload in payloads]
+
+
+class FieldAgreement:
+    """Per field agreement between rule results and model results for the same emails."""
+
+    def __init__(self):
+        self.compared = 0
+        self.exact = 0
+        self.fields = {field: 0 for field in ExtractedFlightInfo.model_fields}
+        self._lock = threading.Lock()
+
+    def add(self, rule: ExtractedFlightInfo | None, model: ExtractedFlightInfo | None):
+        rule_values = rule.model_dump() if rule is not None else {}
+        model_values = model.model_dump() if model is not None else {}
+        with self._lock:
+            self.compared += 1
+            agreed = [field for field in self.fields if rule_values.get(field) == model_values.get(field)]
+            for field in agreed:
+                self.fields[field] += 1
+            if len(agreed) == len(self.fields):
+                self.exact += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            compared = self.compared or 1
+            return {
+                'compared': self.compared,
+                'exact_match': self.exact / compared,
+                'fields': {field: agreed / compared for field, agreed in self.fields.items()},
+            }
+
+
+class CascadeExtractor(Extractor[ExtractedFlightInfo]):
+    """
+    Answers emails the rule extractor is confident about locally and sends only the low
+    confidence and empty ones on to `fallback`.
+
+    With `audit_rate` above zero that share of the confident emails also goes to the
+    fallback, and how often the two agree is tracked in `agreement`. The rule result is
+    still the one returned.
+    """
+
+    def __init__(self,
+                 rules: RuleExtractor,
+                 fallback: Extractor[ExtractedFlightInfo],
+                 threshold: float = DEFAULT_CONFIDENCE_THRESHOLD,
+                 audit_rate: float = 0.0):
+        super().__init__(schema_class=fallback.SCHEMA_PROMPT)
+        self.rules = rules
+        self.fallback = fallback
+        self.model_name = fallback.model_name
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.agreement = FieldAgreement()
+        self.resolved = 0
+        self.escalated = 0
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractedFlightInfo | None]]:
+        """Yields the confident rule results straight away, then the fallback's results."""
+        escalate: list[AIEmailPayload] = []
+        audited: dict[int, ExtractedFlightInfo] = {}
+        for payload in payloads:
+            rule = self.rules.extract_one(payload)
+            if rule.result is None or rule.confidence < self.threshold:
+                escalate.append(payload)
+                continue
+            self.resolved += 1
+            if self.audit_rate and random.random() < self.audit_rate:
+                audited[id(payload)] = rule.result
+                escalate.append(payload)
+            yield payload, rule.result
+        self.escalated += len(escalate) - len(audited)
+
+        for payload, result in self.fallback.extract_iter(escalate):
+            if id(payload) in audited:
+                rule_result = audited.pop(id(payload))
+                # A failed model call says nothing about whether the rules were right
+                if not self.fallback.failed(payload):
+                    self.agreement.add(rule_result, result)
+                continue
+            yield payload, result
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return self.fallback.failed(payload)
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractedFlightInfo | None]:
+        position = {id(payload): i for i, payload in enumerate(payloads)}
+        output: list[ExtractedFlightInfo | None] = [None] * len(payloads)
+        for payload, result in self.extract_iter(payloads):
+            output[position[id(payload)]] = result
+        return output
+
+
+def measure_agreement(rules: RuleExtractor,
+                      model: Extractor[ExtractedFlightInfo],
+                      payloads: list[AIEmailPayload],
+                      threshold: float = DEFAULT_CONFIDENCE_THRESHOLD) -> dict:
+    """
+    Runs both extractors over the same emails. Reports how many the rules would resolve at
+    `threshold` and how well those results agree with the model's.
+    """
+    rule_results = rules.extract_with_confidence(payloads)
+    model_results = model.extract(payloads)
+    confident = FieldAgreement()
+    for rule, result in zip(rule_results, model_results):
+        if rule.result is not None and rule.confidence >= threshold:
+            confident.add(rule.result, result)
+    report = confident.report()
+    report['payloads'] = len(payloads)
+    report['resolved_locally'] = confident.compared / len(payloads) if payloads else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    from model import ClaudeExtractor
+    from tools import load_payloads
+
+    parser = argparse.ArgumentParser(description="Measures rule extraction coverage and agreement with Claude")
+    parser.add_argument("--store", help="read messages from a message store directory instead of ./data")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_CONFIDENCE_THRESHOLD)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.store, args.limit)
+    report = measure_agreement(RuleExtractor(), ClaudeExtractor(schema_class=ExtractedFlightInfo), payloads, args.threshold)
+    print(f"Payloads:          {report['payloads']}")
+    print(f"Resolved locally:  {report['resolved_locally']:.1%}")
+    print(f"Exact agreement:   {report['exact_match']:.1%} of {report['compared']}")
+    for field, rate in report['fields'].items():
+        print(f"  {field}: {rate:.1%}")
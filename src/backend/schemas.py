@@ -1,7 +1,11 @@
 import base64
 import email
-from typing import Any
-from pydantic import BaseModel, Field
+import functools
+import hashlib
+from typing import Any, NamedTuple
+from pydantic import BaseModel, Field, field_validator
+
+from airline_index import AirlineIndex
 
 import abc
 import json
@@ -12,35 +16,78 @@ Do NOT include any other output in your response. \
 Below is the JSON format your output should be in with additional information for each field:"
 
 
-class Attachment():
-    def __init__(self):
-        pass
-    
-    def to_base64(self) -> str:
-        return ""
-    
-    # Returns base64 string after validating it
-    # if the base64 is binary we decode it then convert it to string
-    # input MUST be some version of base64 encoded data
+class Attachment:
+    """
+    Attachment bytes held in a memoryview, so a blob memory mapped from the message store
+    is never copied. The base64 form sent to the model and the SHA-256 digest used for
+    dedupe and cache keys are computed on first use and kept.
+    """
+    __slots__ = ('data', 'filename', 'mime_type', '_base64', '_sha256')
+
+    def __init__(self, data: bytes | memoryview, filename: str | None = None, mime_type: str = 'application/pdf'):
+        self.data = data if isinstance(data, memoryview) else memoryview(data)
+        self.filename = filename
+        self.mime_type = mime_type
+        self._base64: str | None = None
+        self._sha256: str | None = None
+
+    # Gmail returns attachment data as url safe base64
     @classmethod
-    def validate_base64(cls, to_validate) -> str:
-        if type(to_validate) is str:
-            return to_validate
-        elif type(to_validate) is bytes:
-            return base64.b64decode(s=to_validate, validate=True).decode()
-        else:
-            raise Exception()
+    def from_base64(cls, encoded: str, filename: str | None = None, mime_type: str = 'application/pdf') -> 'Attachment':
+        padded = encoded + '=' * (-len(encoded) % 4)
+        return cls(base64.urlsafe_b64decode(padded), filename=filename, mime_type=mime_type)
+
+    def to_base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode('ascii')
+        return self._base64
+
+    @property
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    def __len__(self) -> int:
+        return self.data.nbytes
+
 
 class AIEmailPayload:
     def __init__(self, text_context: dict[str,str], 
                  attachments: list[Attachment]| None,
-                 id: str):
+                 id: str,
+                 sender: str | None = None,
+                 prefilter_score: float | None = None,
+                 original_text: str | None = None):
         """
         @param text_context -> a mapping of context keys in the prompt to their values
+        @param sender -> From header of the email, used to learn per sender boilerplate
+        @param prefilter_score -> score the prefilter gave the message, None when it was not scored
+        @param original_text -> html_text before compaction, None when it was not compacted
         """
         self.text_context = text_context
         self.attachments = attachments
         self.id = id
+        self.sender = sender
+        self.prefilter_score = prefilter_score
+        self.original_text = original_text
+
+    def key_context(self) -> dict[str, str]:
+        """
+        text_context as it was before compaction. Compaction depends on how much boilerplate
+        has been learned so far, cache and dedupe keys are built from this instead so they
+        stay the same from run to run.
+        """
+        if self.original_text is None:
+            return self.text_context
+        return {**self.text_context, 'html_text': self.original_text}
+
+class CompiledPrompt(NamedTuple):
+    meta_schema: dict
+    system_prompt: str
+    # System prompt as a content block marked for provider side prompt caching
+    system_blocks: list[dict]
+
 
 class Promptable(BaseModel, abc.ABC):
     @classmethod
@@ -48,6 +95,25 @@ class Promptable(BaseModel, abc.ABC):
     def get_system_prompt(cls, json_schema: dict) -> str:
         pass
 
+    @classmethod
+    def get_meta_schema(cls) -> dict:
+        properties = cls.model_json_schema()['properties']
+        toReturn = {}
+        for k,v in properties.items():
+            toReturn[k] = {'types' : [v['type']] if 'type' in v else [p['type'] for p in v['anyOf']]}
+            if ("description" in v):
+                toReturn[k]['description'] = v['description']
+        return toReturn
+
+    # Built once per schema class, the system prompt is identical for every request
+    @classmethod
+    @functools.cache
+    def compile_prompt(cls) -> CompiledPrompt:
+        meta_schema = cls.get_meta_schema()
+        system_prompt = cls.get_system_prompt(meta_schema)
+        system_blocks = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        return CompiledPrompt(meta_schema=meta_schema, system_prompt=system_prompt, system_blocks=system_blocks)
+
     
     @classmethod
     @abc.abstractmethod
@@ -72,13 +138,27 @@ class ExtractedFlightInfo(Promptable):
     )
     passenger_name: str | None
 
+    @field_validator('flight_number')
+    @classmethod
+    def normalize_flight_number(cls, flight_number: str | None) -> str | None:
+        # "aa 1234" and "AAL1234" both become AA1234 when the airline is in the code index
+        if flight_number is None:
+            return None
+        return AirlineIndex.default().canonical_flight_number(flight_number)
+
     @classmethod
     def get_user_prompt(cls, content: dict[str, Any]) -> str:
-        return """\
+        prompt = """\
 Any attachments on the email are attached to this prompt.
 Passenger Name: {name}
 Extracted Text from HTML Body of email: 
                 \"{html_text}\"""".format(**content)
+        # PDFs with a usable text layer are sent as their text instead of as attachments
+        if content.get('attachment_text'):
+            prompt += """
+Extracted Text from PDF attachments of email:
+                \"{attachment_text}\"""".format(**content)
+        return prompt
 
     @classmethod
     def get_system_prompt(cls, json_schema: dict) -> str:
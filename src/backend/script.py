@@ -1,5 +1,8 @@
+import argparse
+import logging
 import os.path
-from datetime import datetime
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
 from time import sleep
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -8,18 +11,28 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import base64
 from dotenv import load_dotenv
-from tools import attachment_extraction, message_body_extraction
-from firstpass import generate_firstpass_query
+import metrics
+from tools import extract_unstructured_html, fetch_message_attachments, extrace_html_from_gmail_payload, save_extraction
+from prefilter import PREFILTER_HEADERS, Prefilter
+from gmail_fetch import GmailFetcher
+from message_store import MessageStore, fetch_through
+from sync import MailboxSync, SyncCheckpointStore
 from anthropic import Anthropic
+from compaction import BoilerplateStore, Compactor, message_sender
+from dedupe import DuplicateIndex
+from model import Extractor
+from pdf_text import PdfPreprocessor
+from pipeline import Pipeline, Stage
+from results_store import ResultStore
+from routing import DEFAULT_AUDIT_RATE, DEFAULT_LLM_BATCH_SIZE, DEFAULT_LLM_WORKERS, LLM_BATCH_WAIT
+from schemas import AIEmailPayload
+from wiring import build_extractors, print_report
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 CREDS = "../../credentials.json"
 load_dotenv()
 
-def main():
-  """Shows basic usage of the Gmail API.
-  Lists the user's Gmail labels.
-  """
+def get_credentials() -> Credentials:
   creds = None
   # The file token.json stores the user's access and refresh tokens, and is
   # created automatically when the authorization flow completes for the first
@@ -38,42 +51,185 @@ def main():
     # Save the credentials for the next run
     with open("token.json", "w") as token:
       token.write(creds.to_json())
+  return creds
+
+
+def ingest_stages(fetcher: GmailFetcher,
+                  sync: MailboxSync,
+                  store: MessageStore,
+                  prefilter: Prefilter,
+                  cpu_pool: ProcessPoolExecutor,
+                  pdf_preprocessor: PdfPreprocessor,
+                  compactor: Compactor,
+                  name: str,
+                  duplicates: DuplicateIndex | None = None) -> list[Stage]:
+  """
+  metadata fetch -> prefilter -> full fetch -> attachments -> HTML extraction -> PDF text
+  -> compaction, the stages that turn message ids of one mailbox into model payloads.
+  """
+  # Enough ids per fetch call to keep all of the fetcher's concurrent batches busy
+  fetch_chunk = fetcher.batch_size * fetcher.max_concurrency
+
+  def fetch_metadata(ids):
+    return fetch_through(store, fetcher, ids, format='metadata', metadata_headers=PREFILTER_HEADERS)
+
+  # Messages are scored locally from their metadata instead of with a Gmail search query,
+  # only the ones that pass get their full body fetched
+  def score(message):
+    if prefilter.score(message).passed:
+      return message['id']
+    sync.mark_processed(message['id'])
+    return None
+
+  def fetch_full(ids):
+    return fetch_through(store, fetcher, ids, format='full')
+
+  def fetch_attachments(messages):
+    return fetch_message_attachments(fetcher, messages, store)
+
+  # The HTML parse is CPU bound, it runs in a process pool so it is not serialized on the GIL
+  def extract_text(item):
+    message, attachments = item
+    html = extrace_html_from_gmail_payload(None, message, message['id'])
+    with metrics.timer('html_parse_seconds'):
+      extracted = cpu_pool.submit(extract_unstructured_html, html).result()
+    if len(extracted) == 0 and not attachments:
+      sync.mark_processed(message['id'])
+      return None
+    # The full message carries the same headers and snippet, scoring it again is cheaper than
+    # threading the score through the fetch stages
+    return AIEmailPayload(text_context={'name': name, 'html_text': extracted}, attachments=attachments or None,
+                          id=message['id'], sender=message_sender(message),
+                          prefilter_score=prefilter.score(message).score)
+
+  return [
+    Stage('metadata', fetch_metadata, workers=2, queue_size=2 * fetch_chunk, batch_size=fetch_chunk),
+    Stage('prefilter', score, queue_size=1000),
+    Stage('fetch', fetch_full, workers=2, queue_size=2 * fetch_chunk, batch_size=fetch_chunk),
+    # Attachments of a whole batch of messages are downloaded together, concurrently
+    Stage('attachments', fetch_attachments, workers=2, queue_size=200, batch_size=fetcher.batch_size),
+    Stage('extract', extract_text, workers=os.cpu_count() or 1, queue_size=200),
+    # Confirmations, reminders and boarding passes of one booking are clustered on the parsed
+    # text, before compaction rewrites it, so only one of them is extracted
+    *([Stage('dedupe', duplicates.add_payload, queue_size=200)] if duplicates is not None else []),
+    # PDFs with a good text layer go to the model as text, the layer is read in the process pool
+    Stage('pdf', pdf_preprocessor.process_payload, workers=os.cpu_count() or 1, queue_size=200),
+    # Sender boilerplate and text far from any flight detail is cut before it costs tokens
+    Stage('compact', compactor.compact_payload, queue_size=200),
+  ]
+
+
+def build_pipeline(fetcher: GmailFetcher,
+                   sync: MailboxSync,
+                   store: MessageStore,
+                   prefilter: Prefilter,
+                   extractor: Extractor,
+                   cpu_pool: ProcessPoolExecutor,
+                   pdf_preprocessor: PdfPreprocessor,
+                   compactor: Compactor,
+                   output_dir: pathlib.Path,
+                   name: str,
+                   results: ResultStore | None = None,
+                   duplicates: DuplicateIndex | None = None,
+                   llm_batch_size: int = DEFAULT_LLM_BATCH_SIZE,
+                   llm_workers: int = DEFAULT_LLM_WORKERS) -> Pipeline:
+  """
+  list -> metadata fetch -> prefilter -> full fetch -> attachments -> HTML extraction -> PDF text
+  -> compaction -> LLM -> output.
+  Every stage runs on its own workers joined by bounded queues, so listing, fetching,
+  parsing and extraction overlap and only what fits in the queues and the model batches in
+  flight is held at once.
+  """
+  def save(result):
+    payload, schema = result
+    # A request that ran out of attempts has no answer, it stays in the retry queue for the
+    # next run instead of being saved as "no flight"
+    if not extractor.failed(payload):
+      save_extraction(output_dir, payload, schema)
+      if results is not None:
+        # Indexed copy the dashboard API reads
+        results.upsert(payload.id, schema)
+    sync.mark_processed(payload.id)
+
+  stages = ingest_stages(fetcher, sync, store, prefilter, cpu_pool, pdf_preprocessor, compactor, name, duplicates) + [
+    # Small batches go to the real time endpoint and full ones through the batch API,
+    # several of them can be waiting on the model at once
+    Stage('llm', extractor.extract_iter, workers=llm_workers, queue_size=1000, batch_size=llm_batch_size,
+          batch_wait=LLM_BATCH_WAIT),
+    Stage('output', save, queue_size=1000),
+  ]
+  # Only messages added since the last checkpoint are listed, list pages are pulled
+  # ahead while earlier ids are already being fetched in batches
+  return Pipeline(sync.new_message_ids(), stages)
+
+
+def main(full_scan: bool = False,
+         name: str = "Shrey Patel",
+         llm_batch_size: int = DEFAULT_LLM_BATCH_SIZE,
+         llm_workers: int = DEFAULT_LLM_WORKERS,
+         audit_rate: float = DEFAULT_AUDIT_RATE):
+  creds = get_credentials()
+  checkpoints = SyncCheckpointStore()
+  store = MessageStore()
+  compactor = Compactor(BoilerplateStore())
+  results = ResultStore()
+  duplicates = DuplicateIndex()
+  chain = build_extractors(duplicates, audit_rate=audit_rate)
+  cpu_pool = ProcessPoolExecutor()
+  pdf_preprocessor = PdfPreprocessor(cpu_pool)
 
   try:
     # Call the Gmail API
-    search_query = generate_firstpass_query()
     service = build("gmail", "v1", credentials=creds)
-    results = service.users().messages().list(userId='me', labelIds=['INBOX'],maxResults=5000, q=search_query).execute()
-    messages = results.get('messages', [])
-
-    while 'nextPageToken' in results:
-        page_token = results['nextPageToken']
-        results = service.users().messages().list(userId='me', labelIds=['INBOX'], pageToken=page_token, maxResults=5000,q=search_query).execute()
-        messages.extend(results.get('messages', []))
-    
-
-    print(f"Total messages found: {len(messages)}")
+    fetcher = GmailFetcher(service, credentials=creds)
+    sync = MailboxSync(fetcher, checkpoints)
+    if full_scan:
+        checkpoints.clear(sync.mailbox)
 
+    output_dir = pathlib.Path('./outputs')
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    for msg in messages:
-        message = service.users().messages().get(userId='me', id=msg['id']).execute()
-        subject = ''
-        msg_id = ''
-        for header in message['payload']['headers']:
-            if header['name'] == 'Subject':
-                subject = header['value']
-            if header['name'] == 'Message-ID':
-               msg_id = header['value']        
-        print(f"Message ID: {msg_id}")
-        print(f"Subject: {subject}\nDate: {datetime.fromtimestamp(float(message['internalDate'])/1000).strftime('%Y-%m-%d %H:%M:%S')}")
+    # Requests a previous run could not finish are resubmitted first, on their own
+    for payload, schema in chain.router.retry_pending():
+      if not chain.router.failed(payload):
+        save_extraction(output_dir, payload, schema)
+        results.upsert(payload.id, schema)
 
-        # filename = f"data/email_{msg['id']}_{message['internalDate']}.html"
-        # file = attachment_extraction(service,message,msg['id'])
+    pipeline = build_pipeline(fetcher, sync, store, Prefilter.default(), chain.extractor, cpu_pool, pdf_preprocessor, compactor,
+                              output_dir, name, results, duplicates, llm_batch_size, llm_workers)
+    stats = pipeline.run()
+    committed = sync.commit()
+    print_report(stats, chain, pdf_preprocessor)
+    print(f"Total {'messages found' if sync.full_scan else 'new messages'}: {stats[0]['emitted']}")
+    if not committed:
+      print(f"{sync.unfinished} messages were not processed, the next run picks them up again")
 
   except HttpError as error:
     # TODO(developer) - Handle errors from gmail API.
     print(f"An error occurred: {error}")
+  finally:
+    cpu_pool.shutdown()
+    compactor.store.close()
+    chain.close()
+    results.close()
+    duplicates.close()
+    checkpoints.close()
+    store.close()
 
 
 if __name__ == "__main__":
-  main()
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--full", action="store_true", help="ignore the history checkpoint and rescan the whole inbox")
+  parser.add_argument("--name", default="Shrey Patel", help="mailbox owner's name given to the model")
+  parser.add_argument("--llm-batch-size", type=int, default=DEFAULT_LLM_BATCH_SIZE,
+                      help="most payloads sent to the model in one batch")
+  parser.add_argument("--llm-workers", type=int, default=DEFAULT_LLM_WORKERS, help="sets of payloads in flight at once")
+  parser.add_argument("--audit-rate", type=float, default=DEFAULT_AUDIT_RATE,
+                      help="share of cheaper route results also sent to the strongest model to check them")
+  parser.add_argument("--metrics", help="record stage timings and counters to this file, .json or Prometheus text")
+  parser.add_argument("--profile", help="sample stacks while running and write them here in collapsed format")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  with metrics.recording(args.metrics, args.profile):
+    main(full_scan=args.full, name=args.name, llm_batch_size=args.llm_batch_size, llm_workers=args.llm_workers,
+         audit_rate=args.audit_rate)
@@ -0,0 +1,244 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator
+
+from googleapiclient.errors import HttpError
+
+from gmail_fetch import GmailFetcher
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_DB = "sync_state.db"
+# Runs a listed message that is never processed may keep the checkpoint back, a message
+# deleted before it was fetched or one a stage always drops is given up on after that
+DEFAULT_MAX_HELD_RUNS = 3
+
+
+class HistoryExpired(Exception):
+    """Raised when Gmail no longer has history for a stored historyId."""
+
+
+class SyncCheckpointStore:
+    """
+    Local SQLite store of the last synced historyId and the message ids already processed
+    for each mailbox.
+    """
+
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                mailbox TEXT PRIMARY KEY,
+                history_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS processed (
+                mailbox TEXT NOT NULL,
+                msg_id TEXT NOT NULL,
+                PRIMARY KEY (mailbox, msg_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS held (
+                mailbox TEXT NOT NULL,
+                msg_id TEXT NOT NULL,
+                runs INTEGER NOT NULL,
+                PRIMARY KEY (mailbox, msg_id)
+            ) WITHOUT ROWID;
+        """)
+
+    def get_history_id(self, mailbox: str) -> str | None:
+        with self._lock:
+            row = self.conn.execute("SELECT history_id FROM checkpoints WHERE mailbox = ?", (mailbox,)).fetchone()
+        return row[0] if row else None
+
+    def set_history_id(self, mailbox: str, history_id: str):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO checkpoints (mailbox, history_id, updated_at) VALUES (?, ?, ?) "
+                              "ON CONFLICT(mailbox) DO UPDATE SET history_id = excluded.history_id, "
+                              "updated_at = excluded.updated_at",
+                              (mailbox, history_id, time.time()))
+
+    def clear(self, mailbox: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE mailbox = ?", (mailbox,))
+
+    def mark_processed(self, mailbox: str, msg_ids: Iterable[str]):
+        msg_ids = list(msg_ids)
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO processed (mailbox, msg_id) VALUES (?, ?)",
+                                  ((mailbox, msg_id) for msg_id in msg_ids))
+            self.conn.executemany("DELETE FROM held WHERE mailbox = ? AND msg_id = ?",
+                                  ((mailbox, msg_id) for msg_id in msg_ids))
+
+    def hold(self, mailbox: str, msg_ids: Iterable[str]) -> dict[str, int]:
+        """Counts one more run the messages kept the checkpoint back, returns each one's count."""
+        msg_ids = list(msg_ids)
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT INTO held (mailbox, msg_id, runs) VALUES (?, ?, 1) "
+                                  "ON CONFLICT(mailbox, msg_id) DO UPDATE SET runs = runs + 1",
+                                  ((mailbox, msg_id) for msg_id in msg_ids))
+            return {msg_id: self.conn.execute("SELECT runs FROM held WHERE mailbox = ? AND msg_id = ?",
+                                              (mailbox, msg_id)).fetchone()[0]
+                    for msg_id in msg_ids}
+
+    def release(self, mailbox: str):
+        """Forgets the held messages of a mailbox whose checkpoint moved past them."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM held WHERE mailbox = ?", (mailbox,))
+
+    def is_processed(self, mailbox: str, msg_id: str) -> bool:
+        with self._lock:
+            row = self.conn.execute("SELECT 1 FROM processed WHERE mailbox = ? AND msg_id = ?", (mailbox, msg_id)).fetchone()
+        return row is not None
+
+    def close(self):
+        self.conn.close()
+
+
+class MailboxSync:
+    """
+    Yields the ids of messages that still need processing for a mailbox.
+
+    With a stored historyId only messages added since that checkpoint are listed through
+    users.history.list. Without one, or once Gmail has expired the history (HTTP 404), a full
+    messages.list scan is done instead. Either way ids already marked processed are skipped.
+
+    Call `mark_processed` as messages are handled and `commit` at the end of the run to save
+    the new checkpoint. `flush` saves the processed ids of a run that is done in parts.
+    A listed message that was never marked processed, because a stage failed on it or
+    Gmail dropped its request, keeps the checkpoint where it was, so the next run lists
+    it again while skipping everything that was handled. After `max_held_runs` runs it is
+    given up on and marked processed, so one message deleted mid run or always dropped
+    does not pin the checkpoint and make every later run page an ever longer history.
+
+    History results are not filtered by the search query, so an incremental run can return
+    messages a full scan with the same query would not.
+    """
+
+    def __init__(self,
+                 fetcher: GmailFetcher,
+                 store: SyncCheckpointStore,
+                 mailbox: str | None = None,
+                 label_id: str = 'INBOX',
+                 max_held_runs: int = DEFAULT_MAX_HELD_RUNS):
+        self.fetcher = fetcher
+        self.store = store
+        self.label_id = label_id
+        self.max_held_runs = max_held_runs
+        self.mailbox = mailbox or self._profile()['emailAddress']
+        self._history_id: str | None = None
+        self._processed: list[str] = []
+        # Ids listed in this run and not marked processed yet
+        self._unfinished: set[str] = set()
+        # mark_processed is called from several pipeline stages at once
+        self._processed_lock = threading.Lock()
+        self.full_scan = False
+
+    def _profile(self) -> dict:
+        return self.fetcher.execute(self.fetcher.service.users().getProfile(userId=self.fetcher.user_id))
+
+    def _history_ids(self, start_history_id: str) -> Iterator[str]:
+        history = self.fetcher.service.users().history()
+        page_token = None
+        while True:
+            request = history.list(userId=self.fetcher.user_id,
+                                   startHistoryId=start_history_id,
+                                   historyTypes=['messageAdded'],
+                                   labelId=self.label_id,
+                                   maxResults=500,
+                                   pageToken=page_token)
+            try:
+                results = self.fetcher.execute(request)
+            except HttpError as error:
+                if error.resp.status == 404:
+                    raise HistoryExpired(start_history_id) from error
+                raise
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    yield added['message']['id']
+            self._history_id = results.get('historyId', self._history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+
+    def _full_scan_ids(self, query: str | None) -> Iterator[str]:
+        self.full_scan = True
+        # Taken before listing so anything arriving mid scan is picked up by the next run
+        self._history_id = self._profile()['historyId']
+        yield from self.fetcher.list_message_ids(query=query, label_ids=[self.label_id])
+
+    def _candidate_ids(self, query: str | None) -> Iterator[str]:
+        start_history_id = self.store.get_history_id(self.mailbox)
+        if start_history_id is None:
+            yield from self._full_scan_ids(query)
+            return
+
+        # History has to be fully paged before anything is yielded, an expiry halfway through
+        # would otherwise leave the caller with a partial incremental result
+        try:
+            ids = list(self._history_ids(start_history_id))
+        except HistoryExpired:
+            logger.info("History %s for %s expired, falling back to a full scan", start_history_id, self.mailbox)
+            yield from self._full_scan_ids(query)
+            return
+        yield from ids
+
+    def new_message_ids(self, query: str | None = None) -> Iterator[str]:
+        seen: set[str] = set()
+        for msg_id in self._candidate_ids(query):
+            if msg_id in seen or self.store.is_processed(self.mailbox, msg_id):
+                continue
+            seen.add(msg_id)
+            with self._processed_lock:
+                self._unfinished.add(msg_id)
+            yield msg_id
+
+    def mark_processed(self, msg_id: str):
+        with self._processed_lock:
+            self._processed.append(msg_id)
+            self._unfinished.discard(msg_id)
+            if len(self._processed) >= 500:
+                self.store.mark_processed(self.mailbox, self._processed)
+                self._processed = []
+
+    def flush(self):
+        """Saves the ids processed so far without moving the checkpoint."""
+        with self._processed_lock:
+            self.store.mark_processed(self.mailbox, self._processed)
+            self._processed = []
+
+    @property
+    def unfinished(self) -> int:
+        """Messages listed in this run that were not marked processed."""
+        with self._processed_lock:
+            return len(self._unfinished)
+
+    def commit(self) -> bool:
+        """
+        Saves the processed ids and, when every listed message was processed or given up
+        on, the new checkpoint. Returns whether the checkpoint moved.
+        """
+        self.flush()
+        with self._processed_lock:
+            unfinished = set(self._unfinished)
+        if unfinished:
+            runs = self.store.hold(self.mailbox, unfinished)
+            given_up = [msg_id for msg_id, count in runs.items() if count >= self.max_held_runs]
+            if given_up:
+                logger.warning("Giving up on %d messages of %s not processed in %d runs",
+                               len(given_up), self.mailbox, self.max_held_runs)
+                self.store.mark_processed(self.mailbox, given_up)
+                with self._processed_lock:
+                    self._unfinished.difference_update(given_up)
+            if len(given_up) < len(unfinished):
+                logger.warning("%d messages of %s were not processed, keeping the history checkpoint",
+                               len(unfinished) - len(given_up), self.mailbox)
+                return False
+        if self._history_id is not None:
+            self.store.set_history_id(self.mailbox, self._history_id)
+        self.store.release(self.mailbox)
+        return True
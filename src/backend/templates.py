@@ -0,0 +1,345 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Iterator, NamedTuple
+
+from airline_index import AirlineIndex
+from compaction import sender_domain
+from model import Extractor
+from rules import AIRPORT_CODE, DATE_PATTERNS, FLIGHT_NUMBER_RE, NOT_AIRPORTS, parse_date
+from schemas import AIEmailPayload, ExtractedFlightInfo
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE_DB = "templates.db"
+
+# How each field's value is found on a line
+FIELD_KINDS = {
+    'flight_number': 'flight_number',
+    'airport_code_src': 'airport',
+    'airport_code_dst': 'airport',
+    'flight_takeoff_date': 'date',
+    'passenger_name': 'text',
+}
+# Labels are looked for this many lines above the value
+MAX_ANCHOR_OFFSET = 2
+# Model results a template is induced from, the most recent ones per sender are kept
+MIN_EXAMPLES = 3
+MAX_EXAMPLES = 5
+# Failed applications in a row before a template is thrown away and relearned
+MAX_DRIFTS = 2
+
+AIRPORT_RE = re.compile(rf'\b{AIRPORT_CODE}\b')
+_DIGIT_RE = re.compile(r'\d')
+
+
+class Anchor(NamedTuple):
+    # Text before the value on its line when offset is 0, otherwise a whole label line
+    # `offset` lines above it. `index` picks among several values of the kind on the line
+    label: str
+    offset: int
+    index: int
+
+
+def _normalize(line: str) -> str:
+    return ' '.join(line.split())
+
+
+def _lines(payload: AIEmailPayload) -> list[str]:
+    # Compaction drops the label lines templates anchor on once it has learned them as
+    # boilerplate, so templates read the text from before compaction
+    return [_normalize(line) for line in payload.key_context()['html_text'].splitlines()]
+
+
+def _is_label(text: str) -> bool:
+    # Labels are static template text, anything with digits is a value from this email
+    return bool(text) and any(ch.isalpha() for ch in text) and not _DIGIT_RE.search(text)
+
+
+class TemplateMatcher:
+    """Finds values of each kind on a line and turns them into the schema's normal form."""
+
+    def __init__(self, airlines: AirlineIndex | None = None):
+        self.airlines = airlines or AirlineIndex.default()
+
+    def values(self, kind: str, line: str, label: str = '') -> list[tuple[int, str]]:
+        if kind == 'text':
+            rest = line[len(label):] if label and line.startswith(label) else line
+            rest = rest.strip(' :\t')
+            return [(len(line) - len(rest), rest)] if rest else []
+        if kind == 'flight_number':
+            return [(match.start(), self.airlines.canonical_flight_number(match.group()))
+                    for match in FLIGHT_NUMBER_RE.finditer(line)
+                    if self.airlines.parse_flight_number(match.group()) is not None]
+        if kind == 'airport':
+            return [(match.start(), match.group()) for match in AIRPORT_RE.finditer(line)
+                    if match.group() not in NOT_AIRPORTS]
+        dates = []
+        for pattern, _ in DATE_PATTERNS:
+            for match in pattern.finditer(line):
+                date = parse_date(match)
+                if date is not None:
+                    dates.append((match.start(), date.isoformat()))
+        return sorted(dates)
+
+    def label_on_line(self, kind: str, line: str, value: str) -> str | None:
+        if kind == 'text':
+            position = line.find(value)
+            if position <= 0:
+                return None
+            return _normalize(line[:position]).rstrip(' :') or None
+        values = self.values(kind, line)
+        return _normalize(line[:values[0][0]]) if values else None
+
+    def anchors(self, kind: str, lines: list[str], value: str) -> set[Anchor]:
+        """Every anchor that leads back to exactly `value` in these lines."""
+        found: set[Anchor] = set()
+        for i, line in enumerate(lines):
+            if kind == 'text':
+                matches = [(0, value)] if value in line else []
+            else:
+                matches = self.values(kind, line)
+            for index, (_, candidate) in enumerate(matches):
+                if candidate != value:
+                    continue
+                label = self.label_on_line(kind, line, value)
+                if label is not None and _is_label(label):
+                    found.add(Anchor(label, 0, index))
+                for offset in range(1, MAX_ANCHOR_OFFSET + 1):
+                    if i - offset >= 0 and _is_label(_normalize(lines[i - offset])):
+                        found.add(Anchor(_normalize(lines[i - offset]), offset, index))
+        # A label can also appear earlier in the email or sit before more than the value
+        return {anchor for anchor in found if self.locate(kind, lines, anchor) == (True, value)}
+
+    def locate(self, kind: str, lines: list[str], anchor: Anchor) -> tuple[bool, str | None]:
+        """(whether the anchor was found, the value it points at)."""
+        for i, line in enumerate(lines):
+            normalized = _normalize(line)
+            if anchor.offset == 0:
+                if not normalized.startswith(anchor.label):
+                    continue
+                if kind != 'text' and self.label_on_line(kind, normalized, '') != anchor.label:
+                    continue
+                values = self.values(kind, normalized, anchor.label)
+            else:
+                if normalized != anchor.label or i + anchor.offset >= len(lines):
+                    continue
+                values = self.values(kind, _normalize(lines[i + anchor.offset]))
+            return True, values[anchor.index][1] if anchor.index < len(values) else None
+        return False, None
+
+
+class TemplateStore:
+    """
+    SQLite store of the recent model results per sender domain, as the anchors that lead to
+    each field, and of the templates induced from them. Templates are keyed by domain and
+    the parsed ones are kept in a small LRU, so a lookup is one primary key read at most.
+    """
+
+    def __init__(self, path: str = DEFAULT_TEMPLATE_DB, cache_size: int = 1024):
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, dict | None] = OrderedDict()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS examples (
+                domain TEXT NOT NULL,
+                email_id TEXT NOT NULL,
+                anchors TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (domain, email_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS templates (
+                domain TEXT PRIMARY KEY,
+                template TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                drifts INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID;
+        """)
+
+    def get(self, domain: str) -> dict | None:
+        with self._lock:
+            if domain in self._cache:
+                self._cache.move_to_end(domain)
+                return self._cache[domain]
+            row = self.conn.execute("SELECT template FROM templates WHERE domain = ?", (domain,)).fetchone()
+            template = json.loads(row[0]) if row else None
+            self._cache[domain] = template
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return template
+
+    def add_example(self, domain: str, email_id: str, anchors: dict[str, list | None]) -> list[dict]:
+        """Saves one example and returns the most recent examples for the domain."""
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO examples (domain, email_id, anchors, created) VALUES (?, ?, ?, ?)",
+                              (domain, email_id, json.dumps(anchors), time.time()))
+            self.conn.execute("DELETE FROM examples WHERE domain = ? AND email_id NOT IN "
+                              "(SELECT email_id FROM examples WHERE domain = ? ORDER BY created DESC LIMIT ?)",
+                              (domain, domain, MAX_EXAMPLES))
+            rows = self.conn.execute("SELECT anchors FROM examples WHERE domain = ? ORDER BY created DESC",
+                                     (domain,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def put(self, domain: str, template: dict):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO templates (domain, template, updated) VALUES (?, ?, ?) "
+                              "ON CONFLICT(domain) DO UPDATE SET template = excluded.template, "
+                              "drifts = 0, updated = excluded.updated",
+                              (domain, json.dumps(template), time.time()))
+            self._cache.pop(domain, None)
+
+    def record_hit(self, domain: str):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE templates SET hits = hits + 1, drifts = 0 WHERE domain = ?", (domain,))
+
+    def record_drift(self, domain: str) -> int:
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE templates SET drifts = drifts + 1 WHERE domain = ?", (domain,))
+            row = self.conn.execute("SELECT drifts FROM templates WHERE domain = ?", (domain,)).fetchone()
+        return row[0] if row else 0
+
+    def forget(self, domain: str):
+        """Drops a drifted template and the examples it came from so it is relearned from new emails."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM templates WHERE domain = ?", (domain,))
+            self.conn.execute("DELETE FROM examples WHERE domain = ?", (domain,))
+            self._cache.pop(domain, None)
+
+    def close(self):
+        self.conn.close()
+
+
+def induce(examples: list[dict]) -> dict | None:
+    """
+    Template from the anchors of several examples: for every field, an anchor all of them
+    share, nearest label first. A field that was empty in every example stays empty. None
+    when there are too few examples or some field has no common anchor.
+    """
+    if len(examples) < MIN_EXAMPLES:
+        return None
+    template: dict[str, list | None] = {}
+    for field in FIELD_KINDS:
+        values = [example.get(field) for example in examples]
+        if all(value is None for value in values):
+            template[field] = None
+            continue
+        if any(value is None for value in values):
+            return None
+        common = set.intersection(*(set(map(tuple, value)) for value in values))
+        if not common:
+            return None
+        template[field] = list(min(common, key=lambda anchor: (anchor[1], anchor[2], len(anchor[0]))))
+    if template['flight_number'] is None:
+        return None
+    return template
+
+
+class TemplateExtractor(Extractor[ExtractedFlightInfo]):
+    """
+    Extracts emails from senders with a learned template locally and sends everything else
+    to `fallback`, learning templates from the fallback's results.
+
+    A template holds, for each field, the label line or label text that sits before the
+    value in that sender's emails. It is induced once MIN_EXAMPLES model results from the
+    same domain agree on the anchors. An email where the template finds some anchors but
+    not all of its fields has drifted: it goes to the fallback, and after MAX_DRIFTS
+    drifts in a row the template is dropped and learned again from new results.
+    """
+
+    def __init__(self,
+                 fallback: Extractor[ExtractedFlightInfo],
+                 store: TemplateStore | None = None,
+                 matcher: TemplateMatcher | None = None):
+        super().__init__(schema_class=fallback.SCHEMA_PROMPT)
+        self.fallback = fallback
+        self.model_name = fallback.model_name
+        self.store = store or TemplateStore()
+        self.matcher = matcher or TemplateMatcher()
+        self.templated = 0
+        self.drifted = 0
+
+    def apply(self, template: dict, lines: list[str], name: str | None) -> tuple[ExtractedFlightInfo | None, bool]:
+        """(result, whether any anchor was found). A None result with anchors found is drift."""
+        values: dict[str, str | None] = {}
+        any_found = False
+        complete = True
+        for field, anchor in template.items():
+            if anchor is None:
+                values[field] = None
+                continue
+            found, value = self.matcher.locate(FIELD_KINDS[field], lines, Anchor(*anchor))
+            any_found = any_found or found
+            if value is None:
+                complete = False
+            values[field] = value
+        if not complete:
+            return None, any_found
+        if values.get('passenger_name') and name and values['passenger_name'].lower() != name.lower():
+            # Someone else's booking, the model decides what to do with those
+            return None, False
+        return ExtractedFlightInfo(**values), True
+
+    def learn(self, payload: AIEmailPayload, result: ExtractedFlightInfo):
+        domain = sender_domain(payload.sender)
+        if domain is None:
+            return
+        lines = _lines(payload)
+        anchors: dict[str, list | None] = {}
+        for field, kind in FIELD_KINDS.items():
+            value = getattr(result, field)
+            anchors[field] = None if value is None else sorted(self.matcher.anchors(kind, lines, value))
+        examples = self.store.add_example(domain, payload.id, anchors)
+        if self.store.get(domain) is None:
+            template = induce(examples)
+            if template is not None:
+                logger.info("Learned extraction template for %s", domain)
+                self.store.put(domain, template)
+
+    def extract_iter(self,
+                     payloads: Iterable[AIEmailPayload]
+                     ) -> Iterator[tuple[AIEmailPayload, ExtractedFlightInfo | None]]:
+        escalate: list[AIEmailPayload] = []
+        for payload in payloads:
+            domain = sender_domain(payload.sender)
+            template = self.store.get(domain) if domain is not None else None
+            if template is None:
+                escalate.append(payload)
+                continue
+            lines = _lines(payload)
+            result, matched = self.apply(template, lines, payload.text_context.get('name'))
+            if result is not None:
+                self.templated += 1
+                self.store.record_hit(domain)
+                yield payload, result
+                continue
+            if matched:
+                self.drifted += 1
+                if self.store.record_drift(domain) >= MAX_DRIFTS:
+                    logger.info("Extraction template for %s drifted, relearning", domain)
+                    self.store.forget(domain)
+            escalate.append(payload)
+
+        for payload, result in self.fallback.extract_iter(escalate):
+            if result is not None:
+                self.learn(payload, result)
+            yield payload, result
+
+    def failed(self, payload: AIEmailPayload) -> bool:
+        return self.fallback.failed(payload)
+
+    def extract(self,
+                payloads: list[AIEmailPayload]
+                ) -> list[ExtractedFlightInfo | None]:
+        position = {id(payload): i for i, payload in enumerate(payloads)}
+        output: list[ExtractedFlightInfo | None] = [None] * len(payloads)
+        for payload, result in self.extract_iter(payloads):
+            output[position[id(payload)]] = result
+        return output
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+from batch_scheduler import BatchScheduler
+from fakes import FakeAnthropic, FakeBatches
+
+
+class FailingBatches(FakeBatches):
+    """Batches endpoint that refuses to create the batches whose first request is in `refuse`."""
+
+    def __init__(self, refuse: set[str]):
+        super().__init__(latency=0.0)
+        self.refuse = refuse
+
+    def create(self, requests: list[dict]) -> SimpleNamespace:
+        if requests[0]['custom_id'] in self.refuse:
+            raise RuntimeError("service unavailable")
+        return super().create(requests)
+
+
+def test_failed_shard_comes_back_as_errored_results():
+    client = FakeAnthropic(FailingBatches(refuse={'0'}))
+    scheduler = BatchScheduler(client, max_requests=2, min_poll=0.01, max_poll=0.01)
+    requests = [{'custom_id': str(i), 'params': {'messages': [{'role': 'user', 'content': 'hi'}]}} for i in range(5)]
+    results = {result.custom_id: result.result for result in scheduler.stream(requests)}
+    assert sorted(results) == ['0', '1', '2', '3', '4']
+    assert [results[i].type for i in ('0', '1')] == ['errored', 'errored']
+    assert results['0'].error.error.type == 'api_error'
+    assert all(results[i].type == 'succeeded' for i in ('2', '3', '4'))
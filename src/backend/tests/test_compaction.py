@@ -0,0 +1,78 @@
+from compaction import BoilerplateStore, Compactor
+from dedupe import DuplicateIndex
+from extraction_cache import CachedExtractor, ExtractionCache, payload_key
+from model import Extractor
+from schemas import AIEmailPayload, ExtractedFlightInfo
+
+SENDER = "United <reservations@united.com>"
+BOILERPLATE = ["Download the United app to manage your trip",
+               "Follow us on social media for the latest deals",
+               "You are receiving this email because you booked with us"]
+RESULT = ExtractedFlightInfo(airport_code_src='SFO', airport_code_dst='JFK', flight_takeoff_date='2024-03-14',
+                             flight_number='UA88', passenger_name='Shrey Patel')
+
+
+def email(flight: int, payload_id: str) -> AIEmailPayload:
+    text = '\n'.join(BOILERPLATE + ["Confirmation QX7P2L", f"Flight UA {flight} SFO to JFK on 2024-03-14"]
+                     + BOILERPLATE)
+    return AIEmailPayload(text_context={'name': 'Shrey Patel', 'html_text': text}, attachments=None, id=payload_id,
+                          sender=SENDER)
+
+
+class CountingExtractor(Extractor[ExtractedFlightInfo]):
+    def __init__(self):
+        super().__init__(schema_class=ExtractedFlightInfo)
+        self.model_name = "counting"
+        self.calls = 0
+
+    def extract(self, payloads):
+        self.calls += len(payloads)
+        return [RESULT] * len(payloads)
+
+
+def test_boilerplate_is_dropped_once_learned(tmp_path):
+    compactor = Compactor(BoilerplateStore(str(tmp_path / 'boilerplate.db')))
+    first = compactor.compact_payload(email(88, 'm0'))
+    for i in range(1, 6):
+        compactor.compact_payload(email(100 + i, f'm{i}'))
+    again = compactor.compact_payload(email(88, 'm0'))
+    # Boilerplate right next to a flight line stays as its label, the line further out goes
+    assert BOILERPLATE[1] in first.text_context['html_text']
+    assert BOILERPLATE[1] not in again.text_context['html_text']
+    assert 'UA 88' in again.text_context['html_text']
+
+
+def test_compacted_payload_keeps_its_original_text(tmp_path):
+    compactor = Compactor(BoilerplateStore(str(tmp_path / 'boilerplate.db')))
+    original = email(88, 'm0')
+    compacted = compactor.compact_payload(original)
+    assert compacted.original_text == original.text_context['html_text']
+    assert compacted.key_context() == original.text_context
+    assert payload_key('fingerprint', compacted) == payload_key('fingerprint', original)
+
+
+def test_cache_key_survives_learned_boilerplate(tmp_path):
+    compactor = Compactor(BoilerplateStore(str(tmp_path / 'boilerplate.db')))
+    inner = CountingExtractor()
+    cached = CachedExtractor(inner, ExtractionCache(str(tmp_path / 'cache.db')))
+    assert cached.extract([compactor.compact_payload(email(88, 'm0'))]) == [RESULT]
+    for i in range(1, 6):
+        compactor.compact_payload(email(100 + i, f'm{i}'))
+    # The same email compacts to less text now, it is still answered from the cache
+    assert cached.extract([compactor.compact_payload(email(88, 'm0'))]) == [RESULT]
+    assert inner.calls == 1
+    assert cached.hits == 1
+
+
+def test_cache_key_changes_with_content():
+    assert payload_key('fingerprint', email(88, 'm0')) != payload_key('fingerprint', email(89, 'm0'))
+    assert payload_key('fingerprint', email(88, 'm0')) != payload_key('other', email(88, 'm0'))
+
+
+def test_dedupe_signature_reads_the_original_text(tmp_path):
+    compactor = Compactor(BoilerplateStore(str(tmp_path / 'boilerplate.db')))
+    index = DuplicateIndex(str(tmp_path / 'dedupe.db'))
+    original = email(88, 'm0')
+    for i in range(1, 6):
+        compactor.compact_payload(email(100 + i, f'm{i}'))
+    assert index.signature(compactor.compact_payload(original)) == index.signature(original)
@@ -0,0 +1,52 @@
+from dedupe import DedupingExtractor, DuplicateIndex
+from model import Extractor
+from schemas import AIEmailPayload, ExtractedFlightInfo
+
+RESULT = ExtractedFlightInfo(airport_code_src='SFO', airport_code_dst='JFK', flight_takeoff_date='2024-03-14',
+                             flight_number='UA88', passenger_name='Shrey Patel')
+TEXT = "Your booking QX7P2L is confirmed\nFlight UA 88 SFO to JFK on 2024-03-14\nPassenger Shrey Patel"
+
+
+def email(payload_id: str) -> AIEmailPayload:
+    return AIEmailPayload(text_context={'name': 'Shrey Patel', 'html_text': TEXT}, attachments=None, id=payload_id,
+                          sender="United <reservations@united.com>")
+
+
+class FlakyExtractor(Extractor[ExtractedFlightInfo]):
+    """Fails the first `fail` payloads it is sent, answers the rest."""
+
+    def __init__(self, fail: int = 0):
+        super().__init__(schema_class=ExtractedFlightInfo)
+        self.model_name = "flaky"
+        self.fail = fail
+        self.sent: list[str] = []
+        self.failures: set[str] = set()
+
+    def extract(self, payloads):
+        results = []
+        for payload in payloads:
+            if len(self.sent) < self.fail:
+                self.failures.add(payload.id)
+            self.sent.append(payload.id)
+            results.append(None if payload.id in self.failures else RESULT)
+        return results
+
+    def failed(self, payload):
+        return payload.id in self.failures
+
+
+def test_duplicates_share_one_result(tmp_path):
+    inner = FlakyExtractor()
+    extractor = DedupingExtractor(inner, DuplicateIndex(str(tmp_path / 'dedupe.db')))
+    assert extractor.extract([email('m0'), email('m1'), email('m2')]) == [RESULT] * 3
+    assert inner.sent == ['m0']
+    assert extractor.shared == 2
+
+
+def test_failed_representative_is_retried_for_one_duplicate(tmp_path):
+    inner = FlakyExtractor(fail=1)
+    extractor = DedupingExtractor(inner, DuplicateIndex(str(tmp_path / 'dedupe.db')))
+    assert extractor.extract([email('m0'), email('m1'), email('m2')]) == [None, RESULT, RESULT]
+    assert inner.sent == ['m0', 'm1']
+    assert extractor.failed(email('m0'))
+    assert not extractor.failed(email('m2'))
@@ -0,0 +1,77 @@
+import base64
+
+import pytest
+
+pytest.importorskip('lxml')
+pytest.importorskip('bs4')
+
+import html_text
+from fakes import generate_mailbox
+from tools import extract_unstructured_html_bs4
+
+
+# Constructs seen in airline, hotel and newsletter emails
+EMAIL_BODIES = [
+    # Outlook conditional comments and a hidden preheader
+    '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Your trip</title>'
+    '<style>.x { color: red }</style></head><body>'
+    '<!--[if mso]><table><tr><td><![endif]-->'
+    '<div style="display:none">Your flight to JFK is confirmed</div>'
+    '<table role="presentation"><tr><td>Confirmation</td><td><b>ABC123</b></td></tr>'
+    '<tr><td>Flight</td><td>UA&nbsp;123</td></tr><tr><td>Route</td><td>SFO &rarr; JFK</td></tr></table>'
+    '<!--[if mso]></td></tr></table><![endif]--></body></html>',
+    # Links with nested markup, images and tracking pixels
+    '<html><body><p>Hi Shrey,</p><p>Manage your booking <a href="https://example.com/m?id=1">'
+    '<span>here</span> <img src="x.png" alt="arrow"></a>.</p>'
+    '<a href="https://example.com/u"><b>Unsubscribe</b></a><a name="anchor">Top</a>'
+    '<img src="https://example.com/pixel.gif" width="1" height="1"></body></html>',
+    # Header, nav and footer blocks around the itinerary
+    '<html><body><header><h1>Airline</h1></header><nav><a href="/">Home</a></nav>'
+    '<main><h2>Itinerary</h2><ul><li>Depart 14 Mar 2024 07:45</li><li>Arrive 14 Mar 2024 16:05</li></ul></main>'
+    '<aside>Upgrade now</aside><footer>Copyright 2024</footer></body></html>',
+    # Unclosed paragraphs and list items, entities and line breaks
+    '<div><p>Passenger: PATEL/SHREY<p>Seat 14A<br>Gate B12<br/>Boarding 07:15'
+    '<ul><li>Bag &amp; carry-on<li>Meal: &quot;Vegetarian&quot;</ul></div>',
+    # Plain text with no markup at all
+    'Your e-ticket number is 0162345678901.\nFlight BA 286 LHR to SFO on 2 May 2024.',
+    # Content after the closing html tag, which some mail clients append
+    '<html><body><p>Your flight</p></body></html>\n<div>UA123 SFO to JFK</div>',
+    # Raw text elements that html.parser reads as markup
+    '<div>Notes<textarea>Window <b>seat</b></textarea>End</div><xmp><i>UA 88</i></xmp>',
+    # A CDATA section and a processing instruction
+    '<div>Ref<![CDATA[ QX7P2L ]]>done<?xml version="1.0"?>end</div>',
+]
+
+
+def _html_bodies(count: int) -> list[str]:
+    bodies = []
+    for message in generate_mailbox(count, seed=7).messages:
+        payload = message['payload']
+        part = payload if payload['mimeType'] == 'text/html' else payload['parts'][0]
+        bodies.append(base64.urlsafe_b64decode(part['body']['data']).decode())
+    return bodies
+
+
+@pytest.mark.parametrize('raw_html', EMAIL_BODIES + _html_bodies(60))
+def test_matches_bs4(raw_html):
+    assert html_text.html_to_text(raw_html) == extract_unstructured_html_bs4(raw_html)
+
+
+def test_keeps_content_after_html():
+    text = html_text.html_to_text('<html><body><p>Your flight</p></body></html>\n<div>UA123 SFO to JFK</div>')
+    assert text == 'Your flight\nUA123 SFO to JFK'
+
+
+def test_link_collapses_to_its_text():
+    assert html_text.html_to_text('<p>See <a href="x">your <b>trip</b><script>s</script></a> now</p>') == \
+        'See\nyour trip\nnow'
+
+
+@pytest.mark.parametrize('raw_html', ['', '   \n', '<!-- only a comment -->', '<script>x</script>'])
+def test_empty(raw_html):
+    assert html_text.html_to_text(raw_html) == ''
+
+
+def test_misplaced_tags_do_not_split_text():
+    # Documented difference, libxml2 drops the stray </i> instead of ending a string there
+    assert html_text.html_to_text('<p><b><i>x</b>y</i>z</p>') == 'x\nyz'
@@ -0,0 +1,52 @@
+import pytest
+
+from fakes import FakeGmailService, generate_mailbox
+from gmail_fetch import GmailFetcher
+from message_store import MessageStore, fetch_through, format_covers, format_key
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStore(str(tmp_path / 'message_store'))
+    yield store
+    store.close()
+
+
+def headers(message: dict) -> set[str]:
+    return {header['name'] for header in message['payload']['headers']}
+
+
+def test_format_covers():
+    assert format_covers('full', format_key('metadata', ['Subject']))
+    assert format_covers('full', 'minimal')
+    assert not format_covers('metadata', 'full')
+    assert not format_covers('raw', 'full')
+    assert format_covers(format_key('metadata', ['From', 'Subject']), format_key('metadata', ['subject']))
+    assert not format_covers(format_key('metadata', ['From']), format_key('metadata', ['From', 'Subject']))
+    assert not format_covers(format_key('metadata', ['From']), 'metadata')
+    assert format_covers('metadata', format_key('metadata', ['From']))
+
+
+def test_metadata_copy_only_answers_its_headers(store):
+    fetcher = GmailFetcher(FakeGmailService(generate_mailbox(4, seed=3)))
+    ids = [message['id'] for message in fetcher.service.mailbox.messages]
+    first = list(fetch_through(store, fetcher, ids, format='metadata', metadata_headers=['From']))
+    assert all(headers(message) == {'From'} for message in first)
+    assert fetcher.service.calls['get'] == 4
+
+    # Same headers come from the store, more headers are fetched again
+    assert len(list(fetch_through(store, fetcher, ids, format='metadata', metadata_headers=['from']))) == 4
+    assert fetcher.service.calls['get'] == 4
+    wider = list(fetch_through(store, fetcher, ids, format='metadata', metadata_headers=['From', 'Subject']))
+    assert all(headers(message) == {'From', 'Subject'} for message in wider)
+    assert fetcher.service.calls['get'] == 8
+
+
+def test_full_copy_is_not_replaced_by_a_thinner_one(store):
+    fetcher = GmailFetcher(FakeGmailService(generate_mailbox(2, seed=3)))
+    ids = [message['id'] for message in fetcher.service.mailbox.messages]
+    list(fetch_through(store, fetcher, ids, format='full'))
+    store.put_message(ids[0], {'id': ids[0]}, 'metadata', ['From'])
+    assert store.get_message(ids[0], 'full')['payload']
+    assert len(list(fetch_through(store, fetcher, ids, format='metadata', metadata_headers=['Subject']))) == 2
+    assert fetcher.service.calls['get'] == 2
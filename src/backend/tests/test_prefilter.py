@@ -0,0 +1,23 @@
+from prefilter import AhoCorasick
+
+
+def matches(patterns: list[str], text: str) -> set[str]:
+    matcher = AhoCorasick(patterns)
+    return {matcher.patterns[idx] for idx in matcher.find(text)}
+
+
+def test_patterns_match_whole_words_only():
+    assert matches(['flight', 'itinerary'], "Your Flight itinerary") == {'flight', 'itinerary'}
+    assert matches(['flight', 'gate'], "Flights and investigate") == set()
+    assert matches(['pnr'], "pnr") == {'pnr'}
+
+
+def test_overlapping_patterns_are_all_found():
+    assert matches(['boarding', 'boarding pass', 'pass'], "your boarding pass") == {'boarding', 'boarding pass', 'pass'}
+
+
+def test_punctuation_edge_is_its_own_boundary():
+    assert matches(['flight #'], "Flight #123 is on time") == {'flight #'}
+    assert matches(['#ticket'], "ref#ticket") == {'#ticket'}
+    # The letter edge still needs a boundary
+    assert matches(['flight #'], "Preflight #123") == set()
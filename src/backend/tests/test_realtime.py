@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+
+import anthropic
+import pytest
+
+from realtime import AsyncClaudeExtractor
+from retry_queue import ERRORED, RetryQueue
+from schemas import AIEmailPayload, ExtractedFlightInfo
+
+REPLY = ('"airport_code_src": "SFO", "airport_code_dst": "JFK", "flight_takeoff_date": "2024-03-14", '
+         '"flight_number": "UA88", "passenger_name": "Shrey Patel"}')
+
+
+def status_error(status: int) -> anthropic.APIStatusError:
+    # Built without an HTTP response, only the status code is read
+    error = anthropic.APIStatusError.__new__(anthropic.APIStatusError)
+    Exception.__init__(error, f"HTTP {status}")
+    error.status_code = status
+    error.response = None
+    return error
+
+
+class FakeMessages:
+    """Messages endpoint that raises the next queued error for a payload id, otherwise answers."""
+
+    def __init__(self, errors: dict[str, list[Exception]]):
+        self.errors = errors
+        self.calls: list[str] = []
+
+    async def create(self, **params):
+        text = params['messages'][0]['content']
+        text = text if isinstance(text, str) else ' '.join(block.get('text', '') for block in text)
+        payload_id = next(key for key in ('ok1', 'ok2', 'bad') if key in text)
+        self.calls.append(payload_id)
+        if self.errors.get(payload_id):
+            raise self.errors[payload_id].pop(0)
+        return SimpleNamespace(content=[SimpleNamespace(text=REPLY)],
+                               usage=SimpleNamespace(input_tokens=10, output_tokens=5, cache_read_input_tokens=0))
+
+
+def payload(payload_id: str) -> AIEmailPayload:
+    return AIEmailPayload(text_context={'name': 'Shrey Patel', 'html_text': f"email {payload_id}"}, attachments=None,
+                          id=payload_id)
+
+
+@pytest.fixture
+def retry_queue(tmp_path):
+    return RetryQueue(str(tmp_path / 'retry_queue.db'))
+
+
+def extractor(retry_queue: RetryQueue, errors: dict[str, list[Exception]]) -> AsyncClaudeExtractor:
+    # No backoff inside _send and no rate limit waits, every error goes straight to _settle
+    extractor = AsyncClaudeExtractor(ExtractedFlightInfo, api_key='test', max_retries=0, retry_queue=retry_queue,
+                                     requests_per_minute=60_000, input_tokens_per_minute=10_000_000,
+                                     output_tokens_per_minute=10_000_000)
+    extractor.async_client = SimpleNamespace(messages=FakeMessages(errors))
+    return extractor
+
+
+def test_refused_request_fails_only_its_payload(retry_queue):
+    realtime = extractor(retry_queue, {'bad': [status_error(400)]})
+    results = {p.id: result for p, result in realtime.extract_iter([payload('ok1'), payload('bad'), payload('ok2')])}
+    assert results['ok1'].flight_number == 'UA88'
+    assert results['ok2'].flight_number == 'UA88'
+    assert results['bad'] is None
+    assert realtime.failed(payload('bad'))
+    assert realtime.failure(payload('bad')) == ERRORED
+    assert not realtime.failed(payload('ok1'))
+    # A 400 comes back the same however often it is sent
+    assert realtime.async_client.messages.calls.count('bad') == 1
+    assert retry_queue.report() == {'dead': {ERRORED: 1}}
+
+
+def test_retryable_error_is_sent_again(retry_queue):
+    realtime = extractor(retry_queue, {'bad': [status_error(529)]})
+    assert realtime.extract([payload('bad')])[0].flight_number == 'UA88'
+    assert not realtime.failed(payload('bad'))
+    assert realtime.async_client.messages.calls == ['bad', 'bad']
+    assert retry_queue.report() == {}
+
+
+def connection_errors(count: int) -> list[anthropic.APIConnectionError]:
+    errors = [anthropic.APIConnectionError.__new__(anthropic.APIConnectionError) for _ in range(count)]
+    for error in errors:
+        Exception.__init__(error, "connection reset")
+    return errors
+
+
+def test_connection_errors_run_out_of_attempts(retry_queue):
+    realtime = extractor(retry_queue, {'bad': connection_errors(5)})
+    assert realtime.extract([payload('bad')]) == [None]
+    assert realtime.failed(payload('bad'))
+    assert len(realtime.async_client.messages.calls) == retry_queue.max_attempts
+
+
+def test_failure_is_forgotten_once_answered(retry_queue):
+    realtime = extractor(retry_queue, {'bad': [status_error(400)]})
+    realtime.extract([payload('bad')])
+    assert realtime.failed(payload('bad'))
+    assert realtime.extract([payload('bad')])[0] is not None
+    assert not realtime.failed(payload('bad'))
+    assert realtime.failures == {}
+    # The durable row goes as well, the payload is no longer counted as dead
+    assert retry_queue.report() == {}
+    assert retry_queue.pending() == []
+
+
+def test_payload_sent_again_gets_fresh_attempts(retry_queue):
+    realtime = extractor(retry_queue, {'bad': connection_errors(retry_queue.max_attempts) + [status_error(529)]})
+    assert realtime.extract([payload('bad')]) == [None]
+    assert retry_queue.report() == {'dead': {ERRORED: 1}}
+    # Sent again, the 529 is retried instead of counting on from the dead attempts
+    assert realtime.extract([payload('bad')])[0].flight_number == 'UA88'
+    assert len(realtime.async_client.messages.calls) == retry_queue.max_attempts + 2
+    assert retry_queue.report() == {}
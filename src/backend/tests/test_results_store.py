@@ -0,0 +1,129 @@
+import http.client
+import threading
+
+import pytest
+
+from api import make_server
+from results_store import ResultStore, decode_cursor, encode_cursor
+from schemas import ExtractedFlightInfo
+
+
+def flight(src: str, dst: str, day: str, number: str = 'UA88') -> ExtractedFlightInfo:
+    return ExtractedFlightInfo(airport_code_src=src, airport_code_dst=dst, flight_takeoff_date=day,
+                               flight_number=number, passenger_name='Shrey Patel')
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultStore(str(tmp_path / 'results.db'))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def server(store):
+    server = make_server(store, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path: str, etag: str | None = None) -> tuple[int, str | None, bytes]:
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request('GET', path, headers={'If-None-Match': etag} if etag else {})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, response.getheader('ETag'), body
+
+
+def test_keyset_pages_cover_every_flight_once(store):
+    # Two messages share a date, the message id breaks the tie
+    days = ['2024-03-01', '2024-03-02', '2024-03-02', '2024-03-05', '2024-03-07', '2024-03-09', '2024-03-12']
+    store.upsert_many([(f'm{i}', flight('SFO', 'JFK', day)) for i, day in enumerate(days)])
+    store.upsert('undated', flight('SFO', 'JFK', None))
+    seen, cursor = [], None
+    while True:
+        page = store.query(limit=3, cursor=cursor)
+        seen += [row['message_id'] for row in page.flights]
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert seen == [f'm{i}' for i in range(len(days))]
+
+    page = store.query(start='2024-03-02', end='2024-03-07', limit=2)
+    assert [row['message_id'] for row in page.flights] == ['m1', 'm2']
+    page = store.query(start='2024-03-02', end='2024-03-07', limit=2, cursor=page.next_cursor)
+    assert [row['message_id'] for row in page.flights] == ['m3', 'm4']
+    assert page.next_cursor is None
+
+
+def test_cursor_round_trips_and_rejects_garbage(store):
+    assert decode_cursor(encode_cursor('2024-03-01', 'm0')) == ('2024-03-01', 'm0')
+    for cursor in ('not a cursor', encode_cursor('2024-03-01', 'm0')[:-3], 'WzEsIDJd'):
+        with pytest.raises(ValueError):
+            store.query(cursor=cursor)
+    with pytest.raises(ValueError):
+        store.query_trips(cursor=encode_cursor('yesterday', '1'))
+
+
+def test_etag_answers_304_until_a_write(store, server):
+    store.upsert('m0', flight('SFO', 'JFK', '2024-03-01'))
+    status, etag, _ = get(server, '/flights')
+    assert status == 200 and etag
+    status, again, body = get(server, '/flights', etag)
+    assert status == 304 and again == etag and body == b''
+    store.upsert('m1', flight('JFK', 'SFO', '2024-03-05'))
+    status, changed, _ = get(server, '/flights', etag)
+    assert status == 200 and changed != etag
+    assert get(server, '/flights?cursor=garbage')[0] == 400
+
+
+def test_airport_filter_ignores_case(store, server):
+    store.upsert('m0', flight('SFO', 'JFK', '2024-03-01'))
+    for path in ('/flights?airport=jfk', '/flights?airport=JFK', '/trips?airport=sfo'):
+        status, _, body = get(server, path)
+        assert status == 200
+        assert b'"m0"' in body, path
+
+
+def test_return_leg_closes_the_trip(store):
+    store.upsert('out', flight('SFO', 'JFK', '2024-03-01'))
+    store.upsert('back', flight('JFK', 'SFO', '2024-03-05', 'UA89'))
+    # The next flight out of home is another trip
+    store.upsert('next', flight('SFO', 'SEA', '2024-03-08', 'AS1'))
+    trips = store.query_trips().trips
+    assert [(trip['origin'], trip['destination'], trip['start'], trip['end']) for trip in trips] == \
+        [('SFO', 'SFO', '2024-03-01', '2024-03-05'), ('SFO', 'SEA', '2024-03-08', '2024-03-08')]
+    assert [leg['message_ids'] for leg in trips[0]['legs']] == [['out'], ['back']]
+
+
+def test_reminder_joins_the_leg_of_its_confirmation(store):
+    store.upsert('confirmation', flight('SFO', 'JFK', '2024-03-01'))
+    store.upsert('reminder', flight('SFO', 'JFK', '2024-03-01', None))
+    [trip] = store.query_trips().trips
+    assert trip['legs'][0]['message_ids'] == ['confirmation', 'reminder']
+    assert trip['legs'][0]['flight_number'] == 'UA88'
+
+
+def test_leg_arriving_late_links_two_trips(store):
+    store.upsert('first', flight('SFO', 'ORD', '2024-03-01'))
+    store.upsert('third', flight('JFK', 'BOS', '2024-03-04', 'B61'))
+    assert len(store.query_trips().trips) == 2
+    store.upsert('second', flight('ORD', 'JFK', '2024-03-02', 'UA7'))
+    [trip] = store.query_trips().trips
+    assert (trip['origin'], trip['destination']) == ('SFO', 'BOS')
+    assert [leg['message_ids'] for leg in trip['legs']] == [['first'], ['second'], ['third']]
+
+
+def test_deleting_a_leg_splits_its_trip(store):
+    store.upsert('first', flight('SFO', 'ORD', '2024-03-01'))
+    store.upsert('second', flight('ORD', 'JFK', '2024-03-02', 'UA7'))
+    store.upsert('third', flight('JFK', 'BOS', '2024-03-04', 'B61'))
+    # The middle email turned out to hold no flight
+    store.upsert('second', None)
+    trips = store.query_trips().trips
+    assert [(trip['origin'], trip['destination']) for trip in trips] == [('SFO', 'ORD'), ('JFK', 'BOS')]
+    assert store.get('second') is None
+    assert store.trip(trips[1]['trip_id'])['legs'][0]['message_ids'] == ['third']
@@ -0,0 +1,73 @@
+import pytest
+
+from model import Extractor
+from rules import (DEFAULT_CONFIDENCE_THRESHOLD, FLIGHT_NUMBER_RE, NO_BOOKING_CONFIDENCE, CascadeExtractor,
+                   RuleExtractor)
+from schemas import AIEmailPayload, ExtractedFlightInfo
+
+NAME = "Shrey Patel"
+CONFIRMATION = ("Your booking is confirmed. Confirmation code: QX7P2L\n"
+                "Passenger: Shrey Patel\n"
+                "Flight UA 88 SFO to JFK\n"
+                "Departs 7:45 AM 14 Mar 2024")
+PROMOTION = ("Hi Shrey Patel! Fares from SFO to JFK from USD 99. Sale ends 2024-06-01. "
+             "Flights like UA 88 are filling up.")
+
+
+def payload(text: str, payload_id: str = 'm1') -> AIEmailPayload:
+    return AIEmailPayload(text_context={'name': NAME, 'html_text': text}, attachments=None, id=payload_id)
+
+
+class RecordingExtractor(Extractor[ExtractedFlightInfo]):
+    def __init__(self):
+        super().__init__(schema_class=ExtractedFlightInfo)
+        self.seen: list[str] = []
+
+    def extract(self, payloads):
+        self.seen += [payload.id for payload in payloads]
+        return [None] * len(payloads)
+
+
+@pytest.fixture(scope='module')
+def rules():
+    return RuleExtractor()
+
+
+def test_confirmation_is_resolved(rules):
+    rule = rules.extract_one(payload(CONFIRMATION))
+    assert rule.confidence >= DEFAULT_CONFIDENCE_THRESHOLD
+    assert rule.result == ExtractedFlightInfo(airport_code_src='SFO', airport_code_dst='JFK',
+                                              flight_takeoff_date='2024-03-14', flight_number='UA88',
+                                              passenger_name=NAME)
+
+
+def test_promotion_without_booking_context_is_capped(rules):
+    rule = rules.extract_one(payload(PROMOTION))
+    assert rule.result is not None
+    assert rule.confidence <= NO_BOOKING_CONFIDENCE < DEFAULT_CONFIDENCE_THRESHOLD
+
+
+def test_e_ticket_counts_as_booking_context(rules):
+    rule = rules.extract_one(payload("Your e-ticket for Shrey Patel: UA 88 SFO to JFK departing 2024-06-01"))
+    assert rule.confidence >= DEFAULT_CONFIDENCE_THRESHOLD
+
+
+@pytest.mark.parametrize('text', ["Departs 7:45 AM 14 Mar", "Arrives 10:05PM 2 Apr", "at 09:30 AM 12"])
+def test_clock_times_are_not_flight_numbers(text):
+    assert FLIGHT_NUMBER_RE.search(text) is None
+
+
+@pytest.mark.parametrize('text, expected', [("UA 88", "UA 88"), ("flight AA1234", "AA1234"), ("B6 123", "B6 123"),
+                                            ("U2 1234", "U2 1234")])
+def test_flight_numbers(text, expected):
+    assert FLIGHT_NUMBER_RE.search(text).group() == expected
+
+
+def test_cascade_sends_only_unsure_emails_on(rules):
+    fallback = RecordingExtractor()
+    cascade = CascadeExtractor(rules, fallback)
+    payloads = [payload(CONFIRMATION, 'confirmed'), payload(PROMOTION, 'promotion')]
+    results = {p.id: result for p, result in cascade.extract_iter(payloads)}
+    assert results['confirmed'].flight_number == 'UA88'
+    assert fallback.seen == ['promotion']
+    assert (cascade.resolved, cascade.escalated) == (1, 1)
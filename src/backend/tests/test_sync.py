@@ -0,0 +1,94 @@
+import pytest
+
+from fakes import FakeGmailService, generate_mailbox
+from gmail_fetch import GmailFetcher
+from pipeline import Pipeline, Stage
+from sync import MailboxSync, SyncCheckpointStore
+
+MAILBOX = 'me@example.com'
+
+
+@pytest.fixture
+def fetcher():
+    return GmailFetcher(FakeGmailService(generate_mailbox(30, seed=1)))
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SyncCheckpointStore(str(tmp_path / 'sync_state.db'))
+    yield store
+    store.close()
+
+
+def run(fetcher: GmailFetcher, store: SyncCheckpointStore, fail: set[str] = frozenset()) -> tuple[MailboxSync, list[str]]:
+    """One sync run through a pipeline whose stage raises on the ids in `fail`."""
+    sync = MailboxSync(fetcher, store, mailbox=MAILBOX)
+    handled = []
+
+    def handle(msg_id):
+        if msg_id in fail:
+            raise RuntimeError(f"cannot handle {msg_id}")
+        handled.append(msg_id)
+        sync.mark_processed(msg_id)
+        return msg_id
+
+    Pipeline(sync.new_message_ids(), [Stage('handle', handle, workers=2)], report_interval=60).run()
+    return sync, handled
+
+
+def test_commit_moves_the_checkpoint(fetcher, store):
+    sync, handled = run(fetcher, store)
+    assert len(handled) == 30
+    assert sync.commit()
+    assert store.get_history_id(MAILBOX) == '30'
+
+
+def test_failed_message_keeps_the_checkpoint(fetcher, store):
+    lost = fetcher.service.mailbox.messages[3]['id']
+    sync, handled = run(fetcher, store, fail={lost})
+    assert len(handled) == 29
+    assert sync.unfinished == 1
+    assert not sync.commit()
+    assert store.get_history_id(MAILBOX) is None
+
+    # The next run lists the lost message again and skips everything else
+    sync, handled = run(fetcher, store)
+    assert handled == [lost]
+    assert sync.commit()
+    assert store.get_history_id(MAILBOX) == '30'
+
+
+def test_message_never_processed_is_given_up_on(fetcher, store):
+    lost = fetcher.service.mailbox.messages[3]['id']
+    for _ in range(2):
+        sync, handled = run(fetcher, store, fail={lost})
+        assert not sync.commit()
+        assert store.get_history_id(MAILBOX) is None
+    # The third run it holds the checkpoint back is its last
+    sync, handled = run(fetcher, store, fail={lost})
+    assert handled == []
+    assert sync.commit()
+    assert sync.unfinished == 0
+    assert store.get_history_id(MAILBOX) == '30'
+    assert store.is_processed(MAILBOX, lost)
+
+
+def test_message_gmail_dropped_keeps_the_checkpoint(fetcher, store):
+    sync = MailboxSync(fetcher, store, mailbox=MAILBOX)
+    ids = list(sync.new_message_ids())
+    # Fetching the last message failed for good, it was never handed on
+    for message in fetcher.fetch(ids[:-1], format='minimal'):
+        sync.mark_processed(message['id'])
+    assert not sync.commit()
+    assert store.is_processed(MAILBOX, ids[0])
+    assert not store.is_processed(MAILBOX, ids[-1])
+
+
+def test_flush_saves_processed_ids_only(fetcher, store):
+    sync = MailboxSync(fetcher, store, mailbox=MAILBOX)
+    ids = list(sync.new_message_ids())
+    for msg_id in ids:
+        sync.mark_processed(msg_id)
+    sync.flush()
+    assert all(store.is_processed(MAILBOX, msg_id) for msg_id in ids)
+    assert store.get_history_id(MAILBOX) is None
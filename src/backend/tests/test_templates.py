@@ -0,0 +1,85 @@
+import pytest
+
+from model import Extractor
+from schemas import AIEmailPayload, ExtractedFlightInfo
+from templates import MAX_DRIFTS, MIN_EXAMPLES, TemplateExtractor, TemplateStore
+
+SENDER = "United <reservations@united.com>"
+AIRPORTS = ['SFO', 'JFK', 'LAX', 'ORD', 'SEA', 'BOS', 'ATL', 'DEN']
+
+
+def flight(n: int) -> ExtractedFlightInfo:
+    return ExtractedFlightInfo(airport_code_src=AIRPORTS[n % 8], airport_code_dst=AIRPORTS[(n + 3) % 8],
+                               flight_takeoff_date=f'2024-03-{1 + n % 28:02d}', flight_number=f'UA{100 + n}',
+                               passenger_name='Shrey Patel')
+
+
+def email(n: int, labels: tuple[str, str, str] = ('Flight', 'Departing', 'Arriving')) -> AIEmailPayload:
+    info = flight(n)
+    text = '\n'.join(["Your trip is confirmed", labels[0], info.flight_number, labels[1], info.airport_code_src,
+                      labels[2], info.airport_code_dst, "Date", info.flight_takeoff_date,
+                      f"Passenger: {info.passenger_name}", "Download the United app to manage your trip"])
+    return AIEmailPayload(text_context={'name': 'Shrey Patel', 'html_text': text}, attachments=None, id=f'm{n}',
+                          sender=SENDER)
+
+
+def compacted(payload: AIEmailPayload) -> AIEmailPayload:
+    """The payload as compaction leaves it once it has learned the label lines as boilerplate."""
+    text = payload.text_context['html_text']
+    kept = [line for line in text.splitlines() if any(ch.isdigit() for ch in line) or line.startswith('Passenger')]
+    return AIEmailPayload(text_context={**payload.text_context, 'html_text': '\n'.join(kept)}, attachments=None,
+                          id=payload.id, sender=payload.sender, original_text=text)
+
+
+class TruthExtractor(Extractor[ExtractedFlightInfo]):
+    """Model stand-in that answers every email with the flight it was built from."""
+
+    def __init__(self):
+        super().__init__(schema_class=ExtractedFlightInfo)
+        self.model_name = "truth"
+        self.calls = 0
+
+    def extract(self, payloads):
+        self.calls += len(payloads)
+        return [flight(int(payload.id[1:])) for payload in payloads]
+
+
+@pytest.fixture
+def extractor(tmp_path):
+    store = TemplateStore(str(tmp_path / 'templates.db'))
+    yield TemplateExtractor(TruthExtractor(), store)
+    store.close()
+
+
+def test_template_is_induced_and_applied(extractor):
+    assert extractor.extract([email(n) for n in range(MIN_EXAMPLES)]) == [flight(n) for n in range(MIN_EXAMPLES)]
+    assert extractor.store.get('united.com') is not None
+    assert extractor.extract([email(10), email(11)]) == [flight(10), flight(11)]
+    assert extractor.templated == 2
+    assert extractor.fallback.calls == MIN_EXAMPLES
+
+
+def test_template_reads_the_text_from_before_compaction(extractor):
+    extractor.extract([compacted(email(n)) for n in range(MIN_EXAMPLES)])
+    assert extractor.store.get('united.com') is not None
+    # The label lines the template anchors on are gone from the compacted text
+    assert extractor.extract([compacted(email(10))]) == [flight(10)]
+    assert extractor.templated == 1
+    assert extractor.drifted == 0
+
+
+def test_drifted_template_is_relearned(extractor):
+    extractor.extract([email(n) for n in range(MIN_EXAMPLES)])
+    redesign = ('Flight', 'From', 'To')
+    # The flight label is still found but the airports are not, the model answers instead
+    assert extractor.extract([email(10 + n, redesign) for n in range(MAX_DRIFTS)]) == \
+        [flight(10 + n) for n in range(MAX_DRIFTS)]
+    assert extractor.drifted == MAX_DRIFTS
+    assert extractor.templated == 0
+    # The old template and its examples are gone, the new layout is learned from fresh results
+    extractor.extract([email(20 + n, redesign) for n in range(MIN_EXAMPLES - MAX_DRIFTS)])
+    assert extractor.store.get('united.com') is not None
+    calls = extractor.fallback.calls
+    assert extractor.extract([email(30, redesign)]) == [flight(30)]
+    assert extractor.templated == 1
+    assert extractor.fallback.calls == calls
@@ -1,47 +1,104 @@
 import base64
 from datetime import datetime
+import json
 import os
+import pathlib
 from bs4 import BeautifulSoup, Comment
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-import pdfreader
 
-from schemas import Attachment
+import html_text
+from gmail_fetch import GmailFetcher
+from message_store import MessageStore
+from schemas import AIEmailPayload, Attachment, Promptable
 
 
-# Given some message, extracts body of text from the message attachments
-def attachment_extraction(service,message,msg_id) -> list[str] | None:
-    text = None
-    attachments = []
-    if 'parts' not in message['payload']:
-        return text
-    for part in message['payload']['parts']:
-        if part['filename']:
+def _is_pdf(part: dict) -> bool:
+    return part.get('mimeType') == 'application/pdf' or part.get('filename', '').lower().endswith('.pdf')
+
+
+# PDF parts of a message, including those nested in multipart/mixed and forwarded messages.
+# Only PDFs are kept since they are sent to the model as document blocks
+def attachment_parts(message: dict) -> list[dict]:
+    found = []
+    parts = list(message['payload'].get('parts', []))
+    while parts:
+        part = parts.pop(0)
+        if part.get('filename') and _is_pdf(part):
+            found.append(part)
+        parts.extend(part.get('parts', []))
+    return found
+
+
+# Given some messages, returns each one with its PDF attachments. Attachments missing from the
+# message store are downloaded concurrently in batches and saved to it, and identical PDFs,
+# such as the same itinerary forwarded or resent, come back as one shared Attachment so each
+# unique document is only stored once and encoded once. Without a fetcher only what the store
+# already has is returned
+def fetch_message_attachments(fetcher: GmailFetcher | None,
+                              messages: list[dict],
+                              store: MessageStore | None = None) -> list[tuple[dict, list[Attachment]]]:
+    by_digest: dict[str, Attachment] = {}
+    found: dict[str, list[tuple[int, Attachment]]] = {message['id']: [] for message in messages}
+    missing: dict[tuple[str, str], tuple[int, dict]] = {}
+
+    def add(msg_id: str, position: int, attachment: Attachment):
+        attachment = by_digest.setdefault(attachment.sha256, attachment)
+        if all(existing is not attachment for _, existing in found[msg_id]):
+            found[msg_id].append((position, attachment))
+
+    for message in messages:
+        for position, part in enumerate(attachment_parts(message)):
+            mime_type = part.get('mimeType') or 'application/pdf'
             if 'data' in part['body']:
-                data = part['body']['data']
-                attachments.append(Attachment.validate_base64(data))
+                add(message['id'], position, Attachment.from_base64(part['body']['data'], part['filename'], mime_type))
+                continue
+            att_id = part['body']['attachmentId']
+            cached = store.get_attachment(message['id'], att_id) if store else None
+            if cached is not None:
+                add(message['id'], position, Attachment(cached, part['filename'], mime_type))
             else:
-                att_id = part['body']['attachmentId']
-                att = service.users().messages().attachments().get(userId='me', messageId=msg_id,id=att_id).execute()
-                data = att['data']
-                attachments.append(Attachment.validate_base64(data))
+                missing[(message['id'], att_id)] = (position, part)
+
+    downloaded = fetcher.fetch_attachments(missing) if fetcher is not None else ()
+    for (msg_id, att_id), data in downloaded:
+        position, part = missing[(msg_id, att_id)]
+        mime_type = part.get('mimeType') or 'application/pdf'
+        if store:
+            store.put_attachment(msg_id, att_id, data, filename=part['filename'], mime_type=mime_type)
+        add(msg_id, position, Attachment(data, part['filename'], mime_type))
+
+    return [(message, [attachment for _, attachment in sorted(found[message['id']], key=lambda item: item[0])])
+            for message in messages]
 
-    return attachments
+
+def attachment_extraction(fetcher: GmailFetcher, message: dict, store: MessageStore | None = None) -> list[Attachment]:
+    return fetch_message_attachments(fetcher, [message], store)[0][1]
 
 
 
 # Body is encoded in base64 and is html. In order to pull the raw unstructured text
 # we need to decode the html and then extract the text.
+# Emails with attachments are multipart, their HTML body is one of the nested parts
 def extrace_html_from_gmail_payload(service,message,msg_id) -> str:
-    if 'data' not in message['payload']['body']:
+    body = message['payload']['body']
+    parts = list(message['payload'].get('parts', []))
+    while 'data' not in body and parts:
+        part = parts.pop(0)
+        if part.get('mimeType') == 'text/html' and 'data' in part.get('body', {}):
+            body = part['body']
+        parts.extend(part.get('parts', []))
+    if 'data' not in body:
         return ""
-    html = message['payload']['body']['data']
+    html = body['data']
     html = base64.urlsafe_b64decode(html.encode('UTF-8'))
     return html.decode('utf-8')
 
 
+# Uses the single pass lxml engine in html_text when lxml is installed, the BeautifulSoup
+# version below gives the same text and is kept as the fallback and benchmark reference
 def extract_unstructured_html(html: str | None, filename: str | None = None) -> str:
     raw_html = ""
     if (filename):
@@ -50,6 +107,12 @@ def extract_unstructured_html(html: str | None, filename: str | None = None) ->
     elif(html):
         raw_html = html
 
+    if html_text.available():
+        return html_text.html_to_text(raw_html)
+    return extract_unstructured_html_bs4(raw_html)
+
+
+def extract_unstructured_html_bs4(raw_html: str) -> str:
     soup = BeautifulSoup(raw_html, 'html.parser')
     
     unwanted_tags = [
@@ -78,8 +141,44 @@ def extract_unstructured_html(html: str | None, filename: str | None = None) ->
     
     return cleaned_text
 
+# Writes one extraction result to output_dir/{payload id}.json, {} when nothing was extracted
+def save_extraction(output_dir: pathlib.Path, payload: AIEmailPayload, schema: Promptable | None):
+    output_file = output_dir / f'{payload.id}.json'
+    with open(output_file, 'w') as f:
+        if schema is not None:
+            json.dump(schema.model_dump(), f, indent=2)
+        else:
+            json.dump({}, f, indent=2)
 
-if __name__ == "__main__":
+
+# Payloads for offline evaluation scripts, read from a message store directory or from ./data
+def load_payloads(store_dir: str | None = None, limit: int | None = None, name: str = "Shrey Patel") -> list[AIEmailPayload]:
+    payloads = []
+    if store_dir:
+        store = MessageStore(store_dir)
+        for message in store.iter_messages():
+            if limit is not None and len(payloads) >= limit:
+                break
+            extracted = extract_unstructured_html(html=extrace_html_from_gmail_payload(None, message, message['id']))
+            attachments = attachment_extraction(None, message, store)
+            if extracted or attachments:
+                sender = next((header['value'] for header in message['payload'].get('headers', [])
+                               if header['name'].lower() == 'from'), None)
+                payloads.append(AIEmailPayload(text_context={'name': name, 'html_text': extracted},
+                                               attachments=attachments or None, id=message['id'], sender=sender))
+        store.close()
+        return payloads
     for root, dirs, files in os.walk('./data'):
         for filename in files:
-            extracted = extract_unstructured_html(html=None, filename=os.path.join(root, filename))
\ No newline at end of file
+            if limit is not None and len(payloads) >= limit:
+                return payloads
+            extracted = extract_unstructured_html(html=None, filename=os.path.join(root, filename))
+            if extracted:
+                payloads.append(AIEmailPayload(text_context={'name': name, 'html_text': extracted},
+                                               attachments=None, id=filename))
+    return payloads
+
+
+if __name__ == "__main__":
+    for path, extracted in html_text.extract_directory('./data'):
+        print(path, len(extracted))
\ No newline at end of file
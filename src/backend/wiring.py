@@ -0,0 +1,58 @@
+from typing import NamedTuple
+
+from dedupe import DedupingExtractor, DuplicateIndex
+from extraction_cache import CachedExtractor
+from pdf_text import PdfPreprocessor
+from retry_queue import RetryQueue
+from routing import DEFAULT_AUDIT_RATE, ModelRouter, default_router
+from rules import CascadeExtractor, RuleExtractor
+from schemas import ExtractedFlightInfo
+from templates import TemplateExtractor, TemplateStore
+
+
+class ExtractorChain(NamedTuple):
+    """The extractor every entry point runs, `extractor`, and its layers for reporting."""
+    extractor: DedupingExtractor
+    cascade: CascadeExtractor
+    templates: TemplateExtractor
+    router: ModelRouter
+    retry_queue: RetryQueue
+
+    def close(self):
+        self.templates.store.close()
+        self.retry_queue.close()
+
+
+def build_extractors(duplicates: DuplicateIndex,
+                     retry_queue: RetryQueue | None = None,
+                     template_store: TemplateStore | None = None,
+                     audit_rate: float = DEFAULT_AUDIT_RATE) -> ExtractorChain:
+    """
+    Emails of the same booking are clustered and only one per cluster is extracted.
+    Templated confirmations the rules read with confidence never reach the model, and
+    senders whose layout has been learned from earlier model results are read locally.
+    Payloads already extracted with the same prompt and model are answered from the cache,
+    the rest go to the cheapest model that can take them, and every route books failed
+    requests in one retry queue.
+    """
+    retry_queue = retry_queue or RetryQueue()
+    router = default_router(ExtractedFlightInfo, retry_queue, audit_rate)
+    templates = TemplateExtractor(CachedExtractor(router), template_store)
+    cascade = CascadeExtractor(RuleExtractor(), templates)
+    return ExtractorChain(DedupingExtractor(cascade, duplicates), cascade, templates, router, retry_queue)
+
+
+def print_report(stats: list[dict], chain: ExtractorChain, pdf_preprocessor: PdfPreprocessor):
+    """What a pipeline run did, stage by stage and layer by layer."""
+    for stage in stats:
+        print(f"{stage['stage']}: {stage['received']} in, {stage['emitted']} out, "
+              f"{stage['errors']} errors, {stage['per_second']}/s")
+    print(f"Duplicates answered from their cluster: {chain.extractor.shared}")
+    print(f"Rules resolved {chain.cascade.resolved} emails locally, {chain.cascade.escalated} went to the model")
+    print(f"Templates read {chain.templates.templated} emails locally, {chain.templates.drifted} had drifted")
+    pdf_report = pdf_preprocessor.report()
+    print(f"PDFs: {pdf_report['converted_to_text']}/{pdf_report['pdfs']} sent as text, "
+          f"{pdf_report['bytes_saved']} bytes and ~{pdf_report['tokens_saved']} input tokens saved")
+    for route, report in chain.router.report().items():
+        print(f"Route {route}: {report}")
+    print(f"Retry queue: {chain.retry_queue.report()}")